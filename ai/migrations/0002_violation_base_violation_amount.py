@@ -0,0 +1,26 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:33
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_base_amounts(apps, schema_editor):
+    # Nothing has been escalated yet, so the current amount is the base
+    Violation = apps.get_model('ai', 'Violation')
+    Violation.objects.filter(base_violation_amount__isnull=True).update(base_violation_amount=F('current_violation_amount'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='violation',
+            name='base_violation_amount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(fill_base_amounts, migrations.RunPython.noop),
+    ]
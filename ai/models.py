@@ -11,6 +11,7 @@ class Violation(models.Model):
     trip = models.ForeignKey('toll.Trip', on_delete=models.CASCADE, related_name='violations')
     vehicle_type = models.CharField(max_length=50)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Amount at detection; current_violation_amount is escalated from it every
+    # night by python manage.py escalate_penalties while the trip is unpaid
+    base_violation_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     current_violation_amount = models.DecimalField(max_digits=10, decimal_places=2)
-    
-    # Logic: 10% increase logic would be a method here or in a Celery task
\ No newline at end of file
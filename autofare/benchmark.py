@@ -0,0 +1,169 @@
+"""
+Helpers shared by the benchmark management commands.
+
+Benchmarks run against a throwaway database created the same way the test
+runner creates one, so they never touch the development data.
+"""
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+@contextmanager
+def benchmark_database(keep=False):
+    """Create a fresh, migrated database for the duration of a benchmark"""
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+        # A file database lets worker threads share data without table locks
+        test_settings['NAME'] = os.path.join(tempfile.gettempdir(), f"autofare_bench_{os.getpid()}.sqlite3")
+    old_name = connection.settings_dict['NAME']
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keep)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keep)
+        teardown_test_environment()
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed):
+    """p50/p95/p99 latency in milliseconds and throughput in requests per second"""
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "throughput": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def run_threads(call, requests, concurrency):
+    """Run call(index) requests times on concurrency threads and return (latencies, elapsed)"""
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    index = next(counter, None)
+                if index is None:
+                    return
+                started = time.perf_counter()
+                call(index)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - started
+
+
+def seed_capture_data(users=200, vehicles_per_user=1, balance=Decimal('1000000.00')):
+    """Small dataset for endpoint benchmarks: users with wallets and vehicles, and one gate"""
+    from toll.models import Gate, Toll
+    from users.models import UserProfile, Wallet
+    from vehicles.models import Vehicle
+    from vehicles.plates import normalize_plate
+
+    created = User.objects.bulk_create([User(username=f"bench{i}@example.com") for i in range(users)])
+    UserProfile.objects.bulk_create([
+        UserProfile(user=user, name=f"Bench {i}", email=user.username, phone='0000000000')
+        for i, user in enumerate(created)
+    ])
+    Wallet.objects.bulk_create([Wallet(user=user, wallet_balance=balance) for user in created])
+    Vehicle.objects.bulk_create([
+        Vehicle(user=user, vehicle_type='car', license_plate=f"BN-{i}-{n}",
+                normalized_plate=normalize_plate(f"BN-{i}-{n}"), vechile_model='Bench')
+        for i, user in enumerate(created) for n in range(vehicles_per_user)
+    ])
+    toll = Toll.objects.create(toll_id='BENCH_TOLL', amount=Decimal('5.50'))
+    gate = Gate.objects.create(gate_id='BENCH_GATE', gate_name='Bench Gate', gate_location='Bench Road')
+    gate.tolls.add(toll)
+    return {
+        "user_ids": [user.pk for user in created],
+        "plates": [f"BN-{i}-{n}" for i in range(users) for n in range(vehicles_per_user)],
+        "gate_id": gate.gate_id,
+    }
+
+
+def seed_scaled_dataset(users, vehicles, gates, seed=0, batch_size=5000, balance=Decimal('1000000.00')):
+    """Bulk-load a production-sized dataset and return samples to drive requests with"""
+    from toll.models import Gate, Toll
+    from users.models import UserProfile, Wallet
+    from vehicles.models import Vehicle
+    from vehicles.plates import normalize_plate
+
+    rng = random.Random(seed)
+    first_user = (User.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    user_ids = list(range(first_user, first_user + users))
+    vehicle_types = [value for value, _ in Vehicle.VEHICLE_TYPES]
+
+    for start in range(0, users, batch_size):
+        chunk = user_ids[start:start + batch_size]
+        User.objects.bulk_create([User(id=pk, username=f"load{pk}@example.com", password='!') for pk in chunk])
+        UserProfile.objects.bulk_create([
+            UserProfile(user_id=pk, name=f"Load {pk}", email=f"load{pk}@example.com", phone='0000000000')
+            for pk in chunk
+        ])
+        Wallet.objects.bulk_create([Wallet(user_id=pk, wallet_balance=balance) for pk in chunk])
+
+    plates = []
+    for start in range(0, vehicles, batch_size):
+        batch = []
+        for n in range(start, min(start + batch_size, vehicles)):
+            plate = f"LD-{n:08d}"
+            plates.append(plate)
+            batch.append(Vehicle(
+                user_id=user_ids[n % users],
+                vehicle_type=rng.choice(vehicle_types),
+                license_plate=plate,
+                normalized_plate=normalize_plate(plate),
+                vechile_model='Load'
+            ))
+        Vehicle.objects.bulk_create(batch)
+
+    tolls = Toll.objects.bulk_create([
+        Toll(toll_id=f"LOAD_TOLL_{n}", amount=Decimal(amount))
+        for n, amount in enumerate(['3.00', '5.50', '10.00', '20.00'])
+    ])
+    gate_ids = [f"LOAD_GATE_{n:05d}" for n in range(gates)]
+    for start in range(0, gates, batch_size):
+        chunk = gate_ids[start:start + batch_size]
+        Gate.objects.bulk_create([
+            Gate(gate_id=gate_id, gate_name=f"Gate {gate_id}", gate_location='Load Highway') for gate_id in chunk
+        ])
+        Gate.tolls.through.objects.bulk_create([
+            Gate.tolls.through(gate_id=gate_id, toll_id=rng.choice(tolls).toll_id) for gate_id in chunk
+        ])
+
+    return {
+        "user_ids": rng.sample(user_ids, min(len(user_ids), 10000)),
+        "plates": rng.sample(plates, min(len(plates), 10000)),
+        "gate_ids": rng.sample(gate_ids, min(len(gate_ids), 1000)),
+    }
@@ -0,0 +1,45 @@
+"""
+executemany inserts for bulk loads where bulk_create's per-object
+compilation dominates.
+
+Rows are plain tuples in the order of the given fields, with foreign keys
+given by id. Fields left out get the database default (ids are assigned
+by the database unless 'id' is listed); model defaults, pre_save hooks
+and signals do not run, so callers pass every value they need.
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+def insert_rows(model, fields, rows, using=DEFAULT_DB_ALIAS):
+    """executemany rows (tuples in the order of fields) into model's table. Returns the row count."""
+    if not rows:
+        return 0
+    connection = connections[using]
+    meta = model._meta
+    columns = [meta.get_field(name) for name in fields]
+    quote = connection.ops.quote_name
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(meta.db_table),
+        ', '.join(quote(field.column) for field in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+    # Only dates and decimals need adapting to the database's format
+    adapt = {
+        'DateTimeField': connection.ops.adapt_datetimefield_value,
+        'DecimalField': connection.ops.adapt_decimalfield_value,
+    }
+    adapters = [
+        (index, adapt[field.get_internal_type()]) for index, field in enumerate(columns)
+        if field.get_internal_type() in adapt
+    ]
+    if adapters:
+        prepared = []
+        for row in rows:
+            row = list(row)
+            for index, adapter in adapters:
+                row[index] = adapter(row[index])
+            prepared.append(row)
+        rows = prepared
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+    return len(rows)
@@ -0,0 +1,279 @@
+"""
+Synthetic dataset generator for scale testing.
+
+Builds users with profiles and wallets, vehicles, gates and tolls, and a
+history of trips with their toll-charge transactions and violations. Rows
+are written in chunks with executemany straight into the tables
+(autofare.bulk), with primary keys assigned up front, so tens of millions
+of rows take minutes rather than hours.
+
+Distributions are skewed the way production traffic is: a few fleet
+owners hold many vehicles, and a few vehicles and gates see most trips.
+The same seed always produces the same rows. Primary keys start after the
+current maximum of each table (gate ids after the highest numbered
+G-prefixed gate), and plates, emails and national ids are derived from
+them, so generating into a non-empty database is safe. The database's id
+sequences are moved past the generated keys afterwards, and the tariff
+version is bumped, so running servers see the new gates.
+
+Wallet balances agree with the ledger: every wallet gets one opening
+top-up that covers its charges, and its balance is what is left over.
+"""
+import random
+import time
+from array import array
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from ai.models import Violation as AIViolation
+from autofare.bulk import insert_rows
+from toll.models import Gate, Toll, Trip
+from toll.tariffs import bump_version
+from users.models import UserProfile, Wallet, Transaction
+from vehicles.models import Vehicle
+from vehicles.plates import normalize_plate
+from violations.models import Violation
+
+
+TOLL_AMOUNTS_CENTS = [300, 550, 800, 1000, 2000]
+VEHICLE_TYPES = [value for value, _ in Vehicle.VEHICLE_TYPES]
+VEHICLE_TYPE_WEIGHTS = [70, 8, 10, 3, 4, 5]
+COLORS = ['white', 'black', 'silver', 'blue', 'red', 'grey']
+MODELS = ['Toyota Corolla', 'Hyundai Elantra', 'Kia Cerato', 'Nissan Sunny', 'Volvo FH16', 'Mercedes Sprinter']
+PLATE_LETTERS = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+
+
+def plate_for(vehicle_id):
+    """Unique, realistic-looking plate derived from a vehicle id, e.g. 'BKT-0417'"""
+    letters = []
+    number, digits = divmod(vehicle_id, 10000)
+    for _ in range(3):
+        number, index = divmod(number, len(PLATE_LETTERS))
+        letters.append(PLATE_LETTERS[index])
+    if number:
+        letters.append(str(number))
+    return f"{''.join(reversed(letters))}-{digits:04d}"
+
+
+def cents(value):
+    return Decimal(value).scaleb(-2)
+
+
+class DatasetGenerator:
+    """Generate a deterministic, skewed dataset with chunked bulk inserts"""
+
+    def __init__(self, users, vehicles, gates, trips, seed=0, days=90, skew=3.0,
+                 unpaid_rate=0.08, chunk_size=20000, log=None):
+        self.users = users
+        self.vehicles = vehicles
+        self.gates = gates
+        self.trips = trips
+        self.seed = seed
+        self.days = days
+        self.skew = skew
+        self.unpaid_rate = unpaid_rate
+        self.chunk_size = chunk_size
+        self.log = log or (lambda message: None)
+        self.rng = random.Random(seed)
+        self.counts = {}
+
+    def run(self):
+        """Generate everything and return the number of rows written per table"""
+        started = time.perf_counter()
+        if connection.vendor == 'sqlite' and not connection.in_atomic_block:
+            # Durability of a throwaway dataset is not worth an fsync per chunk
+            # (SQLite cannot change it inside a transaction)
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous = OFF')
+
+        self.now = timezone.now().replace(microsecond=0)
+        self.start = self.now - timedelta(days=self.days)
+        self._offsets()
+        self._users()
+        self._gates()
+        self._vehicles()
+        self._history()
+        self._reset_sequences()
+        self.log(f"Done in {time.perf_counter() - started:.1f}s")
+        return self.counts
+
+    # Skewed pick: index 0 is the hottest; skew=1 is uniform
+    def _skewed(self, size):
+        return int(size * self.rng.random() ** self.skew)
+
+    def _offsets(self):
+        def next_id(model):
+            return (model.objects.aggregate(top=Max('pk'))['top'] or 0) + 1
+
+        self.first_user = next_id(User)
+        self.first_profile = next_id(UserProfile)
+        self.first_wallet = next_id(Wallet)
+        self.first_vehicle = next_id(Vehicle)
+        self.first_trip = next_id(Trip)
+        self.first_transaction = next_id(Transaction)
+        self.first_violation = next_id(Violation)
+        self.first_ai_violation = next_id(AIViolation)
+        # Gate ids are strings; generated ones are numbered after every G<digits> id
+        numbered = Gate.objects.filter(gate_id__regex=r'^G[0-9]+$').values_list('gate_id', flat=True)
+        self.first_gate = max((int(gate_id[1:]) for gate_id in numbered), default=0) + 1
+
+    def _reset_sequences(self):
+        # Rows were inserted with explicit ids, which sequences (PostgreSQL) do not follow
+        models = [User, UserProfile, Wallet, Vehicle, Trip, Transaction, Violation, AIViolation]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+    def _insert(self, model, fields, rows):
+        count = insert_rows(model, fields, rows)
+        self.counts[model._meta.label] = self.counts.get(model._meta.label, 0) + count
+
+    def _chunks(self, total):
+        for start in range(0, total, self.chunk_size):
+            yield start, min(start + self.chunk_size, total)
+
+    def _users(self):
+        for start, end in self._chunks(self.users):
+            users, profiles, wallets = [], [], []
+            for i in range(start, end):
+                user_id = self.first_user + i
+                email = f"user{user_id}@example.com"
+                joined = self.start - timedelta(seconds=self.rng.randrange(365 * 86400))
+                users.append((user_id, '!', False, email, '', '', email, False, True, joined))
+                profiles.append((
+                    self.first_profile + i, user_id, f"User {user_id}", email,
+                    f"NID{user_id:010d}", f"01{self.rng.randrange(10 ** 9):09d}"
+                ))
+                wallets.append((self.first_wallet + i, user_id, Decimal('0.00')))
+            with transaction.atomic():
+                self._insert(User, ['id', 'password', 'is_superuser', 'username', 'first_name', 'last_name',
+                                    'email', 'is_staff', 'is_active', 'date_joined'], users)
+                self._insert(UserProfile, ['id', 'user', 'name', 'email', 'national_id', 'phone'], profiles)
+                self._insert(Wallet, ['id', 'user', 'wallet_balance'], wallets)
+        self.log(f"{self.users} users with profiles and wallets")
+
+    def _gates(self):
+        tolls = [(f"GEN_TOLL_{self.seed}_{amount}", cents(amount)) for amount in TOLL_AMOUNTS_CENTS]
+        existing = set(Toll.objects.filter(toll_id__in=[toll_id for toll_id, _ in tolls]).values_list('pk', flat=True))
+        self.gate_ids = []
+        self.gate_fares = array('l')
+        with transaction.atomic():
+            self._insert(Toll, ['toll_id', 'amount'], [toll for toll in tolls if toll[0] not in existing])
+            for start, end in self._chunks(self.gates):
+                gates, links = [], []
+                for i in range(start, end):
+                    gate_id = f"G{self.first_gate + i:06d}"
+                    toll = self.rng.randrange(len(tolls))
+                    self.gate_ids.append(gate_id)
+                    self.gate_fares.append(TOLL_AMOUNTS_CENTS[toll])
+                    gates.append((gate_id, f"Gate {gate_id}", f"Highway {self.rng.randrange(1, 100)} km {i}"))
+                    links.append((gate_id, tolls[toll][0]))
+                self._insert(Gate, ['gate_id', 'gate_name', 'gate_location'], gates)
+                self._insert(Gate.tolls.through, ['gate', 'toll'], links)
+            # Bulk inserts send no signals; running processes rebuild their tariff matrix
+            bump_version()
+        self.log(f"{self.gates} gates")
+
+    def _vehicles(self):
+        # Per-vehicle owner index and type, kept compact for the trip pass
+        self.vehicle_owner = array('l')
+        self.vehicle_type = array('b')
+        for start, end in self._chunks(self.vehicles):
+            rows = []
+            for i in range(start, end):
+                vehicle_id = self.first_vehicle + i
+                # The first vehicles go one per user, the rest to skewed (fleet) owners
+                owner = i if i < self.users else self._skewed(self.users)
+                kind = self.rng.choices(range(len(VEHICLE_TYPES)), VEHICLE_TYPE_WEIGHTS)[0]
+                self.vehicle_owner.append(owner)
+                self.vehicle_type.append(kind)
+                plate = plate_for(vehicle_id)
+                rows.append((
+                    vehicle_id, self.first_user + owner, VEHICLE_TYPES[kind], plate, normalize_plate(plate),
+                    self.rng.choice(COLORS), self.rng.choice(MODELS)
+                ))
+            with transaction.atomic():
+                self._insert(Vehicle, ['id', 'user', 'vehicle_type', 'license_plate', 'normalized_plate',
+                                       'vechile_color', 'vechile_model'], rows)
+        self.log(f"{self.vehicles} vehicles")
+
+    def _history(self):
+        charged = {}
+        span = (self.now - self.start).total_seconds()
+        transaction_id = self.first_transaction
+        violation_id = self.first_violation
+        ai_violation_id = self.first_ai_violation
+
+        for start, end in self._chunks(self.trips if self.vehicles and self.gates else 0):
+            trips, charges, violations, detections = [], [], [], []
+            for i in range(start, end):
+                trip_id = self.first_trip + i
+                vehicle = self._skewed(self.vehicles)
+                gate = self._skewed(self.gates)
+                fare = self.gate_fares[gate]
+                owner = self.vehicle_owner[vehicle]
+                when = self.start + timedelta(seconds=span * i / self.trips + self.rng.random())
+                paid = self.rng.random() >= self.unpaid_rate
+                trips.append((trip_id, self.first_vehicle + vehicle, self.gate_ids[gate], when, when, cents(fare),
+                              'paid' if paid else 'unpaid'))
+                if paid:
+                    charged[owner] = charged.get(owner, 0) + fare
+                    charges.append((transaction_id, self.first_wallet + owner, f"TXN-GEN-{transaction_id}",
+                                    'toll-charge', cents(fare), when))
+                    transaction_id += 1
+                else:
+                    violations.append((violation_id, self.first_vehicle + vehicle, trip_id, when, 'toll evasion',
+                                       Decimal('50.00'), 'Paid' if self.rng.random() < 0.25 else 'Unpaid'))
+                    detections.append((ai_violation_id, trip_id, VEHICLE_TYPES[self.vehicle_type[vehicle]],
+                                       when, Decimal('50.00'), Decimal('50.00')))
+                    violation_id += 1
+                    ai_violation_id += 1
+            with transaction.atomic():
+                self._insert(Trip, ['trip_id', 'vehicle', 'gate', 'trip_time', 'created_at', 'fare_amount',
+                                    'status'], trips)
+                self._insert(Transaction, ['id', 'wallet', 'transaction_id', 'transaction_type',
+                                           'amount', 'date'], charges)
+                self._insert(Violation, ['id', 'vehicle', 'trip', 'violation_date', 'violation_type',
+                                         'base_penalty', 'status'], violations)
+                self._insert(AIViolation, ['violation_no', 'trip', 'vehicle_type', 'timestamp',
+                                           'base_violation_amount', 'current_violation_amount'], detections)
+            self.log(f"{end}/{self.trips} trips")
+
+        # Opening top-ups cover every wallet's charges; the balance is what remains
+        ops = connections[connection.alias].ops
+        opened = self.start - timedelta(days=1)
+        for start, end in self._chunks(self.users):
+            topups, balances = [], []
+            for owner in range(start, end):
+                left = int(self.rng.lognormvariate(9, 1))  # cents, median about 80.00
+                topups.append((transaction_id, self.first_wallet + owner, f"TXN-GEN-{transaction_id}",
+                               'top-up', cents(charged.get(owner, 0) + left), opened))
+                balances.append((cents(left), self.first_wallet + owner))
+                transaction_id += 1
+            with transaction.atomic():
+                self._insert(Transaction, ['id', 'wallet', 'transaction_id', 'transaction_type',
+                                           'amount', 'date'], topups)
+                with connection.cursor() as cursor:
+                    cursor.executemany(
+                        f"UPDATE {connection.ops.quote_name(Wallet._meta.db_table)} SET wallet_balance = %s WHERE id = %s",
+                        [(ops.adapt_decimalfield_value(balance), pk) for balance, pk in balances]
+                    )
+        self.log("wallet balances")
+
+    def sample(self, users=10000, plates=10000, gates=1000):
+        """Random user ids, plates and gate ids from the generated data, for driving requests"""
+        rng = random.Random(self.seed + 1)
+        return {
+            "user_ids": [self.first_user + rng.randrange(self.users) for _ in range(min(users, self.users))],
+            "plates": [plate_for(self.first_vehicle + rng.randrange(self.vehicles))
+                       for _ in range(min(plates, self.vehicles))],
+            "gate_ids": [rng.choice(self.gate_ids) for _ in range(min(gates, self.gates))],
+        }
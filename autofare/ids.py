@@ -0,0 +1,154 @@
+"""
+Snowflake-style ID generator shared by every app that needs unique IDs.
+
+An ID is a 63-bit integer made of milliseconds since 2026-01-01 (41 bits),
+a worker id (10 bits) and a per-millisecond sequence (12 bits). IDs are
+unique across processes as long as each process has its own worker id,
+need no database round trip, and sort roughly by creation time, so
+inserts into the unique index stay append-friendly.
+
+The worker id is the ID_WORKER_ID setting or the AUTOFARE_WORKER_ID
+environment variable when one is set; the deployment then gives every
+process its own. Otherwise it is ID_HOST_ID (0-31, one per machine or
+container) in the high HOST_BITS, and a slot leased by the process in the
+low bits: the process holds an exclusive flock on
+ID_LEASE_DIR/worker-<slot>.lock for as long as it lives, so no two live
+processes on the host share a slot, and a dead process frees its own.
+A process that borrows milliseconds ahead of the clock records the last
+one in the lock file, and the next holder of the slot starts after it.
+Without a worker id or a host id, generating an id raises
+ImproperlyConfigured.
+"""
+import fcntl
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+EPOCH_MS = 1767225600000  # 2026-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+HOST_BITS = 5
+SLOTS = 1 << (WORKER_BITS - HOST_BITS)
+
+
+def lease_slot(directory):
+    """(slot, open lock file) of a slot no other live process on this host holds"""
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(SLOTS):
+        handle = open(os.path.join(directory, f"worker-{slot}.lock"), 'a+')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            handle.close()
+            continue
+        return slot, handle
+    raise ImproperlyConfigured(f"All {SLOTS} worker ids in {directory} are held by running processes")
+
+
+def default_worker_id():
+    """(worker id, lease to keep open, or None) for this process"""
+    worker_id = getattr(settings, 'ID_WORKER_ID', None)
+    if worker_id is None:
+        worker_id = os.environ.get('AUTOFARE_WORKER_ID')
+    if worker_id is not None:
+        if not 0 <= int(worker_id) <= MAX_WORKER_ID:
+            raise ImproperlyConfigured(f"The worker id must be 0-{MAX_WORKER_ID}, not {worker_id}")
+        return int(worker_id), None
+    host_id = getattr(settings, 'ID_HOST_ID', None)
+    if host_id is None:
+        raise ImproperlyConfigured(
+            "Set ID_HOST_ID (AUTOFARE_HOST_ID) to a number unique to this host, or ID_WORKER_ID per process"
+        )
+    if not 0 <= int(host_id) < 1 << HOST_BITS:
+        raise ImproperlyConfigured(f"ID_HOST_ID must be 0-{(1 << HOST_BITS) - 1}, not {host_id}")
+    slot, lease = lease_slot(str(settings.ID_LEASE_DIR))
+    return int(host_id) << (WORKER_BITS - HOST_BITS) | slot, lease
+
+
+class IdGenerator:
+    """Thread-safe, monotonic generator of 63-bit snowflake IDs"""
+
+    def __init__(self, worker_id=None):
+        self._fixed_worker_id = worker_id
+        self._lock = threading.Lock()
+        self._lease = None
+        self._reset()
+
+    def _reset(self):
+        if self._lease is not None:
+            # A forked child closes only its copy; the lock stays with the parent
+            self._lease.close()
+            self._lease = None
+        self.worker_id = self._fixed_worker_id
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+    def next_ids(self, count):
+        """Reserve count consecutive IDs in one call, for bulk inserts"""
+        with self._lock:
+            if self.worker_id is None:
+                self.worker_id, self._lease = default_worker_id()
+                if self._lease is not None:
+                    self._start_after_previous_holder()
+            worker = self.worker_id << SEQUENCE_BITS
+            now = int(time.time() * 1000) - EPOCH_MS
+            # Never go backwards: if the clock moved back, keep using the last millisecond
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+
+            ids = []
+            while len(ids) < count:
+                if self._sequence > MAX_SEQUENCE:
+                    # Sequence exhausted: borrow the next millisecond instead of sleeping
+                    self._last_ms += 1
+                    self._sequence = 0
+                take = min(count - len(ids), MAX_SEQUENCE + 1 - self._sequence)
+                base = (self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) | worker
+                ids.extend(base | sequence for sequence in range(self._sequence, self._sequence + take))
+                self._sequence += take
+            if self._lease is not None and self._last_ms > now:
+                self._lease.truncate(0)
+                self._lease.write(str(self._last_ms))
+                self._lease.flush()
+            return ids
+
+    def _start_after_previous_holder(self):
+        # The slot's previous holder may have used the current millisecond, or borrowed later ones
+        self._lease.seek(0)
+        recorded = self._lease.read().strip()
+        self._last_ms = max(int(time.time() * 1000) - EPOCH_MS, int(recorded) if recorded else -1)
+        self._sequence = MAX_SEQUENCE + 1
+
+
+generator = IdGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    # A forked worker must not reuse its parent's worker id and sequence
+    os.register_at_fork(after_in_child=generator._reset)
+
+
+def next_id():
+    return generator.next_id()
+
+
+def next_ids(count):
+    return generator.next_ids(count)
+
+
+def transaction_id():
+    """Return a new value for Transaction.transaction_id"""
+    return f"TXN{generator.next_id()}"
+
+
+def transaction_ids(count):
+    return [f"TXN{value}" for value in generator.next_ids(count)]
@@ -0,0 +1,240 @@
+"""
+In-process metrics registry exported in the Prometheus text format.
+
+Counters and histograms are plain dicts keyed by label values, updated
+under one lock, so recording a sample costs a dict lookup and an add.
+
+With several worker processes (gunicorn, uwsgi) set METRICS_DIR to a
+directory shared by the workers. Each process then writes a snapshot of
+its own values to <pid>-<start>.json there at most every
+METRICS_FLUSH_INTERVAL seconds (and on exit), and a scrape on any worker
+sums the snapshots of all of them. Counters of workers that have exited
+keep counting towards the totals, as they should; clear the directory on
+deploy. Without METRICS_DIR a scrape only sees its own process.
+
+Usage:
+    from autofare import metrics
+    metrics.captures.inc(gate='G1', outcome='paid')
+    with metrics.capture_phase.time(phase='debit'):
+        ...
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+# Seconds; suits requests that take from a millisecond to a few seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def merge(self, total, values):
+        for key, value in values:
+            key = tuple(key)
+            total[key] = total.get(key, 0) + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f"{self.name}_total{_labels(self.labelnames, key)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), then the sum
+                state = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+        self.registry.maybe_flush()
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, total, values):
+        for key, state in values:
+            key = tuple(key)
+            current = total.get(key)
+            total[key] = list(state) if current is None else [a + b for a, b in zip(current, state)]
+
+    def render(self, values):
+        for key, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(float(bound)))])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self._flush_lock = threading.Lock()
+        self._reset_process()
+
+    def _reset_process(self):
+        self.token = f"{os.getpid()}-{time.time_ns()}"
+        self._next_flush = time.monotonic()
+        for metric in self.metrics.values():
+            metric.values = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    @property
+    def directory(self):
+        path = getattr(settings, 'METRICS_DIR', None)
+        return Path(path) if path else None
+
+    def snapshot(self):
+        """This process's values, as JSON-friendly [label values, value] pairs per metric"""
+        with self.lock:
+            return {
+                name: [[list(key), list(value) if isinstance(value, list) else value]
+                       for key, value in metric.values.items()]
+                for name, metric in self.metrics.items()
+            }
+
+    def maybe_flush(self):
+        if time.monotonic() >= self._next_flush and self.directory is not None:
+            self.flush()
+
+    def flush(self):
+        """Write this process's snapshot to METRICS_DIR (atomically replacing the previous one)"""
+        directory = self.directory
+        if directory is None or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_flush = time.monotonic() + getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{self.token}.json"
+            temporary = directory / f".{self.token}.tmp"
+            temporary.write_text(json.dumps(self.snapshot()))
+            os.replace(temporary, path)
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """Values summed over every process sharing METRICS_DIR (or just this one)"""
+        snapshots = []
+        directory = self.directory
+        if directory is None:
+            snapshots.append(self.snapshot())
+        else:
+            self.flush()
+            for path in directory.glob('*.json'):
+                try:
+                    snapshots.append(json.loads(path.read_text()))
+                except (OSError, ValueError):
+                    continue  # a worker replaced or removed it mid-read
+        totals = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                if name in self.metrics:
+                    self.metrics[name].merge(totals[name], values)
+        return totals
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+os.register_at_fork(after_in_child=registry._reset_process)
+atexit.register(registry.flush)
+
+
+# Application metrics
+captures = registry.counter(
+    'autofare_captures', "Plate reads settled, by gate and outcome (paid, unpaid, no_wallet, duplicate, not_found)",
+    ['gate', 'outcome']
+)
+captures_queued = registry.counter(
+    'autofare_captures_queued', "Plate reads acknowledged for write-behind settlement, by gate", ['gate']
+)
+capture_latency = registry.histogram(
+    'autofare_capture_duration_seconds', "Capture request latency by gate", ['gate']
+)
+capture_phase = registry.histogram(
+    'autofare_capture_phase_duration_seconds', "Capture latency by phase (lookup, pricing, debit, record)", ['phase']
+)
+topups = registry.counter('autofare_wallet_topups', "Wallet top-ups")
+topup_amount = registry.counter('autofare_wallet_topup_amount', "Amount credited by wallet top-ups")
+plate_cache = registry.counter(
+    'autofare_plate_cache_lookups', "Plate resolver lookups by result (hit, miss, filtered, corrected)", ['result']
+)
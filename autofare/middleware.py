@@ -0,0 +1,177 @@
+"""
+Per-request SQL instrumentation.
+
+QueryMetricsMiddleware counts the queries each request issues on every
+database connection, and times them, the slowest one and the whole view.
+Results go out three ways:
+
+* response headers: X-Query-Count, X-Query-Time-Ms, X-Slowest-Query-Ms, X-View-Time-Ms
+* one JSON log line per request on the 'autofare.queries' logger
+* rolling per-endpoint histograms (route_metrics), served to admins at
+  /api/metrics/queries
+
+Queries issued while a streamed response is sent (autofare/streaming.py)
+run after the middleware has returned and are not counted.
+
+Enabled with QUERY_METRICS_ENABLED in autofare/settings.py.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger('autofare.queries')
+
+# Upper bounds of the histogram buckets (the last bucket is unbounded)
+QUERY_COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+TIME_MS_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+
+class QueryRecorder:
+    """Database execute wrapper that tallies the queries of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = ''
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.total += elapsed
+            if elapsed >= self.slowest:
+                self.slowest = elapsed
+                self.slowest_sql = sql
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def _histogram(values, bounds):
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        counts[bisect_left(bounds, value)] += 1
+    labels = [f"le_{bound}" for bound in bounds] + ['inf']
+    return dict(zip(labels, counts))
+
+
+class RouteMetrics:
+    """Last `window` samples of every endpoint, summarised on demand"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, queries, sql_ms, view_ms):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append((queries, sql_ms, view_ms))
+            self._totals[endpoint] = self._totals.get(endpoint, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            samples = {endpoint: list(values) for endpoint, values in self._samples.items()}
+            totals = dict(self._totals)
+
+        result = {}
+        for endpoint, values in sorted(samples.items()):
+            queries = sorted(value[0] for value in values)
+            sql_ms = sorted(value[1] for value in values)
+            view_ms = sorted(value[2] for value in values)
+            result[endpoint] = {
+                "requests": totals[endpoint],
+                "window": len(values),
+                "queries": {
+                    "mean": round(sum(queries) / len(queries), 2),
+                    "p50": _percentile(queries, 50),
+                    "p95": _percentile(queries, 95),
+                    "max": queries[-1],
+                    "histogram": _histogram(queries, QUERY_COUNT_BUCKETS),
+                },
+                "sql_ms": {
+                    "p50": _percentile(sql_ms, 50),
+                    "p95": _percentile(sql_ms, 95),
+                    "p99": _percentile(sql_ms, 99),
+                    "histogram": _histogram(sql_ms, TIME_MS_BUCKETS),
+                },
+                "view_ms": {
+                    "p50": _percentile(view_ms, 50),
+                    "p95": _percentile(view_ms, 95),
+                    "p99": _percentile(view_ms, 99),
+                    "histogram": _histogram(view_ms, TIME_MS_BUCKETS),
+                },
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+
+
+route_metrics = RouteMetrics(getattr(settings, 'QUERY_METRICS_WINDOW', 1000))
+
+
+def endpoint_name(request):
+    """'POST api/capture/<str:gate_id>/' - the URL pattern, so ids don't split the stats"""
+    match = getattr(request, 'resolver_match', None)
+    route = match.route if match is not None else 'unresolved'
+    return f"{request.method} {route}"
+
+
+class QueryMetricsMiddleware:
+    """Record query count, SQL time, slowest statement and view time per request"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_METRICS_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        view_ms = round((time.perf_counter() - started) * 1000, 3)
+        sql_ms = round(recorder.total * 1000, 3)
+        slowest_ms = round(recorder.slowest * 1000, 3)
+
+        response['X-Query-Count'] = str(recorder.count)
+        response['X-Query-Time-Ms'] = str(sql_ms)
+        response['X-Slowest-Query-Ms'] = str(slowest_ms)
+        response['X-View-Time-Ms'] = str(view_ms)
+
+        endpoint = endpoint_name(request)
+        route_metrics.record(endpoint, recorder.count, sql_ms, view_ms)
+        logger.info(json.dumps({
+            "endpoint": endpoint,
+            "path": request.path,
+            "status": response.status_code,
+            "queries": recorder.count,
+            "sql_ms": sql_ms,
+            "slowest_ms": slowest_ms,
+            "slowest_sql": recorder.slowest_sql[:500],
+            "view_ms": view_ms,
+        }))
+        return response
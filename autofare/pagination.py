@@ -0,0 +1,107 @@
+"""
+Keyset (cursor) pagination shared by the list endpoints.
+
+A page is fetched with WHERE (ordering columns) are past the last row of
+the previous page, instead of an OFFSET, so every page costs the same
+index range scan however deep the client pages. The cursor handed to the
+client is the last row's ordering values, JSON encoded and base64'd; it
+is opaque to clients and validated on the way back in.
+
+Usage:
+    ordering = ['-date', '-id']
+    rows = list(keyset(queryset.values(...), ordering, cursor)[:limit + 1])
+    rows, next_cursor = page(rows, ordering, limit)
+
+    for rows in chunks(queryset.values(...), ordering, 2000):
+        ...
+
+The ordering must end in a unique column (usually the primary key) so
+that every row has a distinct position.
+"""
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def _encode_value(value):
+    # Full precision: DjangoJSONEncoder would cut datetimes to milliseconds,
+    # and the cursor has to match the stored value exactly
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=_encode_value, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Values encoded by encode_cursor. Raises ValueError for anything else."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def _columns(ordering):
+    return [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+
+def keyset(queryset, ordering, cursor=None):
+    """queryset ordered by ordering, starting after the row the cursor points at"""
+    queryset = queryset.order_by(*ordering)
+    if not cursor:
+        return queryset
+
+    columns = _columns(ordering)
+    values = decode_cursor(cursor)
+    if len(values) != len(columns):
+        raise ValueError("Invalid cursor")
+    model = queryset.model
+    try:
+        values = [
+            model._meta.get_field(name).to_python(value) for (name, _), value in zip(columns, values)
+        ]
+    except ValidationError as exc:
+        raise ValueError("Invalid cursor") from exc
+
+    # (a, b) after (x, y)  <=>  a past x, or a = x and b past y
+    after = Q()
+    equal = Q()
+    for (name, descending), value in zip(columns, values):
+        after |= equal & Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+        equal &= Q(**{name: value})
+    return queryset.filter(after)
+
+
+def page(rows, ordering, limit):
+    """Split rows fetched with [:limit + 1] into the page and the next page's cursor (or None)"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([last[name] for name, _ in _columns(ordering)])
+
+
+def chunks(queryset, ordering, chunk_size, cursor=None):
+    """Iterate over every row after the cursor as lists of up to chunk_size rows, one query each.
+
+    The cursor is checked straight away (ValueError), not when iteration starts.
+    """
+    keyset(queryset, ordering, cursor)
+
+    def generate(cursor):
+        while True:
+            rows = list(keyset(queryset, ordering, cursor)[:chunk_size + 1])
+            rows, cursor = page(rows, ordering, chunk_size)
+            yield rows
+            if cursor is None:
+                return
+
+    return generate(cursor)
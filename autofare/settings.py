@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'autofare.middleware.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -136,7 +139,9 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Rejects revoked tokens and inactive users. Gate and mobile views opt
+        # into the claims-only check instead (users/authentication.py)
+        'users.authentication.RevocableJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
@@ -155,3 +160,112 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
 }
+
+# Toll capture settings
+# Plate -> vehicle/owner/wallet cache used by the capture path (entries, seconds)
+PLATE_CACHE_SIZE = 100000
+PLATE_CACHE_TTL = 300
+
+# Write-behind capture: acknowledge with 202 and settle from a local queue
+# (python manage.py settle_captures). Gates can also opt in with ?mode=async.
+CAPTURE_WRITE_BEHIND = False
+CAPTURE_QUEUE_PATH = BASE_DIR / 'capture_queue.sqlite3'
+# A capture that fails to settle is handed out again after this many seconds
+CAPTURE_RETRY_DELAY = 30
+
+# Repeated reads of a plate at the same gate within this many seconds are
+# answered with the first read's result instead of charging again (0 disables)
+CAPTURE_DEDUP_WINDOW = 2
+
+# Request instrumentation
+# Per-request query count and SQL/view timing as X-Query-* response headers,
+# JSON lines on the 'autofare.queries' logger and rolling per-endpoint
+# histograms over the last QUERY_METRICS_WINDOW requests (/api/metrics/queries)
+QUERY_METRICS_ENABLED = False
+QUERY_METRICS_WINDOW = 1000
+
+# Prometheus metrics (/metrics). With several worker processes, point
+# METRICS_DIR at a directory they share; each worker writes its values there
+# every METRICS_FLUSH_INTERVAL seconds and a scrape sums them.
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'autofare.queries': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+        'autofare.settlement': {'handlers': ['console'], 'level': 'WARNING', 'propagate': False},
+    },
+}
+
+# JWT revocation (logout)
+# Each process reloads newly revoked tokens this often (seconds), so a
+# logout made on one worker is enforced by the others within this delay
+REVOCATION_REFRESH_INTERVAL = 5
+
+# Wallet reconciliation (python manage.py reconcile_wallets)
+# Checkpoints leave out each wallet's transactions from the last this many
+# seconds: debits of a sharded wallet can commit out of id order
+CHECKPOINT_SETTLE_SECONDS = 60
+
+# Gate-local spending allowances (users/allowances.py)
+# A wallet captured ALLOWANCE_HOT_CAPTURES times at one gate within
+# ALLOWANCE_TTL seconds gets ALLOWANCE_AMOUNT held for this process to
+# spend in memory at that gate. python manage.py reconcile_allowances
+# closes them ALLOWANCE_CLOSE_GRACE seconds after they expire.
+SPENDING_ALLOWANCES = False
+ALLOWANCE_AMOUNT = '50.00'
+ALLOWANCE_TTL = 300
+ALLOWANCE_HOT_CAPTURES = 3
+ALLOWANCE_CLOSE_GRACE = 60
+
+# Plate prefilter (vehicles/plate_filter.py)
+# A Bloom filter of registered plates answers reads of unknown plates
+# without a query. Each process adds vehicles created elsewhere every
+# PLATE_FILTER_REFRESH seconds. Set PLATE_FILTER_PATH to share one
+# memory-mapped copy between the worker processes of a host.
+# Other processes see changed plates through Vehicle.updated_at, which
+# save(), update() and bulk_update() stamp. Plates changed in raw SQL
+# must set it too, or they read as unregistered until a rebuild
+# (python manage.py build_plate_filter).
+PLATE_FILTER_ENABLED = True
+PLATE_FILTER_PATH = None
+PLATE_FILTER_FP_RATE = 0.01
+PLATE_FILTER_REFRESH = 5
+
+# Fuzzy plate matching (vehicles/matching.py)
+# With PLATE_FUZZY_CAPTURE on, a capture of an unregistered plate charges
+# the single registered plate closest to it, if it is within
+# PLATE_FUZZY_CAPTURE_DISTANCE. Each look-alike substitution (0/O, 1/I,
+# 8/B, ...) counts 0.25 and any other edit 1; below 1 only look-alikes are
+# accepted, and no in-memory index is needed.
+PLATE_FUZZY_CAPTURE = False
+PLATE_FUZZY_CAPTURE_DISTANCE = 0.5
+
+# Violation reconciliation (python manage.py reconcile_violations)
+# Each pass issues violations for unpaid trips written since the saved
+# created_at watermark, starting this many seconds before it: a trip is
+# stamped before it commits, by its host's clock. Trips are issued in
+# batches of VIOLATION_RECONCILE_BATCH, one transaction each.
+VIOLATION_RECONCILE_OVERLAP = 60
+VIOLATION_RECONCILE_BATCH = 5000
+
+# Snowflake ids (autofare/ids.py)
+# Every process needs its own worker id: set ID_WORKER_ID per process, or
+# ID_HOST_ID (0-31) per machine or container and each process leases one
+# of its 32 worker ids with a lock file in ID_LEASE_DIR. Generating ids
+# fails without either; under DEBUG the host is 0.
+ID_WORKER_ID = None
+ID_HOST_ID = os.environ.get('AUTOFARE_HOST_ID', '0' if DEBUG else None)
+ID_LEASE_DIR = os.path.join(tempfile.gettempdir(), 'autofare-worker-ids')
+
+# Tariff matrix (toll/tariffs.py)
+# Each process prices captures from an in-memory matrix of gate tolls and
+# reads the TariffVersion row at most every TARIFF_REFRESH_INTERVAL
+# seconds: a gate or toll changed by another process is charged within
+# that many seconds.
+TARIFF_REFRESH_INTERVAL = 5
@@ -0,0 +1,95 @@
+"""
+Streamed JSON array and NDJSON responses for large listings.
+
+Rows arrive in chunks (see autofare.pagination.chunks) and are encoded and
+sent one chunk at a time, so memory stays flat however many rows the
+listing has. Under ASGI Django would read a plain iterator into a list
+before sending any of it, so stream_rows is given the request and, for
+an ASGI one, hands Django an async iterator that pulls each chunk through
+sync_to_async instead.
+
+The chunk queries run while the body is sent, after the view and the
+middleware have returned, so X-Query-Count and the other
+QueryMetricsMiddleware figures of a streamed response leave them out.
+
+NDJSON is chosen with an Accept: application/x-ndjson header
+or ?stream=ndjson; views that offer it set
+renderer_classes = ndjson_renderer_classes() so content negotiation
+accepts that media type.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def _dumps(row):
+    # Same encoding as DRF's JSONRenderer
+    return json.dumps(row, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """One JSON document per line; a list is rendered as one line per item"""
+    media_type = NDJSON
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data if isinstance(data, list) else [data]
+        return ''.join(_dumps(row) + '\n' for row in rows).encode()
+
+
+def ndjson_renderer_classes():
+    """The project's default renderers plus NDJSONRenderer"""
+    return list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer]
+
+
+def wants_ndjson(request):
+    if request.query_params.get('stream') == 'ndjson':
+        return True
+    return getattr(getattr(request, 'accepted_renderer', None), 'format', None) == 'ndjson'
+
+
+def _ndjson(chunks):
+    for rows in chunks:
+        if rows:
+            yield ''.join(_dumps(row) + '\n' for row in rows)
+
+
+def _json_array(chunks):
+    yield '['
+    first = True
+    for rows in chunks:
+        if rows:
+            body = ','.join(_dumps(row) for row in rows)
+            yield body if first else ',' + body
+            first = False
+    yield ']'
+
+
+async def _pulled(parts):
+    # One chunk at a time, on the thread the sync view and its queries run on
+    parts = iter(parts)
+    done = object()
+    while True:
+        part = await sync_to_async(next)(parts, done)
+        if part is done:
+            return
+        yield part
+
+
+def stream_rows(chunks, ndjson=False, status=200, headers=None, request=None):
+    """StreamingHttpResponse of the rows in chunks, as one JSON array or as NDJSON"""
+    parts = _ndjson(chunks) if ndjson else _json_array(chunks)
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        parts = _pulled(parts)
+    response = StreamingHttpResponse(parts, content_type=NDJSON if ndjson else 'application/json', status=status)
+    for name, value in (headers or {}).items():
+        response[name] = value
+    return response
@@ -2,6 +2,11 @@ from django.contrib import admin
 from django.urls import path, include
 from django.http import HttpResponse
 from users.views import WalletViewSet
+from toll import async_views as toll_async
+from users import async_views as users_async
+from vehicles import async_views as vehicles_async
+from vehicles.views import VehicleViewSet
+from .views import prometheus_metrics, query_metrics
 
 def home(request):
     return HttpResponse("Welcome to AutoFare - Toll Collection System API")
@@ -11,9 +16,18 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     # API endpoints - following contract structure
     path('api/users/', include('users.urls')),
+    path('api/user/car/match', VehicleViewSet.as_view({'get': 'match'}), name='vehicle-match'),
     path('api/user/car', include('vehicles.urls')),
     path('api/user/wallet', WalletViewSet.as_view({'get': 'list', 'post': 'create'}), name='wallet'),
     path('api/capture/', include('toll.urls')),
+    # Native async endpoints, same contracts as above (serve through autofare.asgi)
+    path('api/async/capture/<str:gate_id>/', toll_async.capture_vehicle, name='async-capture'),
+    path('api/async/user/wallet', users_async.wallet, name='async-wallet'),
+    path('api/async/user/car', vehicles_async.vehicle_list, name='async-car'),
+    # Per-endpoint SQL metrics, recorded when QUERY_METRICS_ENABLED is on (admin only)
+    path('api/metrics/queries', query_metrics, name='query-metrics'),
+    # Prometheus scrape endpoint
+    path('metrics', prometheus_metrics, name='metrics'),
     # Legacy app routes
     path('trips/', include('trips.urls')),
     path('payment/', include('payment.urls')),
@@ -0,0 +1,25 @@
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from .metrics import registry
+from .middleware import route_metrics
+
+
+@require_GET
+def prometheus_metrics(request):
+    """GET /metrics - Capture, settlement and top-up metrics in the Prometheus text format"""
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def query_metrics(request):
+    """GET /api/metrics/queries - Rolling per-endpoint query and timing histograms (admin only)
+    DELETE resets them"""
+    if request.method == 'DELETE':
+        route_metrics.reset()
+        return Response(status=204)
+    return Response(route_metrics.snapshot())
@@ -3,6 +3,8 @@ Sample data initialization script for the Automated Toll Collection System.
 This script creates sample users, vehicles, gates, and tolls for testing the API.
 
 Run with: python manage.py shell < sample_data.py
+
+For production-sized data use: python manage.py generate_dataset --help
 """
 
 from django.contrib.auth.models import User
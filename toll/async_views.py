@@ -0,0 +1,131 @@
+"""
+Native async capture endpoint, served through autofare/asgi.py.
+
+Same request and response contract as TollCaptureViewSet.capture_vehicle.
+Plate and tariff lookups run on the event loop (cached, or through the
+async ORM on a miss); only the atomic charge leaves it, through
+sync_to_async. As in the sync view, CAPTURE_WRITE_BEHIND (or ?mode=async)
+queues the capture instead, and repeated reads are answered from the
+in-process ring in toll/dedup.py, with the Trip.dedup_key guard across
+processes.
+"""
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from autofare import metrics
+from vehicles.resolver import plate_resolver
+from .capture_queue import capture_queue, write_behind
+from .dedup import recent_reads
+from .serializers import TollReadSerializer
+from .settlement import settle_read
+from .tariffs import DEFAULT_TOLL_AMOUNT, aget_tariffs
+
+
+def _json_body(request):
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+
+
+@csrf_exempt
+@require_POST
+async def capture_vehicle(request, gate_id):
+    """POST /async/capture/{gate_id} - Capture vehicle at toll gate"""
+    data = _json_body(request)
+    if data is None:
+        return JsonResponse({"detail": "JSON parse error"}, status=400)
+    
+    serializer = TollReadSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    license_plate = serializer.validated_data['license_plate']
+    
+    started = time.perf_counter()
+    with metrics.capture_phase.time(phase='lookup'):
+        record = await plate_resolver.aresolve(license_plate)
+    if record is None:
+        return JsonResponse(
+            {"license_plate": ["Vehicle with this license plate not found."]},
+            status=400
+        )
+    
+    with metrics.capture_phase.time(phase='pricing'):
+        gate = (await aget_tariffs()).get_gate(gate_id)
+        if gate is None:
+            return JsonResponse({"error": f"Gate {gate_id} not found"}, status=404)
+        
+        toll_amount = gate.amounts.get(record.vehicle_type, DEFAULT_TOLL_AMOUNT)
+    location = f"{gate.gate_name} - {gate.gate_location}"
+    
+    try:
+        return await _capture(request, gate, license_plate, record, toll_amount, location)
+    finally:
+        metrics.capture_latency.observe(time.perf_counter() - started, gate=gate.gate_id)
+
+
+async def _capture(request, gate, license_plate, record, toll_amount, location):
+    if write_behind(request.GET.get('mode')):
+        capture = _queue_capture
+    else:
+        capture = _capture_now
+    
+    if not recent_reads.enabled:
+        return await capture(gate, license_plate, record, toll_amount, location)
+    
+    # Repeated reads of the same plate get the original answer back, from
+    # the same ring as the sync view. A claim may wait for the original, so
+    # it runs off the event loop and off the thread the charges run on.
+    read, original = await sync_to_async(recent_reads.claim, thread_sensitive=False)(gate.gate_id, license_plate)
+    if original is not None:
+        data, status_code = original
+        response = JsonResponse(data, status=status_code)
+        response['X-Duplicate-Read'] = 'true'
+        return response
+    try:
+        response = await capture(gate, license_plate, record, toll_amount, location)
+    except Exception:
+        recent_reads.release(read)
+        raise
+    recent_reads.complete(read, (json.loads(response.content), response.status_code))
+    return response
+
+
+async def _queue_capture(gate, license_plate, record, toll_amount, location):
+    capture_id = await sync_to_async(capture_queue.enqueue)(
+        gate.gate_id, license_plate, record, toll_amount, timezone.now()
+    )
+    metrics.captures_queued.inc(gate=gate.gate_id)
+    return JsonResponse(
+        {
+            "message": "Toll capture queued",
+            "capture_id": capture_id,
+            "user_id": str(record.user_id),
+            "amount": float(toll_amount),
+            "location": location
+        },
+        status=202
+    )
+
+
+async def _capture_now(gate, license_plate, record, toll_amount, location):
+    trip, duplicate = await sync_to_async(settle_read)(gate.gate_id, license_plate, record, toll_amount)
+    response = JsonResponse(
+        {
+            "message": "Toll captured successfully",
+            "user_id": str(record.user_id),
+            "amount_charged": float(trip.fare_amount),
+            "location": location,
+            "timestamp": trip.trip_time.isoformat()
+        },
+        status=200
+    )
+    if duplicate:
+        response['X-Duplicate-Read'] = 'true'
+    return response
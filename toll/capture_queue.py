@@ -0,0 +1,135 @@
+"""
+Durable local queue for write-behind captures.
+
+Accepted reads are appended to a SQLite file next to the project database
+(CAPTURE_QUEUE_PATH) before the gate gets its 202, so a crash after the
+acknowledgement never loses a capture. Settlement workers claim entries in
+batches with a lease; entries whose lease runs out (a worker died) are
+handed out again, and settlement itself is idempotent on capture_id.
+Entries that failed to settle are released to be handed out again after
+a delay, so they never hold up the entries queued behind them.
+"""
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from autofare import ids
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    capture_id TEXT PRIMARY KEY,
+    gate_id TEXT NOT NULL,
+    license_plate TEXT NOT NULL,
+    vehicle_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    wallet_id INTEGER,
+    amount TEXT NOT NULL,
+    read_at TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    lease_until REAL,
+    trip_id INTEGER,
+    settled_at TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_status ON captures (status, lease_until);
+"""
+
+COLUMNS = (
+    'capture_id', 'gate_id', 'license_plate', 'vehicle_id', 'user_id', 'wallet_id',
+    'amount', 'read_at', 'status', 'lease_until', 'trip_id', 'settled_at',
+)
+
+
+def write_behind(mode=None):
+    """Whether a capture requested with ?mode=mode is queued; CAPTURE_WRITE_BEHIND picks the default"""
+    default = 'async' if getattr(settings, 'CAPTURE_WRITE_BEHIND', False) else 'sync'
+    return (mode or default) == 'async'
+
+
+class CaptureQueue:
+    """Append-only capture queue stored in a local SQLite file"""
+
+    def __init__(self, path=None):
+        self.path = str(path or getattr(settings, 'CAPTURE_QUEUE_PATH', settings.BASE_DIR / 'capture_queue.sqlite3'))
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, gate_id, license_plate, record, amount, read_at):
+        """Persist an accepted read and return its capture id"""
+        capture_id = str(ids.next_id())
+        self._connection().execute(
+            "INSERT INTO captures (capture_id, gate_id, license_plate, vehicle_id, user_id, wallet_id, amount, read_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (capture_id, gate_id, license_plate, record.vehicle_id, record.user_id,
+             record.wallet_id, str(amount), read_at.isoformat()),
+        )
+        return capture_id
+
+    def claim(self, batch_size=200, lease=60):
+        """Lease up to batch_size queued entries to the calling worker"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM captures "
+                "WHERE status = 'queued' OR (status = 'claimed' AND lease_until < ?) "
+                "ORDER BY rowid LIMIT ?",
+                (now, batch_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE captures SET status = 'claimed', lease_until = ? WHERE capture_id = ?",
+                [(now + lease, row[0]) for row in rows],
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def complete(self, outcomes):
+        """Record final outcomes as (capture_id, status, trip_id, settled_at) tuples"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "UPDATE captures SET status = ?, trip_id = ?, settled_at = ?, lease_until = NULL "
+                "WHERE capture_id = ?",
+                [(status, trip_id, settled_at, capture_id) for capture_id, status, trip_id, settled_at in outcomes],
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release(self, capture_ids, delay=0):
+        """Hand claimed entries out again once delay seconds have passed"""
+        self._connection().executemany(
+            "UPDATE captures SET lease_until = ? WHERE capture_id = ? AND status = 'claimed'",
+            [(time.time() + delay, capture_id) for capture_id in capture_ids],
+        )
+
+    def get(self, capture_id):
+        row = self._connection().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM captures WHERE capture_id = ?", (capture_id,)
+        ).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def pending(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM captures WHERE status IN ('queued', 'claimed')"
+        ).fetchone()[0]
+
+
+capture_queue = CaptureQueue()
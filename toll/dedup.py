@@ -0,0 +1,118 @@
+"""
+Suppression of repeated plate reads at the same gate.
+
+Cameras often report a plate two or three times within a second. Reads of
+the same (gate_id, plate) inside CAPTURE_DEDUP_WINDOW seconds are absorbed:
+the first read is captured normally and the repeats get its result back
+without touching the wallet.
+
+Within a process this is an in-memory ring of time buckets. Across
+processes the guard is Trip.dedup_key, a unique key of gate, plate and
+window bucket, so a repeat handled by another worker fails its insert and
+is answered from the original trip.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+def dedup_key(gate_id, plate, when):
+    """Key shared by every read of a plate at a gate within the same window bucket"""
+    window = getattr(settings, 'CAPTURE_DEDUP_WINDOW', 0)
+    if not window:
+        return None
+    return f"{gate_id}:{plate}:{int(when.timestamp() // window)}"
+
+
+class _Read:
+    __slots__ = ('key', 'at', 'slot', 'result', 'done')
+
+    def __init__(self, key, at, slot):
+        self.key = key
+        self.at = at
+        self.slot = slot
+        self.result = None
+        self.done = threading.Event()
+
+
+class ReadDeduplicator:
+    """Time-bucketed ring of recent (gate_id, plate) reads and their capture results"""
+
+    def __init__(self, window=None, slots=4, wait=2.0):
+        self._window = window
+        self.slots = slots
+        self.wait = wait
+        self._ring = [{} for _ in range(slots)]
+        self._epochs = [None] * slots
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    @property
+    def window(self):
+        if self._window is not None:
+            return self._window
+        return getattr(settings, 'CAPTURE_DEDUP_WINDOW', 0)
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def claim(self, gate_id, plate):
+        """Register a read.
+
+        Returns (read, None) for a new read, which the caller must pass to
+        complete() or release(), or (None, result) with the original result
+        when the read repeats one inside the window.
+        """
+        key = (gate_id, plate)
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                original = self._find(key, now)
+                if original is None:
+                    slot = self._slot(now)
+                    read = _Read(key, now, slot)
+                    self._ring[slot][key] = read
+                    return read, None
+            # Wait for the first read to finish so both answers match
+            if original.done.wait(self.wait) and original.result is not None:
+                with self._lock:
+                    self.suppressed += 1
+                return None, original.result
+            if not original.done.is_set():
+                # The original is taking too long; let this read go through
+                # and rely on the database guard
+                return _Read(key, now, None), None
+
+    def complete(self, read, result):
+        read.result = result
+        read.done.set()
+
+    def release(self, read):
+        """Forget a read whose capture failed, so a retry is processed normally"""
+        if read.slot is not None:
+            with self._lock:
+                if self._ring[read.slot].get(read.key) is read:
+                    del self._ring[read.slot][read.key]
+        read.done.set()
+
+    def _slot(self, now):
+        # With slots - 1 buckets per window every live read is in the ring
+        epoch = int(now // (self.window / (self.slots - 1)))
+        slot = epoch % self.slots
+        if self._epochs[slot] != epoch:
+            self._ring[slot] = {}
+            self._epochs[slot] = epoch
+        return slot
+
+    def _find(self, key, now):
+        self._slot(now)
+        for bucket in self._ring:
+            read = bucket.get(key)
+            if read is not None and now - read.at < self.window:
+                return read
+        return None
+
+
+recent_reads = ReadDeduplicator()
@@ -0,0 +1,89 @@
+"""
+Concurrent-connection throughput of the async (ASGI) endpoints against the
+synchronous DRF (WSGI) endpoints with the same contract.
+
+Usage: python manage.py bench_asgi --requests 1000 --concurrency 32
+
+Both paths run in-process against a throwaway database: the WSGI side
+through django.test.Client on a pool of threads, the ASGI side through
+django.test.AsyncClient with that many requests in flight on one event loop.
+"""
+import asyncio
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+
+from autofare.benchmark import benchmark_database, run_threads, seed_capture_data, summarize
+
+
+class Command(BaseCommand):
+    help = "Compare ASGI and WSGI throughput for capture, wallet and vehicle endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--users', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(CAPTURE_DEDUP_WINDOW=0):
+            data = seed_capture_data(users=options['users'])
+            plates = data['plates']
+            user_ids = data['user_ids']
+            gate = data['gate_id']
+
+            endpoints = [
+                ("capture", 'post',
+                 '/api/capture/{gate}/', '/api/async/capture/{gate}/',
+                 lambda i: {"data": json.dumps({"license_plate": plates[i % len(plates)]}),
+                            "content_type": 'application/json'}),
+                ("wallet", 'get',
+                 '/api/user/wallet', '/api/async/user/wallet',
+                 lambda i: {"data": {"user_id": user_ids[i % len(user_ids)]}}),
+                ("vehicles", 'get',
+                 '/api/user/car', '/api/async/user/car',
+                 lambda i: {"data": {"user_id": user_ids[i % len(user_ids)]}}),
+            ]
+
+            self.stdout.write(f"{'endpoint':<10} {'server':<6} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+            for name, method, sync_url, async_url, kwargs in endpoints:
+                sync_result = self._run_wsgi(method, sync_url.format(gate=gate), kwargs, options)
+                async_result = self._run_asgi(method, async_url.format(gate=gate), kwargs, options)
+                for server, result in (("wsgi", sync_result), ("asgi", async_result)):
+                    self.stdout.write(
+                        f"{name:<10} {server:<6} {result['throughput']:>10.1f} "
+                        f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}"
+                    )
+
+    def _run_wsgi(self, method, url, kwargs, options):
+        local = threading.local()
+
+        def call(index):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client()
+            response = getattr(client, method)(url, **kwargs(index))
+            assert response.status_code < 400, response.content
+
+        return summarize(*run_threads(call, options['requests'], options['concurrency']))
+
+    def _run_asgi(self, method, url, kwargs, options):
+        async def main():
+            client = AsyncClient()
+            limit = asyncio.Semaphore(options['concurrency'])
+            latencies = []
+
+            async def call(index):
+                async with limit:
+                    started = time.perf_counter()
+                    response = await getattr(client, method)(url, **kwargs(index))
+                    latencies.append(time.perf_counter() - started)
+                    assert response.status_code < 400, response.content
+
+            started = time.perf_counter()
+            await asyncio.gather(*(call(i) for i in range(options['requests'])))
+            return latencies, time.perf_counter() - started
+
+        return summarize(*asyncio.run(main()))
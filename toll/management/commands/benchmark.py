@@ -0,0 +1,185 @@
+"""
+Latency and throughput benchmark for the toll capture hot path.
+
+Usage:
+    python manage.py benchmark
+    python manage.py benchmark --users 100000 --vehicles 2000000 --gates 5000
+    python manage.py benchmark --baseline benchmarks/baseline.json
+    python manage.py benchmark --save-baseline benchmarks/baseline.json
+
+Seeds a scaled dataset into a throwaway database and drives the capture,
+wallet top-up, wallet and vehicle list endpoints two ways:
+
+* client: sequentially through django.test.Client, counting SQL queries per request
+* http:   through concurrent HTTP workers against a live server on the same database
+
+For every endpoint it reports p50/p95/p99 latency, throughput and queries
+per request. With --baseline the run fails when an endpoint issues more
+queries than the committed baseline, its p95 latency is higher by more
+than --latency-tolerance, or its throughput is lower by more than
+--throughput-tolerance. p95 is a tail figure and noisier between runs,
+so it gets the wider default.
+"""
+import json
+import time
+import urllib.request
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.testcases import LiveServerThread, _StaticFilesHandler
+from django.test.utils import CaptureQueriesContext
+
+from autofare.benchmark import benchmark_database, run_threads, seed_scaled_dataset, summarize
+from toll.tariffs import get_tariffs
+from vehicles.plate_filter import plate_filter
+
+
+# Relative regressions that fail a --baseline run
+LATENCY_TOLERANCE = 0.5
+THROUGHPUT_TOLERANCE = 0.2
+
+
+class Command(BaseCommand):
+    help = "Benchmark capture, top-up, wallet and vehicle endpoints and compare against a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--vehicles', type=int, default=20000)
+        parser.add_argument('--gates', type=int, default=1000)
+        parser.add_argument('--requests', type=int, default=500, help="Requests per endpoint and mode")
+        parser.add_argument('--concurrency', type=int, default=16, help="HTTP workers")
+        parser.add_argument('--mode', choices=['client', 'http', 'both'], default='both')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', help="Fail if results regress against this JSON file")
+        parser.add_argument('--save-baseline', help="Write the results to this JSON file")
+        parser.add_argument('--latency-tolerance', type=float, default=LATENCY_TOLERANCE,
+                            help="Allowed relative increase of p95 latency")
+        parser.add_argument('--throughput-tolerance', type=float, default=THROUGHPUT_TOLERANCE,
+                            help="Allowed relative decrease of throughput")
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(CAPTURE_DEDUP_WINDOW=0, ALLOWED_HOSTS=['*']):
+            started = time.perf_counter()
+            sample = seed_scaled_dataset(options['users'], options['vehicles'], options['gates'], seed=options['seed'])
+            self.stdout.write(
+                f"Seeded {options['users']} users, {options['vehicles']} vehicles and "
+                f"{options['gates']} gates in {time.perf_counter() - started:.1f}s"
+            )
+
+            # Built once per process, not per request: keep it out of the measurements
+            plate_filter.reset()
+            plate_filter.refresh()
+            get_tariffs()
+
+            endpoints = self._endpoints(sample)
+            results = {}
+            if options['mode'] in ('client', 'both'):
+                for name, request in endpoints.items():
+                    results[f"client:{name}"] = self._run_client(request, options['requests'])
+            if options['mode'] in ('http', 'both'):
+                server = self._start_server()
+                try:
+                    base_url = f"http://{server.host}:{server.port}"
+                    for name, request in endpoints.items():
+                        results[f"http:{name}"] = self._run_http(base_url, request, options)
+                finally:
+                    server.terminate()
+
+        self._report(results)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as handle:
+                json.dump(results, handle, indent=2, sort_keys=True)
+                handle.write('\n')
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+        if options['baseline']:
+            self._compare(
+                results, options['baseline'], options['latency_tolerance'], options['throughput_tolerance']
+            )
+
+    def _endpoints(self, sample):
+        plates, user_ids, gate_ids = sample['plates'], sample['user_ids'], sample['gate_ids']
+
+        def pick(values, index):
+            return values[index % len(values)]
+
+        return {
+            "capture": lambda i: ('POST', f"/api/capture/{pick(gate_ids, i)}/", None,
+                                  {"license_plate": pick(plates, i * 7919)}),
+            "top_up": lambda i: ('POST', "/api/user/wallet", None,
+                                 {"user_id": pick(user_ids, i), "amount": "10.00"}),
+            "wallet": lambda i: ('GET', "/api/user/wallet", {"user_id": pick(user_ids, i)}, None),
+            "vehicles": lambda i: ('GET', "/api/user/car", {"user_id": pick(user_ids, i)}, None),
+        }
+
+    def _run_client(self, request, count):
+        client = Client()
+        latencies = []
+        queries = 0
+        total_started = time.perf_counter()
+        for i in range(count):
+            method, path, params, body = request(i)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                if method == 'GET':
+                    response = client.get(path, params)
+                else:
+                    response = client.post(path, json.dumps(body), content_type='application/json')
+                latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                raise CommandError(f"{method} {path} returned {response.status_code}: {response.content[:200]}")
+            queries += len(captured)
+        result = summarize(latencies, time.perf_counter() - total_started)
+        result["queries_per_request"] = round(queries / count, 2)
+        return result
+
+    def _start_server(self):
+        server = LiveServerThread('localhost', _StaticFilesHandler)
+        server.daemon = True
+        server.start()
+        server.is_ready.wait()
+        if server.error:
+            raise server.error
+        return server
+
+    def _run_http(self, base_url, request, options):
+        def call(index):
+            method, path, params, body = request(index)
+            url = base_url + path + (f"?{urlencode(params)}" if params else '')
+            data = json.dumps(body).encode() if body is not None else None
+            req = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(req, timeout=30) as response:
+                response.read()
+
+        return summarize(*run_threads(call, options['requests'], options['concurrency']))
+
+    def _report(self, results):
+        self.stdout.write(
+            f"{'endpoint':<16} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<16} {result['throughput']:>9.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                f"{result['p99_ms']:>9.2f} {result.get('queries_per_request', '-'):>8}"
+            )
+
+    def _compare(self, results, path, latency_tolerance=LATENCY_TOLERANCE, throughput_tolerance=THROUGHPUT_TOLERANCE):
+        with open(path) as handle:
+            baseline = json.load(handle)
+        failures = []
+        for name, expected in baseline.items():
+            actual = results.get(name)
+            if actual is None:
+                continue
+            if 'queries_per_request' in expected and actual['queries_per_request'] > expected['queries_per_request']:
+                failures.append(
+                    f"{name}: {actual['queries_per_request']} queries per request (baseline {expected['queries_per_request']})"
+                )
+            if actual['p95_ms'] > expected['p95_ms'] * (1 + latency_tolerance):
+                failures.append(f"{name}: p95 {actual['p95_ms']}ms (baseline {expected['p95_ms']}ms)")
+            if actual['throughput'] < expected['throughput'] * (1 - throughput_tolerance):
+                failures.append(f"{name}: {actual['throughput']} req/s (baseline {expected['throughput']} req/s)")
+        if failures:
+            raise CommandError("Performance regressed:\n  " + "\n  ".join(failures))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}"))
@@ -0,0 +1,45 @@
+"""
+Generate a large synthetic dataset for scale testing.
+
+Usage:
+    python manage.py generate_dataset --users 100000 --vehicles 250000 --gates 2000 --trips 5000000
+    python manage.py generate_dataset --seed 42 --skew 4 --days 365
+
+See autofare/datagen.py for the distributions used.
+"""
+from django.core.management.base import BaseCommand
+
+from autofare.datagen import DatasetGenerator
+
+
+class Command(BaseCommand):
+    help = "Bulk-generate users, wallets, vehicles, gates, tolls, trips, transactions and violations"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--vehicles', type=int, default=2000)
+        parser.add_argument('--gates', type=int, default=50)
+        parser.add_argument('--trips', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--days', type=int, default=90, help="Days of trip history")
+        parser.add_argument('--skew', type=float, default=3.0,
+                            help="How strongly fleets, vehicles and gates are concentrated (1 = uniform)")
+        parser.add_argument('--unpaid-rate', type=float, default=0.08)
+        parser.add_argument('--chunk-size', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        generator = DatasetGenerator(
+            users=options['users'],
+            vehicles=options['vehicles'],
+            gates=options['gates'],
+            trips=options['trips'],
+            seed=options['seed'],
+            days=options['days'],
+            skew=options['skew'],
+            unpaid_rate=options['unpaid_rate'],
+            chunk_size=options['chunk_size'],
+            log=self.stdout.write,
+        )
+        counts = generator.run()
+        for label, count in sorted(counts.items()):
+            self.stdout.write(f"{label:<28} {count:>12}")
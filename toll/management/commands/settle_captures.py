@@ -0,0 +1,76 @@
+"""
+Settlement worker pool for write-behind captures.
+
+A worker that fails (the database is unreachable, the queue is locked)
+logs the error and tries again after a back-off that doubles up to
+--max-backoff seconds; captures it had claimed are handed out again when
+their lease runs out.
+
+Usage: python manage.py settle_captures --workers 4 --batch-size 200
+       python manage.py settle_captures --once
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from toll.capture_queue import capture_queue
+from toll.settlement import drain, logger
+
+
+class Command(BaseCommand):
+    help = "Drain the write-behind capture queue into trips, wallet debits and transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--idle-sleep', type=float, default=0.2, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--max-backoff', type=float, default=30.0,
+                            help="Longest wait in seconds after repeated worker errors")
+        parser.add_argument('--once', action='store_true', help="Exit as soon as the queue is empty")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        settled = [0] * options['workers']
+
+        def worker(index):
+            errors = 0
+            try:
+                while not stop.is_set():
+                    try:
+                        count = drain(options['batch_size'], queue=capture_queue)
+                    except Exception:
+                        errors += 1
+                        backoff = min(options['idle_sleep'] * 2 ** errors, options['max_backoff'])
+                        logger.exception("Settlement worker %d failed, retrying in %.1fs", index, backoff)
+                        # A broken connection is reopened on the next query
+                        connection.close_if_unusable_or_obsolete()
+                        stop.wait(backoff)
+                        continue
+                    errors = 0
+                    settled[index] += count
+                    if not count:
+                        if options['once']:
+                            return
+                        stop.wait(options['idle_sleep'])
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(options['workers'])]
+        for thread in pool:
+            thread.start()
+        try:
+            for thread in pool:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in pool:
+                thread.join()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Settled {sum(settled)} captures in {elapsed:.2f}s, {capture_queue.pending()} still pending"
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('toll', '0002_alter_trip_vehicle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='capture_id',
+            field=models.CharField(blank=True, max_length=32, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('toll', '0003_trip_capture_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('toll', '0004_trip_dedup_key'),
+        ('vehicles', '0004_vehicle_normalized_plate'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'trip_time'], name='trip_status_time_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:46
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_created_at(apps, schema_editor):
+    # The write time of existing trips is unknown; their read time is close
+    Trip = apps.get_model('toll', 'Trip')
+    Trip.objects.update(created_at=F('trip_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('toll', '0005_trip_trip_status_time_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='trip',
+            name='trip_status_time_idx',
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_created_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'created_at'], name='trip_status_created_idx'),
+        ),
+    ]
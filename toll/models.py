@@ -11,6 +11,22 @@ class Gate(models.Model):
     gate_location = models.CharField(max_length=255)
     tolls = models.ManyToManyField(Toll, related_name='gates') # "belongs" relationship
 
+
+class TariffVersion(models.Model):
+    """Single row counting Gate/Toll changes; processes rebuild their tariff matrix when it moves"""
+    version = models.PositiveBigIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+BASE_FARES = {  # search for real numbers later
+    'car': 10.00,
+    'truck': 20.00,
+    'motorcycle': 3.00,
+    'bus': 8.00,
+    'minibus': 6.00,
+    'van': 7.00,
+}
+
+
 class Trip(models.Model):
     trip_id = models.AutoField(primary_key=True)
     vehicle = models.ForeignKey('vehicles.Vehicle', on_delete=models.CASCADE)
@@ -18,17 +34,19 @@ class Trip(models.Model):
     trip_time = models.DateTimeField(auto_now_add=True)
     fare_amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, default='Pending') # Paid, Unpaid
+    capture_id = models.CharField(max_length=32, unique=True, null=True, blank=True) # Write-behind captures only
+    dedup_key = models.CharField(max_length=100, unique=True, null=True, blank=True) # Gate, plate and read window
+    # When the row was written. trip_time is the gate's read time, which can be much earlier.
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Unpaid trips written since the reconciliation watermark (violations/reconciliation.py)
+            models.Index(fields=['status', 'created_at'], name='trip_status_created_idx'),
+        ]
 
     def calculate_fare(self):
-        base_fares = {  # search for real numbers later
-            'car': 10.00,
-            'truck': 20.00,
-            'motorcycle': 3.00,
-            'bus': 8.00,
-            'minibus': 6.00,
-            'van': 7.00,
-        }
-        return base_fares.get(self.vehicle.vehicle_type, 5.00)  # Default to car fare
+        return BASE_FARES.get(self.vehicle.vehicle_type, 5.00)  # Default to car fare
 
     def save(self, *args, **kwargs):
         if not self.fare_amount:  # Only calculate if not set
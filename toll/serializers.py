@@ -1,17 +1,30 @@
 from rest_framework import serializers
 from .models import Trip, Gate
-from vehicles.models import Vehicle
+from vehicles.resolver import plate_resolver
 
 
 class TollCaptureSerializer(serializers.Serializer):
     license_plate = serializers.CharField(max_length=20)
     
-    def validate_license_plate(self, value):
-        try:
-            Vehicle.objects.get(license_plate=value)
-        except Vehicle.DoesNotExist:
-            raise serializers.ValidationError("Vehicle with this license plate not found.")
-        return value
+    def validate(self, data):
+        """Resolve the plate once and hand the cached record to the view"""
+        record = plate_resolver.resolve(data['license_plate'])
+        if record is None:
+            raise serializers.ValidationError(
+                {"license_plate": ["Vehicle with this license plate not found."]}
+            )
+        data['plate_record'] = record
+        return data
+
+
+class TollReadSerializer(serializers.Serializer):
+    license_plate = serializers.CharField(max_length=20)
+    timestamp = serializers.DateTimeField(required=False)
+
+
+class TollBatchCaptureSerializer(serializers.Serializer):
+    """Serializer for a batch of plate reads buffered by a gate controller"""
+    reads = TollReadSerializer(many=True, allow_empty=False, max_length=500)
 
 
 class TripSerializer(serializers.ModelSerializer):
@@ -0,0 +1,215 @@
+"""
+Settlement of captures: single reads paid on the spot, and write-behind
+reads queued by capture_vehicle.
+
+A queued batch is settled in one database transaction: each read is debited through
+the wallet ledger, and Trip/Transaction rows are written with bulk inserts.
+Trips carry the capture id, so a batch that was settled but not marked
+complete in the queue (a worker crashed in between) is recognised on retry
+and never charged twice. Repeated reads inside the dedup window are
+answered from the original trip.
+
+A batch that fails (another worker wrote a trip with the same dedup key
+after the batch looked, or one bad entry) is settled again one entry at a
+time, which answers the race from the other worker's trip. Entries that
+still fail are logged and released to be retried after
+CAPTURE_RETRY_DELAY seconds.
+"""
+import logging
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from autofare import ids, metrics
+from users import allowances, ledger
+from users.models import Transaction
+from .capture_queue import capture_queue
+from .dedup import dedup_key
+from .models import Trip
+
+
+logger = logging.getLogger('autofare.settlement')
+
+def capture_outcome(trip, wallet_id):
+    """paid, unpaid (short of funds) or no_wallet, as counted by metrics.captures"""
+    if wallet_id is None:
+        return 'no_wallet'
+    return trip.status
+
+
+def settle_read(gate_id, license_plate, record, toll_amount):
+    """Charge one read and record its trip.
+
+    Returns (trip, duplicate); duplicate is True when another worker already
+    captured the same read and its trip is returned instead.
+    """
+    key = dedup_key(gate_id, license_plate, timezone.now())
+    # Busy wallets at this gate are paid from an allowance held in memory
+    allowance_id = None
+    if allowances.enabled() and record.wallet_id is not None:
+        allowance_id = allowances.book.reserve(record.wallet_id, gate_id, toll_amount)
+    committed = False
+    try:
+        with transaction.atomic():
+            # Create trip record
+            trip = Trip(
+                vehicle_id=record.vehicle_id,
+                gate_id=gate_id,
+                fare_amount=toll_amount,
+                status='unpaid',
+                dedup_key=key
+            )
+            
+            # Process payment with a single conditional debit
+            with metrics.capture_phase.time(phase='debit'):
+                if allowance_id is not None:
+                    paid = True
+                else:
+                    paid = record.wallet_id is not None and ledger.debit(record.wallet_id, toll_amount) is not None
+            
+            with metrics.capture_phase.time(phase='record'):
+                if paid:
+                    trip.status = 'paid'
+                    
+                    # Create transaction record
+                    if allowance_id is not None:
+                        allowances.record_charge(allowance_id, record.wallet_id, toll_amount)
+                    else:
+                        Transaction.objects.create(
+                            wallet_id=record.wallet_id,
+                            transaction_id=ids.transaction_id(),
+                            transaction_type="toll-charge",
+                            amount=toll_amount
+                        )
+                
+                trip.save()
+        committed = True
+    except IntegrityError:
+        # Another worker already captured this read; the debit was rolled back
+        trip = Trip.objects.filter(dedup_key=key).first() if key else None
+        if trip is None:
+            raise
+        metrics.captures.inc(gate=gate_id, outcome='duplicate')
+        return trip, True
+    finally:
+        if not committed and allowance_id is not None:
+            # Nothing was charged, so the allowance still holds the amount
+            allowances.book.refund(record.wallet_id, gate_id, allowance_id, toll_amount)
+    metrics.captures.inc(gate=gate_id, outcome=capture_outcome(trip, record.wallet_id))
+    return trip, False
+
+
+def settle_batch(entries):
+    """Settle claimed queue entries and return (capture_id, status, trip_id, settled_at) outcomes"""
+    settled = {
+        capture_id: (trip_id, trip_status)
+        for capture_id, trip_id, trip_status in Trip.objects.filter(
+            capture_id__in=[entry['capture_id'] for entry in entries]
+        ).values_list('capture_id', 'trip_id', 'status')
+    }
+    pending = [entry for entry in entries if entry['capture_id'] not in settled]
+    keys = {
+        entry['capture_id']: dedup_key(entry['gate_id'], entry['license_plate'], datetime.fromisoformat(entry['read_at']))
+        for entry in pending
+    }
+    # Repeated reads that reached the queue share the original trip
+    captured = {
+        key: (trip_id, trip_status)
+        for key, trip_id, trip_status in Trip.objects.filter(
+            dedup_key__in=[key for key in keys.values() if key]
+        ).values_list('dedup_key', 'trip_id', 'status')
+    }
+    duplicates = {}
+
+    with transaction.atomic():
+        trips = []
+        transactions = []
+        written = []
+        for entry in pending:
+            key = keys[entry['capture_id']]
+            if key in captured:
+                duplicates[entry['capture_id']] = key
+                continue
+            amount = Decimal(entry['amount'])
+            trip = Trip(
+                vehicle_id=entry['vehicle_id'],
+                gate_id=entry['gate_id'],
+                fare_amount=amount,
+                status='unpaid',
+                capture_id=entry['capture_id'],
+                dedup_key=key
+            )
+            if key:
+                captured[key] = trip
+            if entry['wallet_id'] is not None and ledger.debit(entry['wallet_id'], amount) is not None:
+                trip.status = 'paid'
+                transactions.append(Transaction(
+                    wallet_id=entry['wallet_id'],
+                    transaction_type="toll-charge",
+                    amount=amount
+                ))
+            trips.append(trip)
+            written.append(entry)
+
+        Trip.objects.bulk_create(trips)
+        # trip_time is auto_now_add, so the time the gate read the plate is applied afterwards
+        for trip, entry in zip(trips, written):
+            trip.trip_time = datetime.fromisoformat(entry['read_at'])
+        if trips:
+            Trip.objects.bulk_update(trips, ['trip_time'])
+        if transactions:
+            for txn, transaction_id in zip(transactions, ids.transaction_ids(len(transactions))):
+                txn.transaction_id = transaction_id
+            Transaction.objects.bulk_create(transactions)
+
+    for trip, entry in zip(trips, written):
+        settled[trip.capture_id] = (trip.trip_id, trip.status)
+        metrics.captures.inc(gate=entry['gate_id'], outcome=capture_outcome(trip, entry['wallet_id']))
+    for capture_id, key in duplicates.items():
+        original = captured[key]
+        settled[capture_id] = (original.trip_id, original.status) if isinstance(original, Trip) else original
+    for entry in pending:
+        if entry['capture_id'] in duplicates:
+            metrics.captures.inc(gate=entry['gate_id'], outcome='duplicate')
+    settled_at = timezone.now().isoformat()
+    return [
+        (entry['capture_id'], settled[entry['capture_id']][1], settled[entry['capture_id']][0], settled_at)
+        for entry in entries
+    ]
+
+
+def settle_each(entries, queue=capture_queue):
+    """Settle entries one at a time, releasing those that fail. Returns the outcomes of the others."""
+    outcomes = []
+    failed = []
+    error = None
+    for entry in entries:
+        try:
+            outcomes.extend(settle_batch([entry]))
+        except Exception as exc:
+            logger.error("Capture %s failed to settle: %r", entry['capture_id'], exc)
+            failed.append(entry['capture_id'])
+            error = exc
+    if failed:
+        queue.release(failed, settings.CAPTURE_RETRY_DELAY)
+    if not outcomes and error is not None:
+        # Nothing settles: let the worker back off
+        raise error
+    return outcomes
+
+
+def drain(batch_size=200, queue=capture_queue):
+    """Claim, settle and complete one batch. Returns how many entries were settled."""
+    entries = queue.claim(batch_size)
+    if not entries:
+        return 0
+    try:
+        outcomes = settle_batch(entries)
+    except Exception:
+        logger.warning("Batch of %d captures failed to settle, retrying one at a time", len(entries), exc_info=True)
+        outcomes = settle_each(entries, queue)
+    queue.complete(outcomes)
+    return len(outcomes)
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import Gate, Toll
+from .tariffs import bump_version
+
+
+@receiver([post_save, post_delete], sender=Gate)
+@receiver([post_save, post_delete], sender=Toll)
+def invalidate_tariffs(sender, **kwargs):
+    bump_version()
+
+
+@receiver(m2m_changed, sender=Gate.tolls.through)
+def invalidate_tariff_links(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version()
@@ -0,0 +1,133 @@
+"""
+In-memory gate tariff matrix for the capture path.
+
+All Gate/Toll data is compiled into a matrix keyed by (gate_id, vehicle_type)
+so pricing a capture needs no database access. The matrix carries a version
+stamp read from the TariffVersion row; signals in toll/signals.py bump the
+row in the same transaction that changes gates, tolls or their links, and
+the next lookup rebuilds the matrix.
+
+Each process reads the row at most every TARIFF_REFRESH_INTERVAL seconds,
+so a change made by another process is priced within that interval. A
+change made by this process is read on its next lookup, and again once it
+commits. The stamp includes the row's updated_at, so a matrix built from
+a bump that was rolled back never matches a later bump.
+"""
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from vehicles.models import Vehicle
+from .models import Gate, TariffVersion
+
+
+DEFAULT_TOLL_AMOUNT = Decimal('5.50')
+VERSION_ROW = 1
+
+GateTariff = namedtuple('GateTariff', ['gate_id', 'gate_name', 'gate_location', 'amounts'])
+
+
+class TariffMatrix:
+    """Toll amounts for every (gate_id, vehicle_type) pair"""
+
+    def __init__(self, gates, version):
+        self.gates = gates
+        self.version = version
+
+    @classmethod
+    def build(cls, version=None):
+        """Compile all gates and tolls with two queries"""
+        vehicle_types = [value for value, _ in Vehicle.VEHICLE_TYPES]
+        # A gate charges its first toll (lowest toll_id) for every vehicle type,
+        # matching what gate.tolls.first() returned before
+        first_toll = {}
+        links = Gate.tolls.through.objects.order_by('toll_id').values_list('gate_id', 'toll__amount')
+        for gate_id, amount in links:
+            first_toll.setdefault(gate_id, amount)
+
+        gates = {}
+        for gate_id, gate_name, gate_location in Gate.objects.values_list('gate_id', 'gate_name', 'gate_location'):
+            amount = first_toll.get(gate_id, DEFAULT_TOLL_AMOUNT)
+            gates[gate_id] = GateTariff(
+                gate_id, gate_name, gate_location,
+                {vehicle_type: amount for vehicle_type in vehicle_types}
+            )
+        return cls(gates, version)
+
+    def get_gate(self, gate_id):
+        return self.gates.get(gate_id)
+
+    def price(self, gate_id, vehicle_type):
+        """Return the toll for a vehicle type at a gate, or None for an unknown gate"""
+        gate = self.gates.get(gate_id)
+        if gate is None:
+            return None
+        return gate.amounts.get(vehicle_type, DEFAULT_TOLL_AMOUNT)
+
+    def price_many(self, reads):
+        """Price an iterable of (gate_id, vehicle_type) pairs in one pass"""
+        return [self.price(gate_id, vehicle_type) for gate_id, vehicle_type in reads]
+
+
+_matrix = None
+_lock = threading.Lock()
+# (version stamp, monotonic time it must be read again)
+_known = None
+
+
+def current_version():
+    """The tariff version stamp, read from the database at most every TARIFF_REFRESH_INTERVAL seconds"""
+    global _known
+    known = _known
+    now = time.monotonic()
+    if known is not None and now < known[1]:
+        return known[0]
+    version = TariffVersion.objects.filter(pk=VERSION_ROW).values_list('version', 'updated_at').first()
+    _known = (version, now + settings.TARIFF_REFRESH_INTERVAL)
+    return version
+
+
+def expire_version():
+    """Read the version stamp again on the next lookup"""
+    global _known
+    _known = None
+
+
+def bump_version():
+    """Mark the tariff data as changed so every process rebuilds its matrix"""
+    bumped = TariffVersion.objects.filter(pk=VERSION_ROW).update(
+        version=F('version') + 1, updated_at=timezone.now()
+    )
+    if not bumped:
+        TariffVersion.objects.get_or_create(pk=VERSION_ROW, defaults={'version': 2})
+    # This thread sees the bump now; other threads once it commits
+    expire_version()
+    transaction.on_commit(expire_version)
+
+
+def get_tariffs():
+    """Return the current tariff matrix, rebuilding it if the version stamp moved"""
+    global _matrix
+    version = current_version()
+    matrix = _matrix
+    if matrix is not None and matrix.version == version:
+        return matrix
+    with _lock:
+        if _matrix is None or _matrix.version != version:
+            _matrix = TariffMatrix.build(version)
+        return _matrix
+
+
+async def aget_tariffs():
+    """Async get_tariffs(); only a rebuild leaves the event loop"""
+    matrix, known = _matrix, _known
+    if matrix is not None and known is not None and time.monotonic() < known[1] and matrix.version == known[0]:
+        return matrix
+    return await sync_to_async(get_tariffs)()
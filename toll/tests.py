@@ -1,4 +1,726 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Max
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from autofare import metrics
+from autofare.benchmark import percentile, run_threads, summarize
+from autofare.datagen import DatasetGenerator
+from autofare.middleware import route_metrics
+from users import allowances, checkpoints, shards
+from users.models import Transaction, Wallet
+from violations.models import Violation
+from vehicles.models import Vehicle
+from vehicles.resolver import plate_resolver
+from . import settlement, tariffs
+from .management.commands.benchmark import (
+    Command as BenchmarkCommand, LATENCY_TOLERANCE, THROUGHPUT_TOLERANCE
+)
+from .capture_queue import CaptureQueue
+from .dedup import ReadDeduplicator, dedup_key
+from .models import Gate, TariffVersion, Toll, Trip
+from .tariffs import VERSION_ROW, aget_tariffs, get_tariffs
+
+
+def other_process_sets_toll(toll_id, amount):
+    """Change a toll as another process would: this one gets no signal"""
+    Toll.objects.filter(toll_id=toll_id).update(amount=amount)
+    TariffVersion.objects.filter(pk=VERSION_ROW).update(version=F('version') + 1)
+
+
+def interval_passes():
+    version, _ = tariffs._known
+    tariffs._known = (version, time.monotonic())
+
+
+@override_settings(TARIFF_REFRESH_INTERVAL=60)
+class TariffMatrixTests(TestCase):
+    """Every process prices captures with the current tolls, whichever process changed them"""
+
+    def setUp(self):
+        tariffs._matrix = None
+        tariffs.expire_version()
+        self.addCleanup(tariffs.expire_version)
+        self.toll = Toll.objects.create(toll_id='T1', amount=Decimal('7.00'))
+        self.gate = Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+        self.gate.tolls.add(self.toll)
+
+    def price(self):
+        return get_tariffs().price('G1', 'car')
+
+    def test_lookups_within_the_interval_need_no_query(self):
+        self.price()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.price(), Decimal('7.00'))
+
+    def test_change_in_this_process_is_priced_at_once(self):
+        self.price()
+        self.toll.amount = Decimal('9.00')
+        self.toll.save()
+        self.assertEqual(self.price(), Decimal('9.00'))
+
+    def test_gate_added_in_this_process_is_priced_at_once(self):
+        self.price()
+        Gate.objects.create(gate_id='G2', gate_name='South', gate_location='Bypass')
+        self.assertEqual(get_tariffs().price('G2', 'car'), tariffs.DEFAULT_TOLL_AMOUNT)
+
+    def test_change_in_another_process_is_priced_after_the_interval(self):
+        self.price()
+        other_process_sets_toll('T1', Decimal('9.00'))
+        self.assertEqual(self.price(), Decimal('7.00'))
+        interval_passes()
+        self.assertEqual(self.price(), Decimal('9.00'))
+
+    def test_matrix_of_a_rolled_back_change_is_not_reused(self):
+        self.price()
+        try:
+            with transaction.atomic():
+                self.toll.amount = Decimal('1.00')
+                self.toll.save()
+                self.assertEqual(self.price(), Decimal('1.00'))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        # Another process bumps the counter to the value the rolled-back change had
+        other_process_sets_toll('T1', Decimal('9.00'))
+        interval_passes()
+        self.assertEqual(self.price(), Decimal('9.00'))
+
+    async def test_async_lookup_follows_other_processes(self):
+        self.assertEqual((await aget_tariffs()).price('G1', 'car'), Decimal('7.00'))
+        matrix = await aget_tariffs()
+        self.assertIs(await aget_tariffs(), matrix)
+        await Toll.objects.filter(toll_id='T1').aupdate(amount=Decimal('9.00'))
+        await TariffVersion.objects.filter(pk=VERSION_ROW).aupdate(version=F('version') + 1)
+        interval_passes()
+        self.assertEqual((await aget_tariffs()).price('G1', 'car'), Decimal('9.00'))
+
+
+class QueuedCaptures:
+    """A private capture queue and two owners, one who can pay and one who cannot"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = CaptureQueue(os.path.join(directory.name, 'captures.sqlite3'))
+        self.gate = Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+        self.records = {}
+        for plate, balance in (('PAY-100', '50.00'), ('DRY-200', '0.00')):
+            user = User.objects.create_user(username=f'{plate}@example.com')
+            wallet = Wallet.objects.create(user=user, wallet_balance=Decimal(balance))
+            vehicle = Vehicle.objects.create(user=user, license_plate=plate, vehicle_type='car', vechile_model='Golf')
+            self.records[plate] = SimpleNamespace(vehicle_id=vehicle.pk, user_id=user.pk, wallet_id=wallet.pk)
+
+    def enqueue(self, plate):
+        return self.queue.enqueue('G1', plate, self.records[plate], Decimal('10.00'), timezone.now())
+
+
+@override_settings(CAPTURE_DEDUP_WINDOW=2, CAPTURE_RETRY_DELAY=30)
+class SettlementTests(QueuedCaptures, TestCase):
+    """Write-behind captures are settled exactly once, and a failure never loses or blocks them"""
+
+    def test_drain_settles_paid_and_unpaid_reads(self):
+        paid, unpaid = self.enqueue('PAY-100'), self.enqueue('DRY-200')
+        self.assertEqual(settlement.drain(queue=self.queue), 2)
+        self.assertEqual(self.queue.get(paid)['status'], 'paid')
+        self.assertEqual(self.queue.get(unpaid)['status'], 'unpaid')
+        self.assertEqual(Wallet.objects.get(pk=self.records['PAY-100'].wallet_id).wallet_balance, Decimal('40.00'))
+        self.assertEqual(self.queue.pending(), 0)
+
+    @override_settings(ALLOWED_HOSTS=['*'], CAPTURE_DEDUP_WINDOW=0)
+    def test_queued_capture_is_acknowledged_then_settled(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        client = APIClient()
+        with mock.patch('toll.views.capture_queue', self.queue):
+            response = client.post('/api/capture/G1/?mode=async', {"license_plate": 'PAY-100'}, format='json')
+            self.assertEqual(response.status_code, 202)
+            status_url = f"/api/capture/status/{response.data['capture_id']}/"
+            self.assertEqual(client.get(status_url).data['status'], 'pending')
+            self.assertFalse(Trip.objects.exists())
+
+            settlement.drain(queue=self.queue)
+            settled = client.get(status_url).data
+        self.assertEqual(settled['status'], 'paid')
+        self.assertEqual(settled['trip_id'], Trip.objects.get().trip_id)
+        self.assertEqual(Wallet.objects.get(pk=self.records['PAY-100'].wallet_id).wallet_balance, Decimal('44.50'))
+
+    @override_settings(SPENDING_ALLOWANCES=True)
+    def test_failed_charge_gives_back_the_allowance(self):
+        record = self.records['PAY-100']
+        book = allowances.AllowanceBook(amount='20.00', ttl=300, hot_captures=1)
+        with mock.patch.object(allowances, 'book', book), \
+                mock.patch.object(allowances, 'record_charge', side_effect=RuntimeError("database went away")):
+            with self.assertRaises(RuntimeError):
+                settlement.settle_read('G1', 'PAY-100', record, Decimal('5.00'))
+        self.assertEqual(book.remaining(record.wallet_id, 'G1'), Decimal('20.00'))
+        self.assertFalse(Trip.objects.exists())
+
+    def test_batch_settled_again_is_charged_once(self):
+        self.enqueue('PAY-100')
+        entries = self.queue.claim()
+        first = settlement.settle_batch(entries)
+        # The worker died before completing the batch in the queue; another settles it again
+        again = settlement.settle_batch(entries)
+        self.assertEqual([outcome[:3] for outcome in again], [outcome[:3] for outcome in first])
+        self.assertEqual(Trip.objects.count(), 1)
+        self.assertEqual(Wallet.objects.get(pk=self.records['PAY-100'].wallet_id).wallet_balance, Decimal('40.00'))
+
+    def test_dedup_race_is_answered_from_the_other_workers_trip(self):
+        capture_id = self.enqueue('PAY-100')
+        settle_batch = settlement.settle_batch
+
+        def race(entries):
+            # Another worker writes the same read after this batch looked for it
+            entry = entries[0]
+            self.other = Trip.objects.create(
+                vehicle_id=entry['vehicle_id'], gate=self.gate, fare_amount=10, status='paid',
+                dedup_key=dedup_key('G1', 'PAY-100', datetime.fromisoformat(entry['read_at']))
+            )
+            raise IntegrityError('UNIQUE constraint failed: toll_trip.dedup_key')
+
+        calls = iter([race, settle_batch])
+        with mock.patch.object(settlement, 'settle_batch', side_effect=lambda entries: next(calls)(entries)):
+            with self.assertLogs('autofare.settlement', 'WARNING'):
+                self.assertEqual(settlement.drain(queue=self.queue), 1)
+        entry = self.queue.get(capture_id)
+        self.assertEqual((entry['status'], entry['trip_id']), ('paid', self.other.pk))
+        self.assertEqual(Trip.objects.count(), 1)
+        # The race cost nothing
+        self.assertEqual(Wallet.objects.get(pk=self.records['PAY-100'].wallet_id).wallet_balance, Decimal('50.00'))
+
+    def test_failing_capture_is_released_and_the_rest_settle(self):
+        broken, fine = self.enqueue('PAY-100'), self.enqueue('DRY-200')
+        settle_batch = settlement.settle_batch
+
+        def settle(entries):
+            if any(entry['capture_id'] == broken for entry in entries):
+                raise ValueError('bad entry')
+            return settle_batch(entries)
+
+        with mock.patch.object(settlement, 'settle_batch', side_effect=settle):
+            with self.assertLogs('autofare.settlement', 'WARNING') as logs:
+                self.assertEqual(settlement.drain(queue=self.queue), 1)
+        self.assertIn(f"Capture {broken} failed to settle", '\n'.join(logs.output))
+        self.assertEqual(self.queue.get(fine)['status'], 'unpaid')
+        self.assertEqual(self.queue.get(broken)['status'], 'claimed')
+        self.assertGreater(self.queue.get(broken)['lease_until'], time.time() + 20)
+        # Not handed out again until the retry delay has passed
+        self.assertEqual(self.queue.claim(), [])
+        self.queue.release([broken])
+        self.assertEqual(settlement.drain(queue=self.queue), 1)
+        self.assertEqual(self.queue.get(broken)['status'], 'paid')
+
+    def test_batch_that_cannot_settle_is_released_and_raises(self):
+        capture_id = self.enqueue('PAY-100')
+        with mock.patch.object(settlement, 'settle_batch', side_effect=ValueError('database is down')):
+            with self.assertLogs('autofare.settlement', 'WARNING'), self.assertRaises(ValueError):
+                settlement.drain(queue=self.queue)
+        self.assertEqual(self.queue.get(capture_id)['status'], 'claimed')
+        self.assertEqual(self.queue.pending(), 1)
+
+
+
+class SettlementWorkerTests(QueuedCaptures, TransactionTestCase):
+    """Worker threads use their own connections, so the rows they settle must be committed"""
+
+    def test_worker_keeps_settling_after_an_error(self):
+        self.enqueue('PAY-100')
+        drain = settlement.drain
+        calls = iter([mock.Mock(side_effect=RuntimeError('connection lost')), drain, drain])
+        out = StringIO()
+        with mock.patch('toll.management.commands.settle_captures.capture_queue', self.queue), \
+                mock.patch('toll.management.commands.settle_captures.drain',
+                           side_effect=lambda *args, **kwargs: next(calls)(*args, **kwargs)), \
+                self.assertLogs('autofare.settlement', 'ERROR') as logs:
+            call_command('settle_captures', '--once', '--workers', '1', '--idle-sleep', '0.01', stdout=out)
+        self.assertIn("Settlement worker 0 failed, retrying in 0.0s", logs.output[0])
+        self.assertIn("Settled 1 captures", out.getvalue())
+        self.assertEqual(self.queue.pending(), 0)
+
+
+def owner(plate, balance):
+    """A vehicle whose owner's wallet holds balance"""
+    user = User.objects.create_user(username=f'{plate}@example.com')
+    Wallet.objects.create(user=user, wallet_balance=Decimal(balance))
+    return Vehicle.objects.create(user=user, license_plate=plate, vehicle_type='car', vechile_model='Golf')
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CAPTURE_DEDUP_WINDOW=0)
+class BatchCaptureTests(TestCase):
+    """A batch is charged read by read, in the order the gate took the reads"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+        self.client = APIClient()
+
+    def batch(self, *reads, gate_id='G1'):
+        return self.client.post(f'/api/capture/{gate_id}/batch/', {"reads": list(reads)}, format='json')
+
+    def balance(self, plate):
+        return Wallet.objects.get(user__vehicle__license_plate=plate).wallet_balance
+
+    def test_each_read_gets_its_outcome_in_submission_order(self):
+        owner('PAY-100', '50.00')
+        owner('DRY-200', '0.00')
+        response = self.batch({"license_plate": 'PAY-100'}, {"license_plate": 'NOPE-1'}, {"license_plate": 'DRY-200'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['processed'], 3)
+        self.assertEqual(
+            [(result['license_plate'], result['status']) for result in response.data['results']],
+            [('PAY-100', 'paid'), ('NOPE-1', 'not_found'), ('DRY-200', 'unpaid')]
+        )
+        self.assertEqual(self.balance('PAY-100'), Decimal('44.50'))
+        self.assertEqual(Trip.objects.count(), 2)
+        self.assertEqual(Transaction.objects.filter(transaction_type='toll-charge').count(), 1)
+
+    def test_earliest_read_is_charged_first(self):
+        owner('ONE-300', '6.00')
+        read_at = timezone.now()
+        response = self.batch(
+            {"license_plate": 'ONE-300', "timestamp": (read_at + timedelta(minutes=5)).isoformat()},
+            {"license_plate": 'ONE-300', "timestamp": read_at.isoformat()},
+        )
+        late, early = response.data['results']
+        self.assertEqual((early['status'], late['status']), ('paid', 'unpaid'))
+        self.assertEqual(Trip.objects.get(trip_id=early['trip_id']).trip_time, read_at)
+        self.assertEqual(self.balance('ONE-300'), Decimal('0.50'))
+
+    def test_sharded_fleet_wallet_pays_from_its_shards(self):
+        vehicle = owner('FLT-400', '11.00')
+        wallet = Wallet.objects.get(user=vehicle.user)
+        shards.resize(wallet.pk, 2)
+        read_at = timezone.now()
+        response = self.batch(
+            {"license_plate": 'FLT-400', "timestamp": read_at.isoformat()},
+            {"license_plate": 'FLT-400', "timestamp": (read_at + timedelta(minutes=5)).isoformat()},
+            {"license_plate": 'FLT-400', "timestamp": (read_at + timedelta(minutes=10)).isoformat()},
+        )
+        self.assertEqual([result['status'] for result in response.data['results']], ['paid', 'paid', 'unpaid'])
+        self.assertEqual(
+            Wallet.objects.filter(pk=wallet.pk).values_list(shards.total_balance(), flat=True).get(), Decimal('0.00')
+        )
+
+    def spaced(self, plate, count):
+        read_at = timezone.now()
+        return [
+            {"license_plate": plate, "timestamp": (read_at + timedelta(minutes=5 * index)).isoformat()}
+            for index in range(count)
+        ]
+
+    def test_wallet_spread_over_its_shards_pays_as_a_single_capture_would(self):
+        vehicle = owner('THN-500', '11.00')
+        wallet = Wallet.objects.get(user=vehicle.user)
+        # 3.67, 3.67 and 3.66: no single row holds a 5.50 toll
+        shards.resize(wallet.pk, 3)
+        response = self.batch(*self.spaced('THN-500', 3))
+        self.assertEqual([result['status'] for result in response.data['results']], ['paid', 'paid', 'unpaid'])
+        self.assertEqual(Transaction.objects.filter(wallet=wallet, transaction_type='toll-charge').count(), 2)
+
+    @override_settings(SPENDING_ALLOWANCES=True)
+    def test_busy_wallet_is_paid_from_its_allowance(self):
+        vehicle = owner('HOT-600', '50.00')
+        book = allowances.AllowanceBook(amount='20.00', ttl=300, hot_captures=1)
+        with mock.patch.object(allowances, 'book', book):
+            response = self.batch(*self.spaced('HOT-600', 3))
+            self.assertEqual([result['status'] for result in response.data['results']], ['paid'] * 3)
+            self.assertEqual(book.remaining(vehicle.user.wallet.pk, 'G1'), Decimal('3.50'))
+        # Only the hold left the wallet
+        self.assertEqual(self.balance('HOT-600'), Decimal('30.00'))
+        self.assertEqual(Transaction.objects.filter(transaction_type=allowances.CHARGE).count(), 3)
+
+    @override_settings(SPENDING_ALLOWANCES=True)
+    def test_failed_batch_gives_back_what_it_reserved(self):
+        vehicle = owner('HOT-700', '50.00')
+        book = allowances.AllowanceBook(amount='20.00', ttl=300, hot_captures=1)
+        with mock.patch.object(allowances, 'book', book), \
+                mock.patch.object(Trip.objects, 'bulk_create', side_effect=IntegrityError):
+            self.assertEqual(self.batch(*self.spaced('HOT-700', 2)).status_code, 409)
+            self.assertEqual(book.remaining(vehicle.user.wallet.pk, 'G1'), Decimal('20.00'))
+        self.assertFalse(Transaction.objects.filter(transaction_type__in=['toll-charge', allowances.CHARGE]).exists())
+
+    @override_settings(CAPTURE_DEDUP_WINDOW=2)
+    def test_repeated_reads_share_one_trip(self):
+        owner('PAY-100', '50.00')
+        read = {"license_plate": 'PAY-100', "timestamp": timezone.now().isoformat()}
+        first, repeat = self.batch(read, read).data['results']
+        self.assertEqual((repeat['trip_id'], repeat['duplicate']), (first['trip_id'], True))
+        # A resent batch is answered from the trip it already wrote
+        resent = self.batch(read).data['results'][0]
+        self.assertEqual((resent['trip_id'], resent['duplicate']), (first['trip_id'], True))
+        self.assertEqual(Trip.objects.count(), 1)
+        self.assertEqual(self.balance('PAY-100'), Decimal('44.50'))
+
+    def test_unknown_gate_and_empty_batch_are_rejected(self):
+        owner('PAY-100', '50.00')
+        self.assertEqual(self.batch({"license_plate": 'PAY-100'}, gate_id='G9').status_code, 404)
+        self.assertEqual(self.batch().status_code, 400)
+        self.assertEqual(self.balance('PAY-100'), Decimal('50.00'))
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CAPTURE_DEDUP_WINDOW=2)
+class DuplicateReadTests(TestCase):
+    """Repeated reads of a plate at a gate are charged once, whichever process answers them"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        for gate_id in ('G1', 'G2'):
+            Gate.objects.create(gate_id=gate_id, gate_name=gate_id, gate_location='Ring road')
+        self.vehicle = owner('PAY-100', '50.00')
+        self.client = APIClient()
+        self.process()
+        # Reads of the same test are always in the same window bucket
+        now = mock.patch('toll.settlement.timezone.now', return_value=timezone.now())
+        now.start()
+        self.addCleanup(now.stop)
+
+    def process(self):
+        """Answer the next captures from a fresh process's memory"""
+        patcher = mock.patch('toll.views.recent_reads', ReadDeduplicator())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def capture(self, gate_id='G1'):
+        return self.client.post(f'/api/capture/{gate_id}/', {"license_plate": 'PAY-100'}, format='json')
+
+    def balance(self):
+        return Wallet.objects.get(user=self.vehicle.user).wallet_balance
+
+    def test_repeat_in_this_process_gets_the_first_answer(self):
+        first = self.capture()
+        repeat = self.capture()
+        self.assertEqual(repeat.status_code, 200)
+        self.assertEqual(repeat['X-Duplicate-Read'], 'true')
+        self.assertEqual(repeat.data, first.data)
+        self.assertEqual(Trip.objects.count(), 1)
+        self.assertEqual(self.balance(), Decimal('44.50'))
+
+    def test_repeat_in_another_process_is_answered_from_the_trip(self):
+        first = self.capture()
+        self.process()
+        repeat = self.capture()
+        self.assertEqual(repeat['X-Duplicate-Read'], 'true')
+        self.assertEqual(repeat.data['timestamp'], first.data['timestamp'])
+        self.assertEqual(Trip.objects.count(), 1)
+        self.assertEqual(self.balance(), Decimal('44.50'))
+
+    def test_reads_at_other_gates_are_charged(self):
+        self.capture('G1')
+        self.assertNotIn('X-Duplicate-Read', self.capture('G2'))
+        self.assertEqual(Trip.objects.count(), 2)
+
+    def test_repeat_after_the_window_is_charged(self):
+        reads = ReadDeduplicator(window=0.05)
+        read, _ = reads.claim('G1', 'PAY-100')
+        reads.complete(read, 'first')
+        self.assertEqual(reads.claim('G1', 'PAY-100'), (None, 'first'))
+        time.sleep(0.06)
+        read, original = reads.claim('G1', 'PAY-100')
+        self.assertIsNotNone(read)
+        self.assertIsNone(original)
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CAPTURE_DEDUP_WINDOW=0)
+class AsyncCaptureTests(TestCase):
+    """The async capture endpoint keeps the contract of the sync one"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+        self.vehicle = owner('PAY-100', '50.00')
+
+    async def test_capture_matches_the_sync_endpoint(self):
+        response = await AsyncClient().post(
+            '/api/async/capture/G1/', {"license_plate": 'PAY-100'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        sync = await sync_to_async(APIClient().post)('/api/capture/G1/', {"license_plate": 'PAY-100'}, format='json')
+        self.assertEqual(body.keys(), sync.data.keys())
+        self.assertEqual((body['amount_charged'], body['location']), (5.5, 'North - Ring road'))
+        self.assertEqual(await Trip.objects.filter(status='paid').acount(), 2)
+
+    async def test_unknown_plate_and_gate_are_rejected(self):
+        client = AsyncClient()
+        unknown_plate = await client.post('/api/async/capture/G1/', {"license_plate": 'NOPE-1'},
+                                          content_type='application/json')
+        self.assertEqual(unknown_plate.status_code, 400)
+        unknown_gate = await client.post('/api/async/capture/G9/', {"license_plate": 'PAY-100'},
+                                         content_type='application/json')
+        self.assertEqual(unknown_gate.status_code, 404)
+        self.assertEqual(await Trip.objects.acount(), 0)
+
+    async def test_queued_capture_is_acknowledged(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = CaptureQueue(os.path.join(directory.name, 'captures.sqlite3'))
+        with mock.patch('toll.async_views.capture_queue', queue):
+            response = await AsyncClient().post(
+                '/api/async/capture/G1/?mode=async', {"license_plate": 'PAY-100'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(queue.get(response.json()['capture_id'])['status'], 'queued')
+        self.assertEqual(await Trip.objects.acount(), 0)
+
+    @override_settings(CAPTURE_WRITE_BEHIND=True)
+    async def test_write_behind_default_applies(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        queue = CaptureQueue(os.path.join(directory.name, 'captures.sqlite3'))
+        with mock.patch('toll.async_views.capture_queue', queue):
+            response = await AsyncClient().post(
+                '/api/async/capture/G1/', {"license_plate": 'PAY-100'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(await Trip.objects.acount(), 0)
+
+    @override_settings(CAPTURE_DEDUP_WINDOW=2)
+    async def test_repeated_reads_share_the_sync_ring(self):
+        reads = ReadDeduplicator()
+        with mock.patch('toll.views.recent_reads', reads), mock.patch('toll.async_views.recent_reads', reads):
+            sync = await sync_to_async(APIClient().post)('/api/capture/G1/', {"license_plate": 'PAY-100'}, format='json')
+            # Answered from memory: no trip lookup, no debit
+            with mock.patch('toll.async_views.settle_read') as settle:
+                repeat = await AsyncClient().post(
+                    '/api/async/capture/G1/', {"license_plate": 'PAY-100'}, content_type='application/json'
+                )
+        settle.assert_not_called()
+        self.assertEqual(repeat['X-Duplicate-Read'], 'true')
+        self.assertEqual(repeat.json(), json.loads(sync.content))
+        self.assertEqual(await Trip.objects.acount(), 1)
+        self.assertEqual(reads.suppressed, 1)
+
+
+class BenchmarkTests(SimpleTestCase):
+    """Benchmark results are summarised and compared against a baseline correctly"""
+
+    def test_summary_of_latencies(self):
+        latencies = [index / 1000 for index in range(1, 101)]
+        self.assertEqual(
+            summarize(latencies, elapsed=2.0),
+            {"requests": 100, "p50_ms": 50.0, "p95_ms": 95.0, "p99_ms": 99.0, "throughput": 50.0}
+        )
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_threads_run_every_request_once(self):
+        seen = []
+        latencies, elapsed = run_threads(seen.append, requests=50, concurrency=4)
+        self.assertEqual(sorted(seen), list(range(50)))
+        self.assertEqual(len(latencies), 50)
+        self.assertGreater(elapsed, 0)
+
+    def compare(self, baseline, results, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'baseline.json')
+        with open(path, 'w') as handle:
+            json.dump(baseline, handle)
+        command = BenchmarkCommand(stdout=StringIO())
+        command._compare(results, path, **options)
+        return command.stdout.getvalue()
+
+    def test_results_within_tolerance_pass(self):
+        baseline = {"client:capture": {"p95_ms": 10.0, "throughput": 100.0, "queries_per_request": 6.0}}
+        results = {"client:capture": {"p95_ms": 14.0, "throughput": 60.0, "queries_per_request": 6.0}}
+        self.assertIn("No regressions", self.compare(baseline, results, latency_tolerance=0.5, throughput_tolerance=0.5))
+
+    def test_extra_queries_slower_p95_or_lower_throughput_fail(self):
+        baseline = {"client:capture": {"p95_ms": 10.0, "throughput": 100.0, "queries_per_request": 6.0}}
+        results = {"client:capture": {"p95_ms": 16.0, "throughput": 40.0, "queries_per_request": 6.01}}
+        with self.assertRaises(CommandError) as raised:
+            self.compare(baseline, results, latency_tolerance=0.5, throughput_tolerance=0.5)
+        message = str(raised.exception)
+        for expected in ("6.01 queries per request", "p95 16.0ms", "40.0 req/s"):
+            self.assertIn(expected, message)
+
+    def test_default_tolerances_fail_regressions(self):
+        options = BenchmarkCommand().create_parser('manage.py', 'benchmark').parse_args([])
+        self.assertEqual(
+            (options.latency_tolerance, options.throughput_tolerance), (LATENCY_TOLERANCE, THROUGHPUT_TOLERANCE)
+        )
+        baseline = {"client:capture": {"p95_ms": 10.0, "throughput": 100.0}}
+        self.assertIn("No regressions", self.compare(baseline, {"client:capture": {"p95_ms": 14.0, "throughput": 85.0}}))
+        with self.assertRaises(CommandError) as raised:
+            self.compare(baseline, {"client:capture": {"p95_ms": 16.0, "throughput": 75.0}})
+        self.assertIn("p95 16.0ms", str(raised.exception))
+        self.assertIn("75.0 req/s", str(raised.exception))
+
+
+class DatasetGeneratorTests(TestCase):
+    """Generated data is consistent with itself and the same for the same seed"""
+
+    def generate(self, seed=7):
+        generator = DatasetGenerator(users=20, vehicles=40, gates=5, trips=300, seed=seed, chunk_size=64)
+        return generator, generator.run()
+
+    def test_counts_and_links(self):
+        _, counts = self.generate()
+        self.assertEqual(
+            (counts['auth.User'], counts['vehicles.Vehicle'], counts['toll.Gate'], counts['toll.Trip']),
+            (20, 40, 5, 300)
+        )
+        self.assertEqual(Vehicle.objects.values('license_plate').distinct().count(), 40)
+        unpaid = Trip.objects.filter(status='unpaid')
+        self.assertEqual(Violation.objects.filter(trip__in=unpaid).count(), unpaid.count())
+        self.assertFalse(Trip.objects.filter(gate__tolls__isnull=True).exists())
+
+    def test_wallet_balances_agree_with_the_ledger(self):
+        self.generate()
+        wallet_ids = Wallet.objects.values_list('id', flat=True)
+        audits = checkpoints.audit(min(wallet_ids), max(wallet_ids))
+        self.assertEqual(len(audits), 20)
+        for audit in audits:
+            self.assertEqual(audit.stored_balance, audit.ledger_balance)
+
+    def test_same_seed_gives_the_same_data_after_existing_rows(self):
+        first, _ = self.generate()
+        second, _ = self.generate()
+        self.assertEqual(second.first_trip, first.first_trip + 300)
+
+        def history(generator):
+            trips = Trip.objects.filter(trip_id__gte=generator.first_trip, trip_id__lt=generator.first_trip + 300)
+            return [
+                (vehicle_id - generator.first_vehicle, fare, status)
+                for vehicle_id, fare, status in trips.order_by('trip_id').values_list('vehicle_id', 'fare_amount', 'status')
+            ]
+
+        self.assertEqual(history(first), history(second))
+
+    def test_gates_follow_existing_ones_and_reach_running_matrices(self):
+        Gate.objects.create(gate_id='G000003', gate_name='Manual', gate_location='Ring road')
+        get_tariffs()
+        generator, _ = self.generate()
+        self.assertEqual(generator.gate_ids, [f"G{number:06d}" for number in range(4, 9)])
+        self.assertIsNotNone(get_tariffs().get_gate(generator.gate_ids[0]))
+
+    def test_id_sequences_are_moved_past_the_generated_rows(self):
+        with mock.patch.object(connection.ops, 'sequence_reset_sql', wraps=connection.ops.sequence_reset_sql) as reset:
+            self.generate()
+        self.assertIn(Trip, reset.call_args.args[1])
+        user = User.objects.create_user(username='after@example.com')
+        self.assertGreater(user.pk, User.objects.exclude(pk=user.pk).aggregate(top=Max('pk'))['top'])
+
+
+@override_settings(ALLOWED_HOSTS=['*'], QUERY_METRICS_ENABLED=True, CAPTURE_DEDUP_WINDOW=0)
+class QueryMetricsTests(TestCase):
+    """Each request reports its queries, and admins see them summarised per URL pattern"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        route_metrics.reset()
+        self.addCleanup(route_metrics.reset)
+        for gate_id in ('G1', 'G2'):
+            Gate.objects.create(gate_id=gate_id, gate_name=gate_id, gate_location='Ring road')
+        owner('PAY-100', '50.00')
+        self.client = APIClient()
+
+    def capture(self, gate_id):
+        return self.client.post(f'/api/capture/{gate_id}/', {"license_plate": 'PAY-100'}, format='json')
+
+    def test_response_headers_count_the_queries(self):
+        with CaptureQueriesContext(connection) as queries, self.assertLogs('autofare.queries', 'INFO') as logs:
+            response = self.capture('G1')
+        self.assertEqual(int(response['X-Query-Count']), len(queries))
+        for header in ('X-Query-Time-Ms', 'X-Slowest-Query-Ms', 'X-View-Time-Ms'):
+            self.assertGreaterEqual(float(response[header]), 0)
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line['endpoint'], line['queries']), ('POST api/capture/<str:gate_id>/', len(queries)))
+
+    def test_requests_are_grouped_by_url_pattern(self):
+        with self.assertLogs('autofare.queries', 'INFO'):
+            self.capture('G1')
+            self.capture('G2')
+        admin = User.objects.create_user(username='ops@example.com', is_staff=True)
+        self.client.force_authenticate(admin)
+        with self.assertLogs('autofare.queries', 'INFO'):
+            snapshot = self.client.get('/api/metrics/queries').data
+        self.assertEqual(snapshot['POST api/capture/<str:gate_id>/']['requests'], 2)
+
+    def test_summary_is_for_admins_only(self):
+        with self.assertLogs('autofare.queries', 'INFO'):
+            self.assertIn(self.client.get('/api/metrics/queries').status_code, (401, 403))
+
+
+class MetricsRegistryTests(SimpleTestCase):
+    """Metrics render in the Prometheus text format, summed over worker processes"""
+
+    def registry(self):
+        registry = metrics.Registry()
+        requests = registry.counter('test_requests', "Requests", ['gate'])
+        latency = registry.histogram('test_latency_seconds', "Latency", buckets=(0.1, 1.0))
+        return registry, requests, latency
+
+    def test_counters_and_histograms_render(self):
+        registry, requests, latency = self.registry()
+        requests.inc(gate='G1')
+        requests.inc(2, gate='say "hi"')
+        for value in (0.05, 0.5, 5.0):
+            latency.observe(value)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_requests counter', lines)
+        self.assertIn('test_requests_total{gate="G1"} 1', lines)
+        self.assertIn('test_requests_total{gate="say \\"hi\\""} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_latency_seconds_count 3', lines)
+        self.assertIn('test_latency_seconds_sum 5.55', lines)
+
+    def test_processes_sharing_a_directory_are_summed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(METRICS_DIR=directory.name):
+            first, first_requests, _ = self.registry()
+            second, second_requests, _ = self.registry()
+            second.token = 'other-process'
+            first_requests.inc(gate='G1')
+            second_requests.inc(3, gate='G1')
+            second.flush()
+            self.assertIn('test_requests_total{gate="G1"} 4', first.render().splitlines())
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CAPTURE_DEDUP_WINDOW=0)
+class MetricsEndpointTests(TestCase):
+    """Capture outcomes are counted on the /metrics endpoint"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        Gate.objects.create(gate_id='M1', gate_name='Metered', gate_location='Ring road')
+        owner('PAY-100', '50.00')
+
+    def captured(self, outcome):
+        response = APIClient().get('/metrics')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        prefix = f'autofare_captures_total{{gate="M1",outcome="{outcome}"}} '
+        for line in response.content.decode().splitlines():
+            if line.startswith(prefix):
+                return int(line[len(prefix):])
+        return 0
+
+    def test_capture_outcomes_are_counted(self):
+        before = self.captured('paid'), self.captured('not_found')
+        client = APIClient()
+        client.post('/api/capture/M1/', {"license_plate": 'PAY-100'}, format='json')
+        client.post('/api/capture/M1/batch/', {"reads": [{"license_plate": 'NOPE-1'}]}, format='json')
+        self.assertEqual((self.captured('paid'), self.captured('not_found')), (before[0] + 1, before[1] + 1))
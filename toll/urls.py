@@ -4,5 +4,7 @@ from . import views
 app_name = 'toll'
 
 urlpatterns = [
+    path('status/<str:capture_id>/', views.TollCaptureViewSet.as_view({'get': 'capture_status'}), name='capture-status'),
+    path('<str:gate_id>/batch/', views.TollCaptureViewSet.as_view({'post': 'capture_batch'}), name='capture-batch'),
     path('<str:gate_id>/', views.TollCaptureViewSet.as_view({'post': 'capture_vehicle'}), name='capture'),
 ]
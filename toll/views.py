@@ -1,16 +1,33 @@
+import time
+
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.utils import timezone
-from django.db import transaction
-from .models import Gate, Trip, Toll
-from .serializers import TollCaptureSerializer, TripSerializer
-from vehicles.models import Vehicle
-from users.models import Wallet, Transaction
+from django.db import IntegrityError, transaction
+from .capture_queue import capture_queue, write_behind
+from .dedup import dedup_key, recent_reads
+from .settlement import capture_outcome, settle_read
+from .models import Trip
+from .serializers import TollCaptureSerializer, TollBatchCaptureSerializer, TripSerializer
+from .tariffs import DEFAULT_TOLL_AMOUNT, get_tariffs
+from vehicles.resolver import plate_resolver
+from autofare import ids, metrics
+from users import allowances, ledger
+from users.authentication import MACHINE_CLIENT_AUTHENTICATION
+from users.models import Transaction
+
+
+# Queue states as reported to gates polling for an outcome
+QUEUE_STATUSES = {
+    'queued': 'pending',
+    'claimed': 'pending',
+}
 
 
 class TollCaptureViewSet(viewsets.ViewSet):
     """Toll Capture endpoints for gate processing"""
+    authentication_classes = MACHINE_CLIENT_AUTHENTICATION  # Gate controllers
     
     @action(detail=False, methods=['post'], url_path='capture/(?P<gate_id>[^/.]+)')
     def capture_vehicle(self, request, gate_id=None):
@@ -21,74 +38,274 @@ class TollCaptureViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        serializer = TollCaptureSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
+        started = time.perf_counter()
+        with metrics.capture_phase.time(phase='lookup'):
+            serializer = TollCaptureSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+        
+        record = serializer.validated_data['plate_record']
         
+        with metrics.capture_phase.time(phase='pricing'):
+            gate = get_tariffs().get_gate(gate_id)
+            if gate is None:
+                return Response(
+                    {"error": f"Gate {gate_id} not found"},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            
+            # Get toll amount
+            toll_amount = gate.amounts.get(record.vehicle_type, DEFAULT_TOLL_AMOUNT)
         license_plate = serializer.validated_data['license_plate']
         
         try:
-            gate = Gate.objects.get(gate_id=gate_id)
-        except Gate.DoesNotExist:
+            return self._capture_once(request, gate, license_plate, record, toll_amount)
+        finally:
+            metrics.capture_latency.observe(time.perf_counter() - started, gate=gate.gate_id)
+
+    def _capture_once(self, request, gate, license_plate, record, toll_amount):
+        if self._write_behind(request):
+            capture = self._queue_capture
+        else:
+            capture = self._capture_now
+        
+        if not recent_reads.enabled:
+            return capture(gate, license_plate, record, toll_amount)
+        
+        # Repeated reads of the same plate get the original answer back
+        read, original = recent_reads.claim(gate.gate_id, license_plate)
+        if original is not None:
+            data, status_code = original
+            response = Response(data, status=status_code)
+            response['X-Duplicate-Read'] = 'true'
+            return response
+        try:
+            response = capture(gate, license_plate, record, toll_amount)
+        except Exception:
+            recent_reads.release(read)
+            raise
+        recent_reads.complete(read, (response.data, response.status_code))
+        return response
+
+    def _queue_capture(self, gate, license_plate, record, toll_amount):
+        # Acknowledge now; a settlement worker writes the trip and debits the wallet
+        capture_id = capture_queue.enqueue(
+            gate.gate_id,
+            license_plate,
+            record,
+            toll_amount,
+            timezone.now()
+        )
+        metrics.captures_queued.inc(gate=gate.gate_id)
+        return Response(
+            {
+                "message": "Toll capture queued",
+                "capture_id": capture_id,
+                "user_id": str(record.user_id),
+                "amount": float(toll_amount),
+                "location": f"{gate.gate_name} - {gate.gate_location}"
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    def _capture_now(self, gate, license_plate, record, toll_amount):
+        trip, duplicate = settle_read(gate.gate_id, license_plate, record, toll_amount)
+        response = self._captured(gate, record, trip)
+        if duplicate:
+            response['X-Duplicate-Read'] = 'true'
+        return response
+
+    def _captured(self, gate, record, trip):
+        return Response(
+            {
+                "message": "Toll captured successfully",
+                "user_id": str(record.user_id),
+                "amount_charged": float(trip.fare_amount),
+                "location": f"{gate.gate_name} - {gate.gate_location}",
+                "timestamp": trip.trip_time.isoformat()
+            },
+            status=status.HTTP_200_OK
+        )
+
+    @action(detail=False, methods=['get'], url_path='capture/status/(?P<capture_id>[^/.]+)')
+    def capture_status(self, request, capture_id=None):
+        """GET /capture/status/{capture_id} - Poll the outcome of a queued capture"""
+        entry = capture_queue.get(capture_id)
+        if entry is None:
             return Response(
-                {"error": f"Gate {gate_id} not found"},
+                {"error": f"Capture {capture_id} not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        try:
-            vehicle = Vehicle.objects.get(license_plate=license_plate)
-        except Vehicle.DoesNotExist:
+        return Response(
+            {
+                "capture_id": entry['capture_id'],
+                "status": QUEUE_STATUSES.get(entry['status'], entry['status']),
+                "gate_id": entry['gate_id'],
+                "license_plate": entry['license_plate'],
+                "user_id": str(entry['user_id']),
+                "amount_charged": float(entry['amount']),
+                "trip_id": entry['trip_id'],
+                "timestamp": entry['read_at'],
+                "settled_at": entry['settled_at']
+            },
+            status=status.HTTP_200_OK
+        )
+
+    def _write_behind(self, request):
+        return write_behind(request.query_params.get('mode'))
+
+    @action(detail=False, methods=['post'], url_path='capture/(?P<gate_id>[^/.]+)/batch')
+    def capture_batch(self, request, gate_id=None):
+        """POST /capture/{gate_id}/batch - Capture a batch of plate reads at a toll gate"""
+        serializer = TollBatchCaptureSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        reads = serializer.validated_data['reads']
+
+        tariffs = get_tariffs()
+        gate = tariffs.get_gate(gate_id)
+        if gate is None:
             return Response(
-                {"error": "Vehicle not found"},
+                {"error": f"Gate {gate_id} not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
-        
-        user = vehicle.user
-        
-        with transaction.atomic():
-            # Create trip record
-            trip = Trip.objects.create(
-                vehicle=vehicle,
-                gate=gate,
-                status='pending'
+
+        # Resolve every vehicle, owner and wallet with at most one query
+        records = plate_resolver.resolve_many(read['license_plate'] for read in reads)
+        priced = list(records.values())
+        amounts = dict(zip(
+            [record.vehicle_id for record in priced],
+            tariffs.price_many((gate_id, record.vehicle_type) for record in priced)
+        ))
+
+        # Settle reads in the order they were taken at the gate
+        order = sorted(
+            range(len(reads)),
+            key=lambda i: (reads[i].get('timestamp') is None, reads[i].get('timestamp') or 0, i)
+        )
+        results = [None] * len(reads)
+        now = timezone.now()
+
+        # Repeated reads inside the dedup window share one trip
+        keys = [dedup_key(gate_id, read['license_plate'], read.get('timestamp') or now) for read in reads]
+        captured = {}
+        if recent_reads.enabled:
+            captured = Trip.objects.filter(dedup_key__in=[key for key in keys if key]).in_bulk(field_name='dedup_key')
+        duplicates = []
+        trips = []
+
+        for i in order:
+            read = reads[i]
+            record = records.get(read['license_plate'])
+            if record is None:
+                results[i] = {
+                    "license_plate": read['license_plate'],
+                    "status": "not_found",
+                    "error": "Vehicle not found"
+                }
+                continue
+            if keys[i] in captured:
+                duplicates.append((i, record, captured[keys[i]]))
+                continue
+
+            trip = Trip(
+                vehicle_id=record.vehicle_id,
+                gate_id=gate_id,
+                fare_amount=amounts[record.vehicle_id],
+                status='unpaid',
+                dedup_key=keys[i]
             )
-            
-            # Get toll amount
-            toll = gate.tolls.first()
-            toll_amount = toll.amount if toll else 5.50
-            
-            # Process payment
-            try:
-                wallet = user.wallet
-                if wallet.wallet_balance >= toll_amount:
-                    wallet.wallet_balance -= toll_amount
-                    wallet.save()
-                    trip.status = 'paid'
-                    trip.fare_amount = toll_amount
-                else:
-                    trip.status = 'unpaid'
-                    trip.fare_amount = toll_amount
-                
-                trip.save()
-                
-                # Create transaction record
-                Transaction.objects.create(
-                    wallet=wallet,
-                    transaction_id=f"TXN{timezone.now().timestamp()}",
-                    transaction_type="toll-charge",
-                    amount=toll_amount
-                )
-            except Wallet.DoesNotExist:
-                trip.status = 'unpaid'
-                trip.fare_amount = toll_amount
-                trip.save()
-        
+            if keys[i]:
+                captured[keys[i]] = trip
+            trips.append((i, record, trip))
+
+        # Busy wallets at this gate are paid from an allowance held in memory, as in settle_read
+        reserved = {}
+        if allowances.enabled():
+            for i, record, trip in trips:
+                if record.wallet_id is not None:
+                    allowance_id = allowances.book.reserve(record.wallet_id, gate_id, trip.fare_amount)
+                    if allowance_id is not None:
+                        reserved[i] = allowance_id
+
+        committed = False
+        try:
+            with transaction.atomic():
+                transactions = []
+                for i, record, trip in trips:
+                    # Each read is one conditional debit, falling back to the wallet's shards
+                    if i in reserved:
+                        paid = True
+                    else:
+                        paid = record.wallet_id is not None and ledger.debit(record.wallet_id, trip.fare_amount) is not None
+                    if paid:
+                        trip.status = 'paid'
+                        transactions.append(Transaction(
+                            wallet_id=record.wallet_id,
+                            transaction_type=allowances.CHARGE if i in reserved else "toll-charge",
+                            amount=trip.fare_amount,
+                            allowance_id=reserved.get(i)
+                        ))
+
+                Trip.objects.bulk_create([trip for _, _, trip in trips])
+
+                # trip_time is auto_now_add, so the gate's own timestamps are applied afterwards
+                stamped = []
+                for i, _, trip in trips:
+                    if reads[i].get('timestamp'):
+                        trip.trip_time = reads[i]['timestamp']
+                        stamped.append(trip)
+                if stamped:
+                    Trip.objects.bulk_update(stamped, ['trip_time'])
+
+                if transactions:
+                    for txn, transaction_id in zip(transactions, ids.transaction_ids(len(transactions))):
+                        txn.transaction_id = transaction_id
+                    Transaction.objects.bulk_create(transactions)
+            committed = True
+        except IntegrityError:
+            return Response(
+                {"error": "Some reads were captured concurrently by another request; resend the batch"},
+                status=status.HTTP_409_CONFLICT
+            )
+        finally:
+            if not committed:
+                # Nothing was charged, so the allowances still hold the amounts
+                for i, record, trip in trips:
+                    if i in reserved:
+                        allowances.book.refund(record.wallet_id, gate_id, reserved[i], trip.fare_amount)
+
+        # Only reads of unknown plates have a result so far
+        for result in results:
+            if result is not None:
+                metrics.captures.inc(gate=gate_id, outcome='not_found')
+        for i, record, trip in trips:
+            metrics.captures.inc(gate=gate_id, outcome=capture_outcome(trip, record.wallet_id))
+            results[i] = {
+                "license_plate": reads[i]['license_plate'],
+                "status": trip.status,
+                "trip_id": trip.trip_id,
+                "user_id": str(record.user_id),
+                "amount_charged": float(trip.fare_amount),
+                "timestamp": trip.trip_time.isoformat()
+            }
+        for i, record, trip in duplicates:
+            metrics.captures.inc(gate=gate_id, outcome='duplicate')
+            results[i] = {
+                "license_plate": reads[i]['license_plate'],
+                "status": trip.status,
+                "trip_id": trip.trip_id,
+                "user_id": str(record.user_id),
+                "amount_charged": float(trip.fare_amount),
+                "timestamp": trip.trip_time.isoformat(),
+                "duplicate": True
+            }
+
         return Response(
             {
-                "message": "Toll captured successfully",
-                "user_id": str(user.id),
-                "amount_charged": float(trip.fare_amount),
+                "message": "Batch captured successfully",
                 "location": f"{gate.gate_name} - {gate.gate_location}",
-                "timestamp": trip.trip_time.isoformat()
+                "processed": len(reads),
+                "results": results
             },
             status=status.HTTP_200_OK
         )
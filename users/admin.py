@@ -1,7 +1,11 @@
 from django.contrib import admin
-from .models import UserProfile, Wallet, Transaction
+from .models import UserProfile, Wallet, Transaction, WalletShard, SpendingAllowance, WalletCheckpoint, RevokedToken
 
 # Register your models here.
 admin.site.register(UserProfile)
 admin.site.register(Wallet)
 admin.site.register(Transaction)
+admin.site.register(WalletShard)
+admin.site.register(SpendingAllowance)
+admin.site.register(WalletCheckpoint)
+admin.site.register(RevokedToken)
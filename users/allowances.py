@@ -0,0 +1,300 @@
+"""
+Gate-local spending allowances.
+
+A vehicle that passes the same gate again and again costs a conditional
+UPDATE of its wallet row per capture, and a fleet's captures all queue on
+that row. Once a wallet has been captured ALLOWANCE_HOT_CAPTURES times at
+one gate within ALLOWANCE_TTL, this process is granted an allowance:
+ALLOWANCE_AMOUNT is taken from the wallet (an allowance-hold transaction)
+and held for this process and gate until it expires. Captures covered by
+it are debited in memory, and only their allowance-charge transaction is
+written, with no UPDATE of the wallet. After expiry, reconcile_allowances
+closes the allowance and credits back whatever was not charged (an
+allowance-release transaction).
+
+Why the funds are never exceeded:
+- The hold leaves the wallet before anything is spent from it, so the
+  wallet balance plus the unspent allowances is always the real balance.
+- Only the process that was granted an allowance (its holder) spends it,
+  and it counts down in memory before the charge is written. Committed
+  charges therefore never add up to more than the amount.
+- A restarted or forked process gets a new holder id, so it never resumes
+  an allowance whose in-memory count it lost. That allowance simply
+  expires.
+- An allowance is closed ALLOWANCE_CLOSE_GRACE seconds after it expires,
+  once any capture in flight has committed. What it gives back is worked
+  out from the committed charges, not from the holder's memory. A crash
+  loses nothing and double-counts nothing, and closing twice is a no-op.
+- A holder has at most one open allowance per wallet and gate. Until its
+  expired one can be closed, captures of the pair debit the wallet; then
+  the holder closes it itself and is granted a new one, without waiting
+  for reconcile_allowances.
+
+Usage:
+    allowance_id = book.reserve(wallet_id, gate_id, amount)   # None: debit the wallet
+    record_charge(allowance_id, wallet_id, amount)           # in the capture's transaction
+    book.refund(wallet_id, gate_id, allowance_id, amount)    # if that transaction failed
+"""
+import os
+import secrets
+import socket
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from autofare import ids
+from . import ledger
+from .models import SpendingAllowance, Transaction
+
+
+HOLD = 'allowance-hold'
+CHARGE = 'allowance-charge'
+RELEASE = 'allowance-release'
+ZERO = Decimal('0.00')
+
+# Wallet/gate pairs whose capture counts are kept, before old ones are dropped
+MAX_TRACKED = 100000
+
+
+def _to_balance(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+def enabled():
+    return getattr(settings, 'SPENDING_ALLOWANCES', False)
+
+
+def new_holder():
+    """Id of one process's book; never reused, so a restart cannot resume an old allowance"""
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+def grant(wallet_id, gate_id, holder, amount, ttl):
+    """Hold amount from a wallet for holder at gate_id. Returns the SpendingAllowance, or None if short of funds."""
+    with transaction.atomic():
+        if ledger.debit(wallet_id, amount) is None:
+            return None
+        allowance = SpendingAllowance.objects.create(
+            wallet_id=wallet_id,
+            gate_id=gate_id,
+            holder=holder,
+            amount=amount,
+            expires_at=timezone.now() + timedelta(seconds=ttl)
+        )
+        Transaction.objects.create(
+            wallet_id=wallet_id,
+            transaction_id=ids.transaction_id(),
+            transaction_type=HOLD,
+            amount=amount,
+            allowance=allowance
+        )
+    return allowance
+
+
+def record_charge(allowance_id, wallet_id, amount):
+    """Write the transaction of a capture paid from an allowance"""
+    return Transaction.objects.create(
+        wallet_id=wallet_id,
+        transaction_id=ids.transaction_id(),
+        transaction_type=CHARGE,
+        amount=amount,
+        allowance_id=allowance_id
+    )
+
+
+def _spent(allowance_ids):
+    return dict(
+        Transaction.objects.filter(allowance_id__in=allowance_ids, transaction_type=CHARGE)
+        .values('allowance_id').annotate(spent=Sum('amount')).values_list('allowance_id', 'spent')
+    )
+
+
+def close(allowance_id):
+    """Credit back what an allowance did not spend. Returns the amount, or None if it was already closed."""
+    with transaction.atomic():
+        allowance = SpendingAllowance.objects.select_for_update().filter(
+            pk=allowance_id, closed_at__isnull=True
+        ).first()
+        if allowance is None:
+            return None
+        spent = _to_balance(_spent([allowance_id]).get(allowance_id) or ZERO)
+        unused = allowance.amount - spent
+        if unused > ZERO:
+            ledger.credit(allowance.wallet_id, unused)
+            Transaction.objects.create(
+                wallet_id=allowance.wallet_id,
+                transaction_id=ids.transaction_id(),
+                transaction_type=RELEASE,
+                amount=unused,
+                allowance=allowance
+            )
+        allowance.spent = spent
+        allowance.closed_at = timezone.now()
+        allowance.save(update_fields=['spent', 'closed_at'])
+    return unused
+
+
+def reconcile(now=None):
+    """Store what open allowances have spent so far and close the ones past expiry and grace.
+
+    Returns (allowances updated, allowances closed, amount credited back).
+    """
+    now = now or timezone.now()
+    open_allowances = list(SpendingAllowance.objects.filter(closed_at__isnull=True).only('id', 'spent'))
+    spent = _spent([allowance.pk for allowance in open_allowances])
+    changed = []
+    for allowance in open_allowances:
+        total = _to_balance(spent.get(allowance.pk) or ZERO)
+        if allowance.spent != total:
+            allowance.spent = total
+            changed.append(allowance)
+    SpendingAllowance.objects.bulk_update(changed, ['spent'])
+
+    closed = 0
+    returned = ZERO
+    expired = SpendingAllowance.objects.filter(
+        closed_at__isnull=True,
+        expires_at__lt=now - timedelta(seconds=settings.ALLOWANCE_CLOSE_GRACE)
+    ).values_list('id', flat=True)
+    for allowance_id in list(expired):
+        unused = close(allowance_id)
+        if unused is not None:
+            closed += 1
+            returned += unused
+    return len(changed), closed, returned
+
+
+def open_allowance(wallet_id, gate_id, holder):
+    """(id, expires_at) of the holder's open allowance for the pair, or None"""
+    return SpendingAllowance.objects.filter(
+        wallet_id=wallet_id, gate_id=gate_id, holder=holder, closed_at__isnull=True
+    ).values_list('id', 'expires_at').first()
+
+
+class _Open:
+    __slots__ = ('allowance_id', 'remaining', 'expires')
+
+    def __init__(self, allowance_id, remaining, expires):
+        self.allowance_id = allowance_id
+        self.remaining = remaining
+        self.expires = expires  # unix timestamp
+
+
+class AllowanceBook:
+    """This process's allowances, spent in memory"""
+
+    def __init__(self, amount=None, ttl=None, hot_captures=None):
+        self.amount = Decimal(str(amount if amount is not None else settings.ALLOWANCE_AMOUNT))
+        self.ttl = ttl if ttl is not None else settings.ALLOWANCE_TTL
+        self.hot_captures = hot_captures if hot_captures is not None else settings.ALLOWANCE_HOT_CAPTURES
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.holder = new_holder()
+        self._open = {}      # (wallet_id, gate_id) -> _Open
+        self._seen = {}      # (wallet_id, gate_id) -> (captures, window start)
+        self._expired = {}   # (wallet_id, gate_id) -> (allowance id, unix time it can be closed)
+        self._granting = set()
+
+    def _reset_process(self):
+        # A forked child must not spend the parent's allowances: the two
+        # would each count down the same amount
+        self._lock = threading.Lock()
+        self._reset()
+
+    def reserve(self, wallet_id, gate_id, amount):
+        """Take amount from this process's allowance for the wallet at gate_id.
+
+        Grants one first when the pair is busy enough. Returns the allowance
+        id, or None when the capture has to debit the wallet instead.
+        """
+        key = (wallet_id, gate_id)
+        now = time.time()
+        with self._lock:
+            entry = self._open.get(key)
+            if entry is not None and entry.expires <= now:
+                del self._open[key]
+                self._expire(key, entry.allowance_id, entry.expires)
+                entry = None
+            if entry is not None:
+                if entry.remaining < amount:
+                    return None
+                entry.remaining -= amount
+                return entry.allowance_id
+            if not self._busy(key, now) or key in self._granting:
+                return None
+            expired = self._expired.get(key)
+            if expired is not None and now < expired[1]:
+                # Granting would only fail on the open one, after debiting the wallet
+                return None
+            self._granting.add(key)
+        try:
+            if expired is not None:
+                close(expired[0])
+                with self._lock:
+                    self._expired.pop(key, None)
+            try:
+                allowance = grant(wallet_id, gate_id, self.holder, self.amount, self.ttl)
+            except IntegrityError:
+                # An allowance of this holder is still open; wait until it can be closed
+                found = open_allowance(wallet_id, gate_id, self.holder)
+                if found is not None:
+                    with self._lock:
+                        self._expire(key, found[0], found[1].timestamp())
+                allowance = None
+            if allowance is None:
+                return None
+            entry = _Open(allowance.pk, allowance.amount, allowance.expires_at.timestamp())
+            with self._lock:
+                self._open[key] = entry
+                if entry.remaining < amount:
+                    return None
+                entry.remaining -= amount
+            return allowance.pk
+        finally:
+            with self._lock:
+                self._granting.discard(key)
+
+    def refund(self, wallet_id, gate_id, allowance_id, amount):
+        """Give back a reserved amount whose charge was never committed"""
+        with self._lock:
+            entry = self._open.get((wallet_id, gate_id))
+            if entry is not None and entry.allowance_id == allowance_id:
+                entry.remaining += amount
+
+    def _expire(self, key, allowance_id, expires):
+        self._expired[key] = (allowance_id, expires + settings.ALLOWANCE_CLOSE_GRACE)
+        if len(self._expired) > MAX_TRACKED:
+            now = time.time()
+            self._expired = {
+                tracked: value for tracked, value in self._expired.items() if value[1] > now
+            }
+
+    def _busy(self, key, now):
+        captures, since = self._seen.get(key, (0, now))
+        if now - since > self.ttl:
+            captures, since = 0, now
+        captures += 1
+        self._seen[key] = (captures, since)
+        if len(self._seen) > MAX_TRACKED:
+            self._seen = {
+                tracked: value for tracked, value in self._seen.items() if now - value[1] <= self.ttl
+            }
+        return captures >= self.hot_captures
+
+    def remaining(self, wallet_id, gate_id):
+        """Unspent amount of the open allowance for the pair, or None"""
+        with self._lock:
+            entry = self._open.get((wallet_id, gate_id))
+            return entry.remaining if entry is not None else None
+
+
+book = AllowanceBook()
+os.register_at_fork(after_in_child=book._reset_process)
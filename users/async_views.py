@@ -0,0 +1,72 @@
+"""
+Native async wallet endpoint, served through autofare/asgi.py.
+
+Same request and response contract as WalletViewSet. Reads use the async
+ORM; a top-up runs the atomic ledger credit through sync_to_async.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from . import history, ledger
+from .models import Wallet
+from .serializers import AddFundsSerializer, WalletSerializer, WalletHistoryQuerySerializer
+
+
+@csrf_exempt
+@require_http_methods(['GET', 'POST'])
+async def wallet(request):
+    """GET/POST /async/user/wallet - Wallet balance and history, or add money"""
+    if request.method == 'POST':
+        return await _top_up(request)
+    
+    user_id = request.GET.get('user_id')
+    if not user_id:
+        return JsonResponse({"error": "user_id query parameter is required"}, status=400)
+    
+    params = WalletHistoryQuerySerializer(data=request.GET)
+    if not params.is_valid():
+        return JsonResponse(params.errors, status=400)
+    params = params.validated_data
+    
+    wallet = await history.wallet(user_id).afirst() if user_id.isdigit() else None
+    if wallet is None:
+        return JsonResponse({"error": "User or wallet not found"}, status=404)
+    
+    if params['history']:
+        try:
+            rows = [row async for row in history.transactions(wallet['id'], params)]
+        except ValueError:
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+        wallet = history.with_page(wallet, rows, params)
+    
+    return JsonResponse(WalletSerializer(wallet).data)
+
+
+async def _top_up(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({"detail": "JSON parse error"}, status=400)
+    
+    serializer = AddFundsSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    
+    wallet_id = await Wallet.objects.filter(
+        user_id=serializer.validated_data['user_id']
+    ).values_list('id', flat=True).afirst()
+    if wallet_id is None:
+        return JsonResponse({"error": "User or wallet not found"}, status=404)
+    
+    new_balance = await sync_to_async(ledger.top_up)(wallet_id, serializer.validated_data['amount'])
+    return JsonResponse(
+        {
+            "message": "Wallet updated successfully",
+            "new_balance": float(new_balance)
+        },
+        status=200
+    )
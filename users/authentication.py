@@ -0,0 +1,186 @@
+"""
+JWT authentication without a database round trip per request.
+
+simplejwt's JWTAuthentication verifies the token signature and then loads
+the User row for every request. ClaimsJWTAuthentication stops after the
+signature: request.user is a TokenUser built from the token's claims
+(user id, is_staff), which is all the API's permission checks read. It is
+opted into by the views machine clients call at volume (gate captures,
+the mobile app's wallet and vehicles); every other view uses
+RevocableJWTAuthentication, which loads the User and rejects inactive
+ones.
+
+Logging out has to keep working without that query, so revoked tokens
+are stored as RevokedToken rows and every process keeps their jtis in
+memory (RevocationList). The set is loaded once and then refreshed every
+REVOCATION_REFRESH_INTERVAL seconds with only the rows revoked since the
+last refresh; entries are dropped once their token has expired anyway,
+so the set stays as small as the number of live revoked tokens. A token
+revoked in one process is rejected there at once and by the others
+within one refresh interval.
+
+Access tokens carry the jti of the refresh token they came from as
+their "sid" claim, so revoking a refresh token also revokes every access
+token minted from it.
+
+The claims of a token are only as current as its issue time. Deleting a
+user, deactivating one, or changing is_staff or is_superuser therefore
+revokes every token the user was issued until then (users/signals.py): a
+RevokedToken row with the jti "user:<id>" whose revoked_at is the cutoff.
+
+Usage:
+    refresh = issue_tokens(user)
+    revocations.revoke(refresh)
+    revocations.revoke_user(user.pk)
+"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.authentication import SessionAuthentication
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import RevokedToken
+
+
+SESSION_CLAIM = 'sid'
+USER_PREFIX = 'user:'
+
+# Rows are fetched from a little before the previous refresh, so one
+# committed late (revoked_at is set before the commit) is not missed
+REFRESH_OVERLAP = timedelta(seconds=60)
+
+
+def issue_tokens(user):
+    """RefreshToken for user, with the claims ClaimsJWTAuthentication needs"""
+    refresh = RefreshToken.for_user(user)
+    refresh['is_staff'] = user.is_staff
+    refresh['is_superuser'] = user.is_superuser
+    # Copied into every access token made from this refresh token
+    refresh[SESSION_CLAIM] = refresh[api_settings.JTI_CLAIM]
+    return refresh
+
+
+class RevocationList:
+    """In-memory set of revoked jtis, refreshed incrementally from RevokedToken"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expiry = {}            # jti -> expiry as a unix timestamp
+        self._cutoffs = {}           # user id -> (tokens issued up to here are revoked, expiry)
+        self._since = None           # revoked_at covered by the last refresh
+        self._next_refresh = 0.0     # time.monotonic() deadline
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def is_revoked(self, jti):
+        self._refresh_if_due()
+        return jti in self._expiry
+
+    def is_user_revoked(self, user_id, issued_at):
+        """Whether tokens of user_id issued at issued_at (a unix timestamp) were revoked with the user"""
+        self._refresh_if_due()
+        cutoff = self._cutoffs.get(str(user_id))
+        return cutoff is not None and issued_at <= cutoff[0]
+
+    def refresh(self):
+        """Load revocations made since the last refresh (all live ones the first time)"""
+        with self._lock:
+            self._load()
+
+    def _refresh_if_due(self):
+        if time.monotonic() >= self._next_refresh:
+            with self._lock:
+                # Another thread may have refreshed while this one waited
+                if time.monotonic() >= self._next_refresh:
+                    self._load()
+
+    def _load(self):
+        started = timezone.now()
+        rows = RevokedToken.objects.all()
+        if self._since is None:
+            rows = rows.filter(expires_at__gt=started)
+        else:
+            rows = rows.filter(revoked_at__gte=self._since - REFRESH_OVERLAP)
+        expiry = dict(self._expiry)
+        cutoffs = dict(self._cutoffs)
+        for jti, expires_at, revoked_at in rows.values_list('jti', 'expires_at', 'revoked_at'):
+            if jti.startswith(USER_PREFIX):
+                cutoffs[jti[len(USER_PREFIX):]] = (revoked_at.timestamp(), expires_at.timestamp())
+            else:
+                expiry[jti] = expires_at.timestamp()
+        now = time.time()
+        # Readers never take the lock, so the dicts are replaced rather than changed
+        self._expiry = {jti: expires for jti, expires in expiry.items() if expires > now}
+        self._cutoffs = {user_id: cutoff for user_id, cutoff in cutoffs.items() if cutoff[1] > now}
+        self._since = started
+        self._next_refresh = time.monotonic() + settings.REVOCATION_REFRESH_INTERVAL
+
+    def revoke(self, token, user_id=None):
+        """Store token's revocation and apply it in this process right away"""
+        jti = token[api_settings.JTI_CLAIM]
+        expires_at = datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+        RevokedToken.objects.get_or_create(jti=jti, defaults={'user_id': user_id, 'expires_at': expires_at})
+        with self._lock:
+            self._expiry = {**self._expiry, jti: expires_at.timestamp()}
+
+    def revoke_user(self, user_id, exists=True):
+        """Revoke every token issued to user_id until now, and apply it in this process right away"""
+        revoked_at = timezone.now()
+        # No token issued until now outlives the longest lifetime
+        expires_at = revoked_at + max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+        RevokedToken.objects.update_or_create(
+            jti=f"{USER_PREFIX}{user_id}",
+            defaults={'user_id': user_id if exists else None, 'expires_at': expires_at, 'revoked_at': revoked_at}
+        )
+        with self._lock:
+            self._cutoffs = {**self._cutoffs, str(user_id): (revoked_at.timestamp(), expires_at.timestamp())}
+
+    def clear(self):
+        """Forget everything; the next check reloads from the database"""
+        with self._lock:
+            self._expiry = {}
+            self._cutoffs = {}
+            self._since = None
+            self._next_refresh = 0.0
+
+
+revocations = RevocationList()
+
+
+def is_revoked(token):
+    """Whether token, the refresh token it was minted from, or its user's tokens have been revoked"""
+    if revocations.is_revoked(token.get(api_settings.JTI_CLAIM)):
+        return True
+    session = token.get(SESSION_CLAIM)
+    if session is not None and revocations.is_revoked(session):
+        return True
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    return user_id is not None and revocations.is_user_revoked(user_id, token.get('iat', 0))
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    """simplejwt's JWTAuthentication (User loaded from the database) that rejects revoked tokens"""
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if is_revoked(token):
+            raise InvalidToken({"detail": "Token has been revoked", "code": "token_revoked"})
+        return token
+
+
+class ClaimsJWTAuthentication(RevocableJWTAuthentication, JWTStatelessUserAuthentication):
+    """Signature, expiry and revocation checks only: request.user is a TokenUser, no query.
+
+    For the machine-client views only; set as their authentication_classes.
+    """
+
+
+# authentication_classes of the views gates and the mobile app call
+MACHINE_CLIENT_AUTHENTICATION = [ClaimsJWTAuthentication, SessionAuthentication]
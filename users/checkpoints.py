@@ -0,0 +1,167 @@
+"""
+Wallet balance verification against the transaction ledger.
+
+Transaction rows are the append-only ledger: top-ups add to a wallet and
+toll charges take from it. Replaying a wallet's whole history to check
+Wallet.wallet_balance gets slower every day, so verified balances are
+stored as WalletCheckpoint rows and a wallet is checked as
+
+    ledger balance = latest checkpoint + signed transactions after it
+
+which only reads the transactions since the last audit.
+
+A wallet's stored balance is its wallet_balance plus its shards' (see
+users/shards.py). Each chunk is read in one statement, so the stored
+balance and the ledger tail come from the same snapshot even while
+captures keep running.
+
+Transaction ids are the checkpoint watermark, but debits of different
+shards do not wait for each other, so a wallet's transactions can commit
+out of id order. A checkpoint therefore only covers the transactions
+before the wallet's first one from the last CHECKPOINT_SETTLE_SECONDS;
+anything after it is left for the next run, by which time any
+transaction with a smaller id has committed.
+"""
+from collections import namedtuple
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Wallet, WalletShard, WalletCheckpoint, Transaction
+
+
+CENT = Decimal('0.01')
+
+# Sign of each transaction type in the ledger
+SIGNS = {
+    'top-up': 1,
+    'toll-charge': -1,
+    # Spending allowances (users/allowances.py): the hold leaves the wallet,
+    # charges against it were already paid by the hold, the unused rest returns
+    'allowance-hold': -1,
+    'allowance-charge': 0,
+    'allowance-release': 1,
+}
+
+WalletAudit = namedtuple('WalletAudit', [
+    'wallet_id', 'user_id', 'stored_balance', 'ledger_balance', 'last_transaction_id',
+    'transaction_count', 'new_transactions', 'unknown_types',
+    # The part of the ledger a checkpoint may cover (see the module docstring)
+    'settled_balance', 'settled_transaction_id', 'settled_count', 'settled_transactions'
+])
+
+
+def _to_balance(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def _audit_sql():
+    quote = connection.ops.quote_name
+    wallet = quote(Wallet._meta.db_table)
+    shard = quote(WalletShard._meta.db_table)
+    checkpoint = quote(WalletCheckpoint._meta.db_table)
+    ledger = quote(Transaction._meta.db_table)
+    amounts = {1: 't.amount', -1: '-t.amount', 0: '0'}
+    signed = ' '.join(
+        f"WHEN t.transaction_type = '{kind}' THEN {amounts[sign]}" for kind, sign in SIGNS.items()
+    )
+    known = ', '.join(f"'{kind}'" for kind in SIGNS)
+    date = quote(Transaction._meta.get_field('date').column)
+    settled = "(r.first_id IS NULL OR t.id < r.first_id)"
+    return f"""
+        SELECT w.id, w.user_id, w.wallet_balance + COALESCE(s.balance, 0),
+               c.balance, c.last_transaction_id, c.transaction_count,
+               SUM(CASE {signed} ELSE 0 END),
+               COUNT(t.id),
+               SUM(CASE WHEN t.id IS NOT NULL AND t.transaction_type NOT IN ({known}) THEN 1 ELSE 0 END),
+               MAX(t.id),
+               SUM(CASE WHEN {settled} THEN CASE {signed} ELSE 0 END ELSE 0 END),
+               SUM(CASE WHEN t.id IS NOT NULL AND {settled} THEN 1 ELSE 0 END),
+               MAX(CASE WHEN {settled} THEN t.id END)
+        FROM {wallet} w
+        LEFT JOIN (
+            SELECT wallet_id, SUM(balance) AS balance FROM {shard}
+            WHERE wallet_id >= %s AND wallet_id <= %s GROUP BY wallet_id
+        ) s ON s.wallet_id = w.id
+        LEFT JOIN {checkpoint} c ON c.id = (
+            SELECT MAX(latest.id) FROM {checkpoint} latest WHERE latest.wallet_id = w.id
+        )
+        LEFT JOIN (
+            SELECT wallet_id, MIN(id) AS first_id FROM {ledger}
+            WHERE wallet_id >= %s AND wallet_id <= %s AND {date} >= %s GROUP BY wallet_id
+        ) r ON r.wallet_id = w.id
+        LEFT JOIN {ledger} t ON t.wallet_id = w.id AND t.id > COALESCE(c.last_transaction_id, 0)
+        WHERE w.id >= %s AND w.id <= %s
+        GROUP BY w.id, w.user_id, w.wallet_balance, s.balance, c.balance, c.last_transaction_id,
+                 c.transaction_count, r.first_id
+        ORDER BY w.id
+    """
+
+
+def audit(first_wallet_id, last_wallet_id):
+    """WalletAudit for every wallet with an id in [first_wallet_id, last_wallet_id]"""
+    settled_before = connection.ops.adapt_datetimefield_value(
+        timezone.now() - timedelta(seconds=settings.CHECKPOINT_SETTLE_SECONDS)
+    )
+    bounds = [first_wallet_id, last_wallet_id]
+    with connection.cursor() as cursor:
+        cursor.execute(_audit_sql(), bounds + bounds + [settled_before] + bounds)
+        rows = cursor.fetchall()
+    return [
+        WalletAudit(
+            wallet_id=wallet_id,
+            user_id=user_id,
+            stored_balance=_to_balance(stored),
+            ledger_balance=_to_balance(_to_balance(checkpoint) + _to_balance(tail)),
+            last_transaction_id=last_id or checkpoint_last_id or 0,
+            transaction_count=(checkpoint_count or 0) + new_count,
+            new_transactions=new_count,
+            unknown_types=unknown or 0,
+            settled_balance=_to_balance(_to_balance(checkpoint) + _to_balance(settled_tail)),
+            settled_transaction_id=settled_last_id or checkpoint_last_id or 0,
+            settled_count=(checkpoint_count or 0) + (settled_count or 0),
+            settled_transactions=settled_count or 0
+        )
+        for (wallet_id, user_id, stored, checkpoint, checkpoint_last_id, checkpoint_count,
+             tail, new_count, unknown, last_id, settled_tail, settled_count, settled_last_id) in rows
+    ]
+
+
+def ledger_balance(wallet_id):
+    """A wallet's balance recomputed from its latest checkpoint and the transactions after it"""
+    audits = audit(wallet_id, wallet_id)
+    return audits[0].ledger_balance if audits else None
+
+
+def checkpoint(audits):
+    """Store the settled ledger balances of audited wallets that had new transactions. Returns how many."""
+    checkpoints = [
+        WalletCheckpoint(
+            wallet_id=result.wallet_id,
+            balance=result.settled_balance,
+            last_transaction_id=result.settled_transaction_id,
+            transaction_count=result.settled_count
+        )
+        for result in audits
+        if result.settled_transactions and not result.unknown_types
+    ]
+    with transaction.atomic():
+        WalletCheckpoint.objects.bulk_create(checkpoints)
+    return len(checkpoints)
+
+
+def wallet_ranges(chunk_size):
+    """[first, last] wallet id ranges of at most chunk_size wallets, covering every wallet"""
+    last = 0
+    while True:
+        ids = list(
+            Wallet.objects.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return
+        last = ids[-1]
+        yield ids[0], last
@@ -0,0 +1,40 @@
+"""
+Wallet transaction history, newest first, one bounded page at a time.
+
+Pages are keyset-paginated on (date, id) and served from the
+(wallet, date, id) index, so a wallet with hundreds of thousands of
+transactions costs the same per page as one with ten.
+"""
+from autofare.pagination import keyset, page
+from .models import Wallet, Transaction
+from .shards import total_balance
+
+
+ORDERING = ['-date', '-id']
+
+
+def wallet(user_id):
+    """Queryset of the user's wallet as a dict of id, user_id and balance (summed over any shards)"""
+    return Wallet.objects.filter(user_id=user_id).values('id', 'user_id', balance=total_balance())
+
+
+def transactions(wallet_id, params):
+    """Queryset of the next page (plus one row) for validated WalletHistoryQuerySerializer data.
+
+    Raises ValueError for a cursor that was not issued by this endpoint.
+    """
+    queryset = Transaction.objects.filter(wallet_id=wallet_id)
+    if params.get('type'):
+        queryset = queryset.filter(transaction_type=params['type'])
+    if params.get('since'):
+        queryset = queryset.filter(date__gte=params['since'])
+    if params.get('until'):
+        queryset = queryset.filter(date__lt=params['until'])
+    rows = queryset.values('id', 'transaction_id', 'amount', 'transaction_type', 'date')
+    return keyset(rows, ORDERING, params.get('cursor'))[:params['limit'] + 1]
+
+
+def with_page(wallet, rows, params):
+    """Wallet dict ready for WalletSerializer, with the page and the next cursor added"""
+    rows, next_cursor = page(rows, ORDERING, params['limit'])
+    return dict(wallet, transactions=rows, next_cursor=next_cursor)
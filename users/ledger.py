@@ -0,0 +1,151 @@
+"""
+Wallet balance changes done as single conditional UPDATE statements.
+
+A debit is one ``UPDATE ... SET balance = balance - x WHERE balance >= x``,
+so concurrent captures on the same wallet never lose updates and never
+hold a row lock across a Python round trip. Where the database supports
+``UPDATE ... RETURNING`` (PostgreSQL, SQLite 3.35+) the new balance comes
+back from the same statement.
+
+A wallet split into shards (users/shards.py) is debited from its own row
+first and, when that is short, from one of its shards that holds enough,
+starting from a random one so parallel captures spread over the rows.
+"""
+import random
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import F
+
+from autofare import ids, metrics
+from .models import Wallet, WalletShard, Transaction
+
+
+CENT = Decimal('0.01')
+
+
+def _supports_update_returning():
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.features.can_return_columns_from_insert
+
+
+def _to_balance(value):
+    return Decimal(str(value)).quantize(CENT)
+
+
+def _apply(model, field, filters, delta, require_funds):
+    """Add delta to model.field in the row matching filters; the new value, or None if no row matched"""
+    table = connection.ops.quote_name(model._meta.db_table)
+    balance = connection.ops.quote_name(model._meta.get_field(field).column)
+    where = ' AND '.join(
+        f"{connection.ops.quote_name(model._meta.get_field(name).column)} = %s" for name in filters
+    )
+    sql = f"UPDATE {table} SET {balance} = ROUND({balance} + %s, 2) WHERE {where}"
+    params = [delta, *filters.values()]
+    if require_funds:
+        sql += f" AND {balance} >= %s"
+        params.append(-delta)
+    with connection.cursor() as cursor:
+        cursor.execute(sql + f" RETURNING {balance}", params)
+        row = cursor.fetchone()
+    return _to_balance(row[0]) if row else None
+
+
+def _apply_without_returning(model, field, filters, delta, require_funds):
+    rows = model.objects.filter(**filters)
+    if require_funds:
+        rows = rows.filter(**{f"{field}__gte": -delta})
+    with transaction.atomic():
+        if not rows.update(**{field: F(field) + delta}):
+            return None
+        return model.objects.filter(**filters).values_list(field, flat=True).get()
+
+
+def _change(model, field, filters, delta, require_funds):
+    if _supports_update_returning():
+        return _apply(model, field, filters, delta, require_funds)
+    return _apply_without_returning(model, field, filters, delta, require_funds)
+
+
+def _debit_shards(wallet_id, amount):
+    shards = dict(WalletShard.objects.filter(wallet_id=wallet_id).values_list('number', 'balance'))
+    numbers = [number for number, balance in shards.items() if balance >= amount]
+    random.shuffle(numbers)
+    # Another capture may empty a shard between the read and its update, so try the next
+    for number in numbers:
+        filters = {'wallet_id': wallet_id, 'number': number}
+        new_balance = _change(WalletShard, 'balance', filters, -amount, require_funds=True)
+        if new_balance is not None:
+            return new_balance, True
+    return None, bool(shards)
+
+
+def debit_shard(wallet_id, amount):
+    """Take amount from one of a wallet's shards that holds enough, starting from a random one.
+
+    Returns that shard's new balance, or None when no shard can cover the amount.
+    """
+    return _debit_shards(wallet_id, Decimal(amount))[0]
+
+
+def _debit_across(wallet_id, amount):
+    # Rare: the funds are spread too thin for any one row, so lock them all
+    with transaction.atomic():
+        wallet = Wallet.objects.select_for_update().filter(pk=wallet_id).first()
+        if wallet is None:
+            return None
+        shards = list(WalletShard.objects.select_for_update().filter(wallet_id=wallet_id).order_by('number'))
+        balances = [_to_balance(wallet.wallet_balance)] + [_to_balance(shard.balance) for shard in shards]
+        total = sum(balances, Decimal('0.00'))
+        if total < amount:
+            return None
+        remaining = amount
+        for row, field in [(wallet, 'wallet_balance')] + [(shard, 'balance') for shard in shards]:
+            taken = min(_to_balance(getattr(row, field)), remaining)
+            if taken > 0:
+                setattr(row, field, _to_balance(getattr(row, field)) - taken)
+                row.save(update_fields=[field])
+                remaining -= taken
+        return total - amount
+
+
+def debit(wallet_id, amount):
+    """Take amount from a wallet, or failing that its shards, if it holds enough funds.
+
+    Returns the new balance of the row that was debited (the wallet's total
+    when taken across several), or None when the wallet is missing or
+    short of funds.
+    """
+    amount = Decimal(amount)
+    new_balance = _change(Wallet, 'wallet_balance', {'id': wallet_id}, -amount, require_funds=True)
+    if new_balance is not None:
+        return new_balance
+    new_balance, sharded = _debit_shards(wallet_id, amount)
+    if new_balance is None and sharded:
+        # No single row holds enough, but the wallet and its shards together may
+        new_balance = _debit_across(wallet_id, amount)
+    return new_balance
+
+
+def credit(wallet_id, amount):
+    """Add amount to a wallet. Returns the new balance, or None when the wallet is missing."""
+    amount = Decimal(amount)
+    return _change(Wallet, 'wallet_balance', {'id': wallet_id}, amount, require_funds=False)
+
+
+def top_up(wallet_id, amount):
+    """Credit a wallet and record the top-up. Returns the new balance, or None when the wallet is missing."""
+    with transaction.atomic():
+        new_balance = credit(wallet_id, amount)
+        if new_balance is None:
+            return None
+        Transaction.objects.create(
+            wallet_id=wallet_id,
+            transaction_id=ids.transaction_id(),
+            transaction_type="top-up",
+            amount=amount
+        )
+    metrics.topups.inc()
+    metrics.topup_amount.inc(float(amount))
+    return new_balance
@@ -0,0 +1,72 @@
+"""
+Per-request cost of JWT authentication, with and without the User query.
+
+Usage: python manage.py bench_auth --requests 5000
+
+Authenticates the same Bearer access token repeatedly with simplejwt's
+JWTAuthentication (signature check plus a User lookup), with
+RevocableJWTAuthentication (the same plus the revocation check) and with
+ClaimsJWTAuthentication (signature and revocation checks only), and
+reports the time and queries per request of each.
+"""
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from autofare.middleware import QueryRecorder
+from users.authentication import ClaimsJWTAuthentication, RevocableJWTAuthentication, issue_tokens
+
+
+AUTHENTICATORS = [
+    ('db user', JWTAuthentication),
+    ('db user + revocation', RevocableJWTAuthentication),
+    ('claims only', ClaimsJWTAuthentication),
+]
+
+
+class Command(BaseCommand):
+    help = "Compare JWT authentication cost with and without loading the User"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        if count < 1:
+            raise CommandError("--requests must be at least 1")
+
+        user = User.objects.create_user(username=f"bench-{uuid.uuid4().hex[:12]}")
+        try:
+            access = str(issue_tokens(user).access_token)
+            request = Request(APIRequestFactory().get('/', HTTP_AUTHORIZATION=f"Bearer {access}"))
+            results = {}
+            for name, authentication_class in AUTHENTICATORS:
+                authenticator = authentication_class()
+                # Warm up caches (revocation list load, key setup) outside the timing
+                authenticator.authenticate(request)
+                queries = QueryRecorder()
+                with connection.execute_wrapper(queries):
+                    started = time.perf_counter()
+                    for _ in range(count):
+                        authenticated = authenticator.authenticate(request)
+                    elapsed = time.perf_counter() - started
+                if authenticated is None or str(authenticated[0].pk) != str(user.pk):
+                    raise CommandError(f"{name} did not authenticate the benchmark user")
+                results[name] = (elapsed / count * 1e6, queries.count / count)
+        finally:
+            user.delete()
+
+        self.stdout.write(f"requests:        {count}")
+        for name, (micros, queries) in results.items():
+            self.stdout.write(f"{name + ':':<24} {micros:8.1f} us/request  {queries:.2f} queries/request")
+        baseline = results['db user'][0]
+        claims = results['claims only'][0]
+        self.stdout.write(
+            f"claims only saves {baseline - claims:.1f} us/request ({(1 - claims / baseline) * 100:.0f}%)"
+        )
@@ -0,0 +1,115 @@
+"""
+Contention benchmark for wallet debits on a single hot wallet.
+
+Usage: python manage.py bench_wallet_contention --threads 8 --captures 200
+       python manage.py bench_wallet_contention --threads 8 --shards 8
+
+Every thread runs captures (a debit plus its Transaction row) against the
+same wallet. At the end the wallet balance must equal the starting balance
+minus everything that was charged; any difference is a lost update and
+fails the command. Pass --naive to run the old read-modify-write pattern
+for comparison, or --shards K to split the wallet into K shards first
+(users/shards.py) and see how throughput scales with K.
+"""
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
+
+from autofare import ids
+from users import ledger, shards
+from users.models import Wallet, WalletShard, Transaction
+
+
+class Command(BaseCommand):
+    help = "Measure captures per second on one hot wallet and check for lost updates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--captures', type=int, default=200, help="Captures per thread")
+        parser.add_argument('--amount', type=Decimal, default=Decimal('5.50'))
+        parser.add_argument('--naive', action='store_true', help="Use read-modify-write instead of the ledger")
+        parser.add_argument('--shards', type=int, default=0, help="Split the wallet into this many shards")
+
+    def handle(self, *args, **options):
+        threads = options['threads']
+        per_thread = options['captures']
+        amount = options['amount']
+        start_balance = amount * threads * per_thread
+
+        user = User.objects.create_user(username=f"bench-{uuid.uuid4().hex[:12]}")
+        wallet = Wallet.objects.create(user=user, wallet_balance=start_balance)
+        if options['shards']:
+            shards.resize(wallet.pk, options['shards'])
+        capture = self._naive_capture if options['naive'] else self._ledger_capture
+        charged = [0] * threads
+        errors = [0] * threads
+
+        def worker(index):
+            try:
+                for _ in range(per_thread):
+                    try:
+                        if capture(wallet.pk, amount):
+                            charged[index] += 1
+                    except OperationalError:
+                        # SQLite reports writer contention as "database is locked"
+                        errors[index] += 1
+            finally:
+                connection.close()
+
+        try:
+            pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+            started = time.perf_counter()
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            final_balance = Wallet.objects.values_list('wallet_balance', flat=True).get(pk=wallet.pk)
+            final_balance += sum(WalletShard.objects.filter(wallet=wallet).values_list('balance', flat=True))
+            expected = start_balance - amount * sum(charged)
+            rate = sum(charged) / elapsed if elapsed else 0.0
+
+            self.stdout.write(f"mode:            {'naive' if options['naive'] else 'ledger'}")
+            self.stdout.write(f"shards:          {options['shards']}")
+            self.stdout.write(f"threads:         {threads}")
+            self.stdout.write(f"captures:        {sum(charged)} charged, {sum(errors)} failed")
+            self.stdout.write(f"elapsed:         {elapsed:.3f}s")
+            self.stdout.write(f"throughput:      {rate:.1f} captures/s")
+            self.stdout.write(f"final balance:   {final_balance} (expected {expected})")
+        finally:
+            user.delete()
+
+        if final_balance != expected:
+            raise CommandError(f"Lost updates: balance is off by {final_balance - expected}")
+        self.stdout.write(self.style.SUCCESS("No lost updates"))
+
+    def _ledger_capture(self, wallet_id, amount):
+        with transaction.atomic():
+            if ledger.debit(wallet_id, amount) is None:
+                return False
+            self._record(wallet_id, amount)
+        return True
+
+    def _naive_capture(self, wallet_id, amount):
+        with transaction.atomic():
+            wallet = Wallet.objects.get(pk=wallet_id)
+            if wallet.wallet_balance < amount:
+                return False
+            wallet.wallet_balance -= amount
+            wallet.save(update_fields=['wallet_balance'])
+            self._record(wallet_id, amount)
+        return True
+
+    def _record(self, wallet_id, amount):
+        Transaction.objects.create(
+            wallet_id=wallet_id,
+            transaction_id=ids.transaction_id(),
+            transaction_type="toll-charge",
+            amount=amount
+        )
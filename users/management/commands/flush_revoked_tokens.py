@@ -0,0 +1,21 @@
+"""
+Delete revoked-token rows whose tokens have expired anyway.
+
+Usage: python manage.py flush_revoked_tokens
+
+An expired token is rejected by its signature check, so its RevokedToken
+row no longer does anything. Running this daily keeps the table (and the
+first load of every process's revocation list) small.
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = "Delete revoked JWTs that have expired"
+
+    def handle(self, *args, **options):
+        deleted, _ = RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+        self.stdout.write(f"Deleted {deleted} expired revoked tokens")
@@ -0,0 +1,60 @@
+"""
+Bulk onboard users and vehicles from a CSV or NDJSON file.
+
+Usage:
+    python manage.py import_users fleet.csv
+    python manage.py import_users fleet.ndjson --report errors.ndjson --chunk-size 10000
+
+Columns: name,email,phone,national_id,user_id,license_plate,vehicle_type,model,color
+(see users/onboarding.py). Rejected rows are written as NDJSON to --report,
+or to stdout.
+"""
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.onboarding import CHUNK_SIZE, Importer, read_csv, read_ndjson
+
+
+class Command(BaseCommand):
+    help = "Bulk import users, profiles, wallets and vehicles from CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--input-format', choices=['csv', 'ndjson'],
+                            help="Defaults to the file extension (.csv, .ndjson or .jsonl)")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--report', help="Write rejected rows here instead of stdout")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        kind = options['input_format']
+        if kind is None:
+            if path.endswith('.csv'):
+                kind = 'csv'
+            elif path.endswith(('.ndjson', '.jsonl')):
+                kind = 'ndjson'
+            else:
+                raise CommandError("Cannot tell the format from the file name; pass --input-format")
+
+        started = time.perf_counter()
+        importer = Importer(chunk_size=options['chunk_size'])
+        report = open(options['report'], 'w') if options['report'] else sys.stdout
+        try:
+            with open(path, newline='', encoding='utf-8') as source:
+                rows = read_csv(source) if kind == 'csv' else read_ndjson(source)
+                for entries in importer.run(rows):
+                    for entry in entries:
+                        if 'summary' not in entry:
+                            report.write(json.dumps(entry) + '\n')
+        finally:
+            if report is not sys.stdout:
+                report.close()
+
+        counts = importer.counts
+        self.stdout.write(
+            f"{counts['rows']} rows: {counts['users_created']} users and {counts['vehicles_created']} "
+            f"vehicles created, {counts['errors']} rows rejected in {time.perf_counter() - started:.1f}s"
+        )
@@ -0,0 +1,41 @@
+"""
+Background rebalancer for sharded wallets.
+
+Usage: python manage.py rebalance_wallet_shards --interval 5
+       python manage.py rebalance_wallet_shards --once
+
+Every interval, wallets whose reserve holds funds (top-ups land there) or
+with a shard below --tolerance of its even share are spread evenly over
+their shards again, so captures keep finding a shard that can pay.
+"""
+import threading
+
+from django.core.management.base import BaseCommand
+
+from users import shards
+
+
+class Command(BaseCommand):
+    help = "Move funds between wallet shards so each holds an even share"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds between passes")
+        parser.add_argument('--tolerance', type=float, default=shards.DEFAULT_TOLERANCE,
+                            help="Rebalance when a shard holds less than this fraction of its even share")
+        parser.add_argument('--once', action='store_true', help="Make one pass and exit")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        passes = 0
+        moved = 0
+        try:
+            while not stop.is_set():
+                for wallet_id in shards.unbalanced(options['tolerance']):
+                    moved += shards.rebalance(wallet_id)
+                passes += 1
+                if options['once']:
+                    break
+                stop.wait(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Rebalanced {moved} wallets in {passes} passes")
@@ -0,0 +1,42 @@
+"""
+Periodic reconciliation of gate-local spending allowances.
+
+Usage: python manage.py reconcile_allowances --interval 30
+       python manage.py reconcile_allowances --once
+
+Each pass stores what every open allowance has charged so far, and closes
+the ones that expired more than ALLOWANCE_CLOSE_GRACE seconds ago,
+crediting their unspent amount back to the wallet. Allowances left behind
+by a crashed process are closed the same way.
+"""
+import threading
+
+from django.core.management.base import BaseCommand
+
+from users import allowances
+
+
+class Command(BaseCommand):
+    help = "Record spending allowance usage and return the unspent part of expired allowances"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=30.0, help="Seconds between passes")
+        parser.add_argument('--once', action='store_true', help="Make one pass and exit")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        totals = [0, 0, 0]
+        try:
+            while not stop.is_set():
+                updated, closed, returned = allowances.reconcile()
+                totals[0] += updated
+                totals[1] += closed
+                totals[2] += returned
+                if options['once']:
+                    break
+                stop.wait(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(
+            f"Updated {totals[0]} open allowances, closed {totals[1]} and returned {totals[2]:.2f} to wallets"
+        )
@@ -0,0 +1,96 @@
+"""
+Verify every wallet balance against the transaction ledger and checkpoint it.
+
+Usage:
+    python manage.py reconcile_wallets
+    python manage.py reconcile_wallets --workers 8 --chunk-size 2000
+    python manage.py reconcile_wallets --verify-only --fail-on-drift
+
+Wallets are checked in id-range chunks by a pool of workers. Each wallet's
+ledger balance is its latest checkpoint plus the transactions since, so a
+nightly run reads only the day's transactions. Wallets whose stored
+balance (including its shards) differs from the ledger are reported as
+drift. Unless --verify-only is given, the ledger balance of every wallet
+with new transactions is stored as a new checkpoint, up to its
+transactions of the last CHECKPOINT_SETTLE_SECONDS.
+"""
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from users.checkpoints import audit, checkpoint, wallet_ranges
+
+
+class Command(BaseCommand):
+    help = "Reconcile wallet balances with the transaction ledger and write balance checkpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Wallets per chunk")
+        parser.add_argument('--verify-only', action='store_true', help="Report drift without writing checkpoints")
+        parser.add_argument('--show', type=int, default=20, help="Drifted wallets to list")
+        parser.add_argument('--fail-on-drift', action='store_true', help="Exit with an error when any wallet drifted")
+
+    def handle(self, *args, **options):
+        ranges = wallet_ranges(options['chunk_size'])
+        lock = threading.Lock()
+        totals = {"wallets": 0, "transactions": 0, "checkpoints": 0, "unknown": 0}
+        drifted = []
+        errors = []
+
+        def next_range():
+            with lock:
+                return next(ranges, None)
+
+        def worker():
+            try:
+                while True:
+                    bounds = next_range()
+                    if bounds is None:
+                        return
+                    audits = audit(*bounds)
+                    written = 0 if options['verify_only'] else checkpoint(audits)
+                    with lock:
+                        totals["wallets"] += len(audits)
+                        totals["transactions"] += sum(result.new_transactions for result in audits)
+                        totals["checkpoints"] += written
+                        totals["unknown"] += sum(1 for result in audits if result.unknown_types)
+                        drifted.extend(
+                            result for result in audits if result.stored_balance != result.ledger_balance
+                        )
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, daemon=True) for _ in range(options['workers'])]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        if errors:
+            raise errors[0]
+
+        drifted.sort(key=lambda result: abs(result.stored_balance - result.ledger_balance), reverse=True)
+        total_drift = sum((result.stored_balance - result.ledger_balance for result in drifted), Decimal('0.00'))
+        self.stdout.write(
+            f"Checked {totals['wallets']} wallets ({totals['transactions']} transactions since their "
+            f"last checkpoint) in {elapsed:.2f}s; wrote {totals['checkpoints']} checkpoints"
+        )
+        if totals['unknown']:
+            self.stdout.write(
+                f"{totals['unknown']} wallets have transactions of unknown type and were not checkpointed"
+            )
+        self.stdout.write(f"{len(drifted)} wallets drifted, net {total_drift:+}")
+        for result in drifted[:options['show']]:
+            self.stdout.write(
+                f"  wallet {result.wallet_id} (user {result.user_id}): stored {result.stored_balance}, "
+                f"ledger {result.ledger_balance}, drift {result.stored_balance - result.ledger_balance:+}"
+            )
+        if drifted and options['fail_on_drift']:
+            raise CommandError(f"{len(drifted)} wallets drifted from the ledger")
@@ -0,0 +1,30 @@
+"""
+Split a fleet's wallet into shards, or merge them back.
+
+Usage:
+    python manage.py shard_wallet 42 --shards 8
+    python manage.py shard_wallet 42 --shards 0
+
+The wallet's balance is spread evenly over the shards; see users/shards.py.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from users import shards
+from users.models import Wallet
+
+
+class Command(BaseCommand):
+    help = "Split a user's wallet into shards so parallel captures do not queue on one row"
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_id', type=int)
+        parser.add_argument('--shards', type=int, required=True, help="Number of shards, 0 to merge them back")
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError("--shards cannot be negative")
+        wallet_id = Wallet.objects.filter(user_id=options['user_id']).values_list('id', flat=True).first()
+        if wallet_id is None:
+            raise CommandError(f"User {options['user_id']} has no wallet")
+        shards.resize(wallet_id, options['shards'])
+        self.stdout.write(f"Wallet {wallet_id} now has {options['shards']} shards")
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_alter_userprofile_national_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'date', 'id'], name='transaction_wallet_date_idx'),
+        ),
+    ]
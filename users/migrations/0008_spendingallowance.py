@@ -0,0 +1,37 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_walletshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendingAllowance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gate_id', models.CharField(max_length=50)),
+                ('holder', models.CharField(max_length=100)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('spent', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allowances', to='users.wallet')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='allowance',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='users.spendingallowance'),
+        ),
+        migrations.AddConstraint(
+            model_name='spendingallowance',
+            constraint=models.UniqueConstraint(condition=models.Q(('closed_at__isnull', True)), fields=('wallet', 'gate_id', 'holder'), name='spendingallowance_open_uniq'),
+        ),
+    ]
@@ -19,4 +19,77 @@ class Transaction(models.Model):
     transaction_type = models.CharField(max_length=50) 
     visa_type = models.CharField(max_length=50, blank=True, null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    date = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    date = models.DateTimeField(auto_now_add=True)
+    # Set on the hold, charges and release of a spending allowance
+    allowance = models.ForeignKey(
+        'SpendingAllowance', null=True, blank=True, on_delete=models.SET_NULL, related_name='transactions'
+    )
+    class Meta:
+        indexes = [
+            # Wallet history, newest first, paged by (date, id)
+            models.Index(fields=['wallet', 'date', 'id'], name='transaction_wallet_date_idx'),
+        ]
+
+
+class WalletShard(models.Model):
+    """Part of a wallet's balance that captures can debit without touching the Wallet row.
+
+    A sharded wallet's balance is its own wallet_balance (the reserve that
+    top-ups go to) plus the balances of its shards; see users/shards.py.
+    """
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='shards')
+    number = models.PositiveSmallIntegerField()
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['wallet', 'number'], name='walletshard_wallet_number_uniq'),
+        ]
+
+
+class SpendingAllowance(models.Model):
+    """Funds held from a wallet for one gate, spent in memory by one process (the holder).
+
+    The amount leaves the wallet when the allowance is granted and what was
+    not spent goes back when it is closed after expiring; see
+    users/allowances.py.
+    """
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='allowances')
+    gate_id = models.CharField(max_length=50)
+    holder = models.CharField(max_length=100)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    spent = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    expires_at = models.DateTimeField(db_index=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['wallet', 'gate_id', 'holder'], condition=models.Q(closed_at__isnull=True),
+                name='spendingallowance_open_uniq'
+            ),
+        ]
+
+
+class WalletCheckpoint(models.Model):
+    """Verified ledger balance of a wallet up to and including one transaction.
+
+    Transactions are the append-only ledger; a wallet's balance is its
+    latest checkpoint plus the signed amounts of the transactions after
+    last_transaction_id. Checkpoints are only ever inserted.
+    """
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='checkpoints')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    last_transaction_id = models.BigIntegerField()
+    transaction_count = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class RevokedToken(models.Model):
+    """A JWT (by its jti claim) that must no longer be accepted, e.g. after logout.
+
+    Kept until the token would have expired anyway; see users/authentication.py.
+    """
+    jti = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name='revoked_tokens')
+    expires_at = models.DateTimeField(db_index=True)
+    revoked_at = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,253 @@
+"""
+Bulk onboarding of users and vehicles from CSV or NDJSON.
+
+Every row describes a user, a vehicle, or both:
+
+    name,email,phone,national_id,user_id,license_plate,vehicle_type,model,color
+
+A row with an email creates that user (with profile and wallet) the first
+time the email appears in the import; later rows with the same email add
+vehicles to the same user. A row with a user_id instead adds a vehicle to
+an existing user.
+
+Rows are handled in chunks. Each chunk is checked for uniqueness of email,
+national_id and license_plate against the database with one query per
+field, and against the rest of the import in memory. Its users, profiles,
+wallets and vehicles are then written with bulk inserts in one
+transaction (users with bulk_create, the rest with autofare.bulk
+executemany inserts). Importer.run yields the report as it goes: one
+entry per rejected row, then a summary, so a caller can stream it back.
+
+Usage:
+    importer = Importer()
+    for entries in importer.run(read_csv(stream)):
+        ...
+"""
+import codecs
+import csv
+import json
+import secrets
+from decimal import Decimal
+
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from autofare.bulk import insert_rows
+from vehicles.models import Vehicle
+from vehicles.plate_filter import plate_filter
+from vehicles.plates import normalize_plate
+from .models import UserProfile, Wallet
+
+
+FIELDS = ['name', 'email', 'phone', 'national_id', 'user_id', 'license_plate', 'vehicle_type', 'model', 'color']
+MAX_LENGTHS = {
+    # The email is also the username, which is shorter than an email may be
+    'name': 100, 'email': User._meta.get_field('username').max_length, 'phone': 20, 'national_id': 50,
+    'license_plate': 20, 'vehicle_type': 20, 'model': 50, 'color': 20,
+}
+VEHICLE_TYPES = {value for value, _ in Vehicle.VEHICLE_TYPES}
+CHUNK_SIZE = 5000
+ZERO = Decimal('0.00')
+
+
+def text_stream(stream, encoding='utf-8'):
+    """Decode a binary file-like object (upload, request body) line by line"""
+    return codecs.getreader(encoding)(stream)
+
+
+def read_csv(stream):
+    """Yield (row number, row dict or None, parse error) from CSV text with a header line"""
+    for number, row in enumerate(csv.DictReader(stream), start=1):
+        if None in row:
+            yield number, None, "Row has more columns than the header"
+            continue
+        yield number, row, None
+
+
+def read_ndjson(stream):
+    """Yield (row number, row dict or None, parse error) from one JSON object per line"""
+    number = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "Expected a JSON object"
+            continue
+        yield number, row, None
+
+
+class Importer:
+    """Validate and bulk insert rows in chunks, yielding the report as it goes"""
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.user_by_email = {}      # email -> id of the user this import created
+        self.failed_emails = {}      # email -> row that should have created the user
+        self.plates = set()
+        self.national_ids = set()
+        self.counts = {"rows": 0, "users_created": 0, "vehicles_created": 0, "errors": 0}
+
+    def run(self, rows):
+        """Yield lists of report entries: rejected rows per chunk, then [{"summary": ...}]"""
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield self._import(chunk)
+                chunk = []
+        if chunk:
+            yield self._import(chunk)
+        yield [{"summary": self.counts}]
+
+    def _clean(self, row):
+        data = {}
+        errors = {}
+        for field in FIELDS:
+            value = row.get(field)
+            value = str(value).strip() if value is not None else ''
+            if field in MAX_LENGTHS and len(value) > MAX_LENGTHS[field]:
+                errors[field] = [f"Ensure this field has no more than {MAX_LENGTHS[field]} characters."]
+            data[field] = value or None
+
+        if data['user_id'] is not None:
+            if not data['user_id'].isdigit():
+                errors['user_id'] = ["A valid integer is required."]
+            if data['license_plate'] is None:
+                errors['license_plate'] = ["Required when user_id is given."]
+        else:
+            for field in ('name', 'email', 'phone'):
+                if data[field] is None:
+                    errors[field] = ["This field is required."]
+            if data['email'] is not None and 'email' not in errors:
+                try:
+                    validate_email(data['email'])
+                except ValidationError:
+                    errors['email'] = ["Enter a valid email address."]
+
+        if data['license_plate'] is not None:
+            if data['vehicle_type'] not in VEHICLE_TYPES:
+                errors['vehicle_type'] = [f"\"{data['vehicle_type'] or ''}\" is not a valid choice."]
+            if data['model'] is None:
+                errors['model'] = ["This field is required."]
+        return data, errors
+
+    def _import(self, chunk):
+        report = []
+        rows = []
+        for number, row, error in chunk:
+            self.counts["rows"] += 1
+            if error is not None:
+                report.append({"row": number, "errors": {"non_field_errors": [error]}})
+                continue
+            data, errors = self._clean(row)
+            if errors:
+                report.append({"row": number, "errors": errors})
+            else:
+                rows.append((number, data))
+
+        # One query per unique field for the whole chunk
+        emails = {data['email'] for _, data in rows if data['user_id'] is None}
+        emails -= self.user_by_email.keys()
+        taken_emails = set(User.objects.filter(username__in=emails).values_list('username', flat=True))
+        taken_emails |= set(UserProfile.objects.filter(email__in=emails).values_list('email', flat=True))
+        national_ids = {data['national_id'] for _, data in rows if data['national_id']}
+        taken_national_ids = set(
+            UserProfile.objects.filter(national_id__in=national_ids).values_list('national_id', flat=True)
+        )
+        plates = {data['license_plate'] for _, data in rows if data['license_plate']}
+        taken_plates = set(Vehicle.objects.filter(license_plate__in=plates).values_list('license_plate', flat=True))
+        user_ids = {int(data['user_id']) for _, data in rows if data['user_id']}
+        known_user_ids = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+        new_users = {}   # email -> (row number, data) of the row creating the user
+        vehicles = []    # (row number, data, owner: user id or email of a new user)
+        for number, data in rows:
+            errors = {}
+            email = data['email']
+            owner = email
+            creates_user = False
+            if data['user_id'] is not None:
+                owner = int(data['user_id'])
+                if owner not in known_user_ids:
+                    errors['user_id'] = [f"User {owner} not found."]
+            elif email in self.failed_emails:
+                errors['email'] = [f"User from row {self.failed_emails[email]} could not be created."]
+            elif email in self.user_by_email:
+                owner = self.user_by_email[email]
+            elif email not in new_users:
+                creates_user = True
+                if email in taken_emails:
+                    errors['email'] = ["Email already registered."]
+                if data['national_id'] and (
+                    data['national_id'] in taken_national_ids or data['national_id'] in self.national_ids
+                ):
+                    errors['national_id'] = ["User profile with this national id already exists."]
+
+            plate = data['license_plate']
+            if plate and (plate in taken_plates or plate in self.plates):
+                errors['license_plate'] = ["Vehicle with this license plate already exists."]
+
+            if errors:
+                if creates_user:
+                    self.failed_emails[email] = number
+                report.append({"row": number, "errors": errors})
+                continue
+            if creates_user:
+                new_users[email] = (number, data)
+                if data['national_id']:
+                    self.national_ids.add(data['national_id'])
+            if plate:
+                self.plates.add(plate)
+                vehicles.append((number, data, owner))
+
+        try:
+            self._write(new_users, vehicles)
+        except IntegrityError:
+            # Someone else registered one of these concurrently; the chunk was rolled back
+            rejected = {entry["row"] for entry in report}
+            report.extend(
+                {"row": number, "errors": {"non_field_errors": ["Conflicts with a concurrent change; import it again."]}}
+                for number, _ in rows
+                if number not in rejected
+            )
+            self.plates.difference_update(data['license_plate'] for _, data, _ in vehicles)
+            self.national_ids.difference_update(data['national_id'] for _, data in new_users.values())
+        self.counts["errors"] += len(report)
+        report.sort(key=lambda entry: entry["row"])
+        return report
+
+    def _write(self, new_users, vehicles):
+        with transaction.atomic():
+            emails = list(new_users)
+            users = User.objects.bulk_create([
+                # Unusable password, as make_password(None) makes, minus its per-character RNG calls
+                User(username=email, email=email, password=UNUSABLE_PASSWORD_PREFIX + secrets.token_hex(20))
+                for email in emails
+            ])
+            created = {email: user.pk for email, user in zip(emails, users)}
+            # Profiles, wallets and vehicles need no ids back, so skip bulk_create's per-object work
+            insert_rows(UserProfile, ['user', 'name', 'email', 'phone', 'national_id'], [
+                (created[email], data['name'], email, data['phone'], data['national_id'])
+                for email, (_, data) in new_users.items()
+            ])
+            insert_rows(Wallet, ['user', 'wallet_balance'], [(user_id, ZERO) for user_id in created.values()])
+            insert_rows(Vehicle, ['user', 'license_plate', 'normalized_plate', 'vehicle_type', 'vechile_model',
+                                  'vechile_color'], [
+                (created.get(owner, owner), data['license_plate'], normalize_plate(data['license_plate']),
+                 data['vehicle_type'], data['model'], data['color'] or 'white')
+                for _, data, owner in vehicles
+            ])
+            # insert_rows sends no post_save, so the plates go into this process's filter here
+            transaction.on_commit(lambda: plate_filter.add([data['license_plate'] for _, data, _ in vehicles]))
+        self.user_by_email.update(created)
+        self.counts["users_created"] += len(created)
+        self.counts["vehicles_created"] += len(vehicles)
@@ -19,13 +19,31 @@ class TransactionSerializer(serializers.ModelSerializer):
 
 
 class WalletSerializer(serializers.ModelSerializer):
-    user_id = serializers.CharField(source='user.id', read_only=True)
+    user_id = serializers.CharField(read_only=True)
     transactions = TransactionSerializer(read_only=True, many=True)
-    balance = serializers.DecimalField(source='wallet_balance', max_digits=12, decimal_places=2)
+    # Reserve plus shards, as annotated by users.history.wallet
+    balance = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)
+    next_cursor = serializers.CharField(read_only=True)
     
     class Meta:
         model = Wallet
-        fields = ['user_id', 'balance', 'transactions']
+        fields = ['user_id', 'balance', 'transactions', 'next_cursor']
+
+
+class UserListQuerySerializer(serializers.Serializer):
+    """Query parameters of GET /users"""
+    limit = serializers.IntegerField(min_value=1, max_value=10000, required=False)
+    cursor = serializers.CharField(required=False)
+
+
+class WalletHistoryQuerySerializer(serializers.Serializer):
+    """Query parameters of GET /user/wallet"""
+    limit = serializers.IntegerField(min_value=1, max_value=500, default=50)
+    cursor = serializers.CharField(required=False)
+    type = serializers.CharField(required=False, max_length=50)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    history = serializers.BooleanField(default=True)
 
 
 class UserDetailSerializer(serializers.ModelSerializer):
@@ -0,0 +1,116 @@
+"""
+Wallet shards for fleet accounts with many vehicles.
+
+Every vehicle of a fleet is charged from the same Wallet row, so parallel
+captures at different gates queue on that row's lock. A wallet can be
+split into K WalletShard rows: its balance is then
+
+    wallet_balance (the reserve, where top-ups go) + the sum of its shards
+
+and users.ledger.debit takes a toll from the reserve, or when that is
+short from any shard holding enough, so K captures can debit the same
+fleet at once. rebalance moves the reserve and uneven shards back to an
+even split; run it periodically with
+``python manage.py rebalance_wallet_shards``.
+
+Moves between the reserve and shards are not transactions: the total never
+changes, so the ledger (users/checkpoints.py) is unaffected.
+
+Usage:
+    resize(wallet_id, 8)     # split into 8 shards, 0 merges them back
+    rebalance(wallet_id)
+"""
+from decimal import Decimal, ROUND_DOWN
+
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Wallet, WalletShard
+
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+# A shard holding less than this fraction of its even share triggers a rebalance
+DEFAULT_TOLERANCE = 0.5
+
+
+def total_balance():
+    """Expression for a Wallet's reserve plus its shards, for .values()/.annotate()"""
+    shards = WalletShard.objects.filter(wallet=OuterRef('pk')).values('wallet').annotate(
+        total=Sum('balance')
+    ).values('total')
+    output = DecimalField(max_digits=14, decimal_places=2)
+    return F('wallet_balance') + Coalesce(Subquery(shards, output_field=output), Value(ZERO, output_field=output))
+
+
+def _locked(wallet_id):
+    wallet = Wallet.objects.select_for_update().get(pk=wallet_id)
+    shards = list(WalletShard.objects.select_for_update().filter(wallet_id=wallet_id).order_by('number'))
+    return wallet, shards
+
+
+def _spread(wallet, shards):
+    # Even split to the cent; the leftover cents go to the first shards
+    total = wallet.wallet_balance + sum((shard.balance for shard in shards), ZERO)
+    share = (total / len(shards)).quantize(CENT, rounding=ROUND_DOWN)
+    leftover = int((total - share * len(shards)) / CENT)
+    changed = []
+    for index, shard in enumerate(shards):
+        balance = share + (CENT if index < leftover else ZERO)
+        if shard.balance != balance:
+            shard.balance = balance
+            changed.append(shard)
+    if changed:
+        WalletShard.objects.bulk_update(changed, ['balance'])
+    if wallet.wallet_balance != ZERO:
+        wallet.wallet_balance = ZERO
+        wallet.save(update_fields=['wallet_balance'])
+    return bool(changed)
+
+
+def rebalance(wallet_id):
+    """Move the reserve and all shard balances to an even split. Returns whether anything moved."""
+    with transaction.atomic():
+        wallet, shards = _locked(wallet_id)
+        if not shards:
+            return False
+        return _spread(wallet, shards)
+
+
+def resize(wallet_id, count):
+    """Split a wallet into count shards (0 merges them back into the wallet) and rebalance"""
+    with transaction.atomic():
+        wallet, shards = _locked(wallet_id)
+        kept = [shard for shard in shards if shard.number < count]
+        dropped = [shard for shard in shards if shard.number >= count]
+        if dropped:
+            wallet.wallet_balance += sum((shard.balance for shard in dropped), ZERO)
+            wallet.save(update_fields=['wallet_balance'])
+            WalletShard.objects.filter(pk__in=[shard.pk for shard in dropped]).delete()
+        numbers = {shard.number for shard in kept}
+        kept += WalletShard.objects.bulk_create([
+            WalletShard(wallet=wallet, number=number, balance=ZERO)
+            for number in range(count) if number not in numbers
+        ])
+        if kept:
+            _spread(wallet, sorted(kept, key=lambda shard: shard.number))
+    return count
+
+
+def unbalanced(tolerance=DEFAULT_TOLERANCE):
+    """Ids of sharded wallets with funds in the reserve or a shard below tolerance of its even share"""
+    reserves = {}
+    shards = {}
+    # Only fleet wallets are sharded, a handful of rows each
+    rows = WalletShard.objects.values_list('wallet_id', 'balance', 'wallet__wallet_balance')
+    for wallet_id, balance, reserve in rows:
+        reserves[wallet_id] = reserve
+        shards.setdefault(wallet_id, []).append(balance)
+    found = []
+    for wallet_id, balances in shards.items():
+        even = (reserves[wallet_id] + sum(balances, ZERO)) / len(balances)
+        if reserves[wallet_id] > ZERO or min(balances) < even * Decimal(str(tolerance)):
+            found.append(wallet_id)
+    return found
@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .authentication import revocations
+
+
+# Fields whose value tokens carry, or that decide whether a token is honoured
+ACCESS_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+
+@receiver(pre_save, sender=User)
+def remember_access_fields(sender, instance, update_fields=None, **kwargs):
+    # Logins save only last_login; skip the query when no access field can change
+    if instance.pk is None or (update_fields is not None and not set(ACCESS_FIELDS) & set(update_fields)):
+        return
+    instance._saved_access = User.objects.filter(pk=instance.pk).values_list(*ACCESS_FIELDS).first()
+
+
+@receiver(post_save, sender=User)
+def revoke_tokens_on_access_change(sender, instance, created, **kwargs):
+    saved = getattr(instance, '_saved_access', None)
+    instance._saved_access = None
+    if saved is not None and saved != tuple(getattr(instance, field) for field in ACCESS_FIELDS):
+        revocations.revoke_user(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def revoke_tokens_on_delete(sender, instance, **kwargs):
+    revocations.revoke_user(instance.pk, exists=False)
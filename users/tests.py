@@ -1,3 +1,773 @@
-from django.test import TestCase
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from autofare import ids
+from autofare.ids import HOST_BITS, IdGenerator, SEQUENCE_BITS, SLOTS, WORKER_BITS
+from autofare.streaming import stream_rows
+from vehicles.models import Vehicle
+from vehicles.resolver import plate_resolver
+from . import allowances, checkpoints, ledger, onboarding, shards
+from .authentication import RevocationList, issue_tokens, revocations
+from .models import RevokedToken, UserProfile, Wallet, WalletCheckpoint, WalletShard, Transaction, SpendingAllowance
+
+
+def _generate_in_child(queue, count):
+    queue.put(ids.next_ids(count))
+
+
+def _worker_id(value):
+    return (value >> SEQUENCE_BITS) & ((1 << WORKER_BITS) - 1)
+
+
+class IdGeneratorTests(SimpleTestCase):
+    """Stress tests for the snowflake transaction ID generator"""
+
+    def test_ids_are_unique_and_increasing_across_threads(self):
+        generator = IdGenerator(worker_id=7)
+        results = [[] for _ in range(16)]
+
+        def worker(index):
+            for _ in range(2000):
+                results[index].append(generator.next_id())
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        everything = [value for chunk in results for value in chunk]
+        self.assertEqual(len(everything), len(set(everything)))
+        for chunk in results:
+            self.assertEqual(chunk, sorted(chunk))
+
+    def test_bulk_allocation_spans_exhausted_sequences(self):
+        generator = IdGenerator(worker_id=1)
+        values = generator.next_ids(3 * (1 << SEQUENCE_BITS) + 5)
+        self.assertEqual(len(values), len(set(values)))
+        self.assertEqual(values, sorted(values))
+        self.assertLess(values[-1], generator.next_id())
+
+    def test_worker_id_is_embedded(self):
+        value = IdGenerator(worker_id=513).next_id()
+        self.assertEqual(_worker_id(value), 513)
+
+    def test_ids_are_unique_across_processes(self):
+        ids.next_id()  # make sure the parent has claimed its own worker id
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        processes = [context.Process(target=_generate_in_child, args=(queue, 5000)) for _ in range(6)]
+        for process in processes:
+            process.start()
+        batches = [queue.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+
+        everything = [value for batch in batches for value in batch] + ids.next_ids(5000)
+        self.assertEqual(len(everything), len(set(everything)))
+        self.assertNotIn(ids.generator.worker_id, {_worker_id(batch[0]) for batch in batches})
+
+
+@override_settings(ID_WORKER_ID=None, ID_HOST_ID=3)
+class WorkerIdLeaseTests(SimpleTestCase):
+    """Processes that are not given a worker id lease one of their host's"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(ID_LEASE_DIR=directory.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop('AUTOFARE_WORKER_ID', None)
+
+    def generator(self):
+        generator = IdGenerator()
+        generator.next_id()
+        self.addCleanup(generator._reset)
+        return generator
+
+    def test_live_processes_hold_different_worker_ids(self):
+        workers = [self.generator().worker_id for _ in range(SLOTS)]
+        self.assertEqual(len(set(workers)), SLOTS)
+        self.assertEqual({worker >> (WORKER_BITS - HOST_BITS) for worker in workers}, {3})
+        with self.assertRaises(ImproperlyConfigured):
+            self.generator()
+
+    def test_released_worker_id_is_leased_again(self):
+        first = self.generator()
+        worker_id = first.worker_id
+        self.assertNotEqual(self.generator().worker_id, worker_id)
+        # Far more than one millisecond of ids: the last ones are ahead of the clock
+        last = first.next_ids(20 * (1 << SEQUENCE_BITS))[-1]
+        first._reset()
+        second = self.generator()
+        self.assertEqual(second.worker_id, worker_id)
+        self.assertGreater(second.next_id(), last)
+
+    @override_settings(ID_HOST_ID=None)
+    def test_missing_host_id_fails_fast(self):
+        with self.assertRaises(ImproperlyConfigured):
+            IdGenerator().next_id()
+
+    @override_settings(ID_HOST_ID=None, ID_WORKER_ID=700)
+    def test_configured_worker_id_needs_no_lease(self):
+        self.assertEqual(self.generator().worker_id, 700)
+
+
+class TransactionIdTests(TestCase):
+
+    def test_bulk_inserted_transactions_get_unique_ids(self):
+        user = User.objects.create_user(username='ids@example.com')
+        wallet = Wallet.objects.create(user=user)
+        Transaction.objects.bulk_create([
+            Transaction(wallet=wallet, transaction_id=transaction_id, transaction_type='top-up', amount=Decimal('1.00'))
+            for transaction_id in ids.transaction_ids(500)
+        ])
+        self.assertEqual(Transaction.objects.values('transaction_id').distinct().count(), 500)
+
+
+@override_settings(ALLOWANCE_CLOSE_GRACE=60)
+class LedgerTests(TestCase):
+    """A debit takes the whole amount or nothing, with or without UPDATE ... RETURNING"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='ledger@example.com')
+        self.wallet = Wallet.objects.create(user=user, wallet_balance=Decimal('10.00'))
+
+    def balance(self):
+        return Wallet.objects.values_list('wallet_balance', flat=True).get(pk=self.wallet.pk)
+
+    def check_debits(self):
+        self.assertEqual(ledger.debit(self.wallet.pk, '4.50'), Decimal('5.50'))
+        self.assertIsNone(ledger.debit(self.wallet.pk, '6.00'))
+        self.assertEqual(self.balance(), Decimal('5.50'))
+        self.assertEqual(ledger.debit(self.wallet.pk, '5.50'), Decimal('0.00'))
+        self.assertIsNone(ledger.debit(self.wallet.pk, '0.01'))
+        self.assertIsNone(ledger.debit(self.wallet.pk + 1, '1.00'))
+        self.assertEqual(ledger.credit(self.wallet.pk, '2.25'), Decimal('2.25'))
+        self.assertEqual(self.balance(), Decimal('2.25'))
+
+    def test_debit_is_one_conditional_update(self):
+        with self.assertNumQueries(1):
+            ledger.debit(self.wallet.pk, '1.00')
+        self.wallet.refresh_from_db()
+        self.assertEqual(self.wallet.wallet_balance, Decimal('9.00'))
+
+    def test_debits_never_overdraw(self):
+        self.check_debits()
+
+    def test_debits_never_overdraw_without_returning(self):
+        with mock.patch.object(ledger, '_supports_update_returning', return_value=False):
+            self.check_debits()
+
+    def test_top_up_is_recorded(self):
+        self.assertEqual(ledger.top_up(self.wallet.pk, '15.00'), Decimal('25.00'))
+        self.assertEqual(
+            list(Transaction.objects.values_list('transaction_type', 'amount')), [('top-up', Decimal('15.00'))]
+        )
+        self.assertIsNone(ledger.top_up(self.wallet.pk + 1, '15.00'))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class WalletShardTests(TestCase):
+    """A sharded wallet's total never changes except by debits and top-ups"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='fleet@example.com')
+        self.wallet = Wallet.objects.create(user=user, wallet_balance=Decimal('10.00'))
+
+    def split(self):
+        reserve = Wallet.objects.values_list('wallet_balance', flat=True).get(pk=self.wallet.pk)
+        balances = list(WalletShard.objects.filter(wallet=self.wallet).order_by('number').values_list('balance', flat=True))
+        return reserve, balances
+
+    def total(self):
+        return Wallet.objects.filter(pk=self.wallet.pk).values_list(shards.total_balance(), flat=True).get()
+
+    def test_resize_spreads_the_balance_evenly(self):
+        shards.resize(self.wallet.pk, 3)
+        self.assertEqual(self.split(), (Decimal('0.00'), [Decimal('3.34'), Decimal('3.33'), Decimal('3.33')]))
+        self.assertEqual(self.total(), Decimal('10.00'))
+        shards.resize(self.wallet.pk, 2)
+        self.assertEqual(self.split(), (Decimal('0.00'), [Decimal('5.00'), Decimal('5.00')]))
+        shards.resize(self.wallet.pk, 0)
+        self.assertEqual(self.split(), (Decimal('10.00'), []))
+
+    def test_debit_falls_back_to_a_shard(self):
+        shards.resize(self.wallet.pk, 2)
+        self.assertEqual(ledger.debit(self.wallet.pk, '4.00'), Decimal('1.00'))
+        self.assertEqual(sorted(self.split()[1]), [Decimal('1.00'), Decimal('5.00')])
+        self.assertEqual(ledger.debit_shard(self.wallet.pk, '5.00'), Decimal('0.00'))
+        self.assertIsNone(ledger.debit_shard(self.wallet.pk, '5.00'))
+
+    def test_debit_across_rows_only_when_the_total_covers_it(self):
+        shards.resize(self.wallet.pk, 3)
+        # No single row holds 5.00, the wallet does
+        self.assertEqual(ledger.debit(self.wallet.pk, '5.00'), Decimal('5.00'))
+        self.assertEqual(self.total(), Decimal('5.00'))
+        self.assertIsNone(ledger.debit(self.wallet.pk, '5.01'))
+        self.assertEqual(self.total(), Decimal('5.00'))
+        self.assertTrue(all(balance >= 0 for balance in self.split()[1]))
+
+    def test_rebalance_moves_top_ups_into_the_shards(self):
+        shards.resize(self.wallet.pk, 2)
+        self.assertEqual(shards.unbalanced(), [])
+        ledger.top_up(self.wallet.pk, '2.00')
+        self.assertEqual(shards.unbalanced(), [self.wallet.pk])
+        out = StringIO()
+        call_command('rebalance_wallet_shards', '--once', stdout=out)
+        self.assertIn("Rebalanced 1 wallets in 1 passes", out.getvalue())
+        self.assertEqual(self.split(), (Decimal('0.00'), [Decimal('6.00'), Decimal('6.00')]))
+        self.assertFalse(shards.rebalance(self.wallet.pk))
+
+
+class AsyncWalletTests(TestCase):
+    """The async wallet endpoint keeps the contract of the sync one"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='async@example.com')
+        self.wallet = Wallet.objects.create(user=self.user)
+        ledger.top_up(self.wallet.pk, Decimal('20.00'))
+
+    async def test_balance_and_history_match_the_sync_endpoint(self):
+        url = f'/api/async/user/wallet?user_id={self.user.pk}'
+        response = await AsyncClient().get(url)
+        self.assertEqual(response.status_code, 200)
+        sync = await sync_to_async(APIClient().get)(f'/api/user/wallet?user_id={self.user.pk}')
+        self.assertEqual(response.json(), json.loads(sync.content))
+        self.assertEqual(len(response.json()['transactions']), 1)
+
+    async def test_top_up_returns_the_new_balance(self):
+        response = await AsyncClient().post(
+            '/api/async/user/wallet', {"user_id": self.user.pk, "amount": '5.00'}, content_type='application/json'
+        )
+        self.assertEqual(response.json(), {"message": "Wallet updated successfully", "new_balance": 25.0})
+
+    async def test_unknown_user_is_not_found(self):
+        client = AsyncClient()
+        self.assertEqual((await client.get('/api/async/user/wallet?user_id=999999')).status_code, 404)
+        self.assertEqual((await client.get('/api/async/user/wallet')).status_code, 400)
+        response = await client.post(
+            '/api/async/user/wallet', {"user_id": 999999, "amount": '5.00'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class WalletHistoryTests(TestCase):
+    """Wallet history pages are bounded, gapless and newest first, however deep"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='history@example.com')
+        self.wallet = Wallet.objects.create(user=self.user)
+        moment = timezone.now()
+        self.transactions = [
+            Transaction.objects.create(
+                wallet=self.wallet, transaction_id=f'TXN-{index}', amount=Decimal('1.00'),
+                transaction_type='top-up' if index % 2 else 'toll-charge'
+            )
+            for index in range(7)
+        ]
+        # Three share a timestamp, so pages must break ties by id
+        Transaction.objects.filter(pk__in=[txn.pk for txn in self.transactions[2:5]]).update(date=moment)
+        self.client = APIClient()
+
+    def get(self, **params):
+        return self.client.get('/api/user/wallet', {"user_id": self.user.pk, **params})
+
+    def walk(self, **params):
+        seen, cursor = [], None
+        while True:
+            body = self.get(limit=2, **({"cursor": cursor} if cursor else {}), **params).data
+            self.assertLessEqual(len(body['transactions']), 2)
+            seen += [txn['transaction_id'] for txn in body['transactions']]
+            cursor = body['next_cursor']
+            if cursor is None:
+                return seen
+
+    def newest_first(self, transactions):
+        ordered = Transaction.objects.filter(pk__in=[txn.pk for txn in transactions]).order_by('-date', '-id')
+        return list(ordered.values_list('transaction_id', flat=True))
+
+    def test_pages_cover_the_history_once_in_order(self):
+        self.assertEqual(self.walk(), self.newest_first(self.transactions))
+
+    def test_pages_can_be_filtered_by_type(self):
+        top_ups = [txn for txn in self.transactions if txn.transaction_type == 'top-up']
+        self.assertEqual(self.walk(type='top-up'), self.newest_first(top_ups))
+
+    def test_deep_page_costs_the_same_queries(self):
+        with CaptureQueriesContext(connection) as first:
+            cursor = self.get(limit=2).data['next_cursor']
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as deep:
+                cursor = self.get(limit=2, cursor=cursor).data['next_cursor']
+        self.assertEqual(len(deep), len(first))
+
+    def test_balance_without_history(self):
+        body = self.get(history='false').data
+        self.assertNotIn('transactions', body)
+        self.assertEqual(body['balance'], '0.00')
+
+    def test_bad_parameters_are_rejected(self):
+        self.assertEqual(self.get(cursor='nonsense').status_code, 400)
+        self.assertEqual(self.get(limit=501).status_code, 400)
+        self.assertEqual(self.client.get('/api/user/wallet', {"user_id": 999999}).status_code, 404)
+
+
+@override_settings(CHECKPOINT_SETTLE_SECONDS=0)
+class WalletCheckpointTests(TestCase):
+    """Balances are verified from the latest checkpoint plus the transactions after it"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='audit@example.com')
+        self.wallet = Wallet.objects.create(user=user)
+        ledger.top_up(self.wallet.pk, Decimal('30.00'))
+        self.charge('4.50')
+
+    def charge(self, amount):
+        ledger.debit(self.wallet.pk, amount)
+        Transaction.objects.create(
+            wallet=self.wallet, transaction_id=ids.transaction_id(), transaction_type='toll-charge',
+            amount=Decimal(amount)
+        )
+
+    def audit(self):
+        return checkpoints.audit(self.wallet.pk, self.wallet.pk)[0]
+
+    def test_checkpoint_covers_the_audited_transactions(self):
+        result = self.audit()
+        self.assertEqual((result.stored_balance, result.ledger_balance), (Decimal('25.50'), Decimal('25.50')))
+        self.assertEqual(checkpoints.checkpoint([result]), 1)
+
+        self.charge('5.50')
+        result = self.audit()
+        self.assertEqual((result.new_transactions, result.transaction_count), (1, 3))
+        self.assertEqual(result.ledger_balance, Decimal('20.00'))
+        self.assertEqual(checkpoints.ledger_balance(self.wallet.pk), self.audit().stored_balance)
+
+    def test_nothing_new_writes_no_checkpoint(self):
+        checkpoints.checkpoint([self.audit()])
+        self.assertEqual(checkpoints.checkpoint([self.audit()]), 0)
+        self.assertEqual(WalletCheckpoint.objects.count(), 1)
+
+    def test_drift_is_detected_after_a_checkpoint(self):
+        checkpoints.checkpoint([self.audit()])
+        Wallet.objects.filter(pk=self.wallet.pk).update(wallet_balance=Decimal('99.00'))
+        result = self.audit()
+        self.assertEqual((result.stored_balance, result.ledger_balance), (Decimal('99.00'), Decimal('25.50')))
+
+    @override_settings(CHECKPOINT_SETTLE_SECONDS=60)
+    def test_recent_transactions_are_left_for_the_next_run(self):
+        result = self.audit()
+        self.assertEqual(result.ledger_balance, Decimal('25.50'))
+        self.assertEqual(result.settled_transactions, 0)
+        self.assertEqual(checkpoints.checkpoint([result]), 0)
+
+    def test_unknown_transaction_types_are_not_checkpointed(self):
+        Transaction.objects.create(
+            wallet=self.wallet, transaction_id=ids.transaction_id(), transaction_type='refund', amount=Decimal('1.00')
+        )
+        result = self.audit()
+        self.assertEqual(result.unknown_types, 1)
+        self.assertEqual(checkpoints.checkpoint([result]), 0)
+
+    def test_wallet_ranges_cover_every_wallet(self):
+        for index in range(4):
+            Wallet.objects.create(user=User.objects.create_user(username=f'range{index}@example.com'))
+        ranges = list(checkpoints.wallet_ranges(2))
+        self.assertEqual(len(ranges), 3)
+        covered = sum(Wallet.objects.filter(id__gte=low, id__lte=high).count() for low, high in ranges)
+        self.assertEqual(covered, 5)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class UserListTests(TestCase):
+    """The user list streams every profile with one query per chunk, as JSON or NDJSON"""
+
+    def setUp(self):
+        for index in range(5):
+            user = User.objects.create_user(username=f'list{index}@example.com')
+            UserProfile.objects.create(user=user, name=f'User {index}', email=f'list{index}@example.com', phone='0100')
+        # Not listed: no profile
+        User.objects.create_user(username='bare@example.com')
+        self.client = APIClient()
+        chunk_size = mock.patch('users.views.UserViewSet.stream_chunk_size', 2)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+
+    def streamed(self, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/', *args, **kwargs)
+            body = b''.join(response.streaming_content).decode()
+        return response, body, len(queries)
+
+    def test_json_array_of_every_profile_one_query_per_chunk(self):
+        response, body, queries = self.streamed()
+        self.assertEqual(response['Content-Type'], 'application/json')
+        users = json.loads(body)
+        self.assertEqual([user['name'] for user in users], [f'User {index}' for index in range(5)])
+        self.assertEqual(set(users[0]), {'user_id', 'name', 'email', 'phone'})
+        self.assertEqual(queries, 3)
+
+    def test_ndjson_by_query_parameter_or_accept_header(self):
+        for response, body, _ in (self.streamed({"stream": 'ndjson'}),
+                                  self.streamed(HTTP_ACCEPT='application/x-ndjson')):
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            lines = body.splitlines()
+            self.assertEqual([json.loads(line)['name'] for line in lines], [f'User {index}' for index in range(5)])
+
+    def test_pages_with_a_cursor(self):
+        first, body, _ = self.streamed({"limit": 3})
+        self.assertEqual(len(json.loads(body)), 3)
+        rest, body, _ = self.streamed({"limit": 3, "cursor": first['X-Next-Cursor']})
+        self.assertEqual([user['name'] for user in json.loads(body)], ['User 3', 'User 4'])
+        self.assertFalse(rest.has_header('X-Next-Cursor'))
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.client.get('/api/users/', {"cursor": 'nonsense'}).status_code, 400)
+
+    async def test_asgi_requests_get_an_async_stream(self):
+        response = await AsyncClient().get('/api/users/')
+        self.assertTrue(response.is_async)
+        body = b''.join([part async for part in response.streaming_content]).decode()
+        self.assertEqual([user['name'] for user in json.loads(body)], [f'User {index}' for index in range(5)])
+
+    async def test_async_stream_pulls_one_chunk_at_a_time(self):
+        pulled = []
+
+        def pages():
+            for number in range(3):
+                pulled.append(number)
+                yield [{"page": number}]
+
+        response = stream_rows(pages(), ndjson=True, request=AsyncRequestFactory().get('/api/users/'))
+        parts = aiter(response.streaming_content)
+        self.assertEqual(await anext(parts), b'{"page":0}\n')
+        self.assertEqual(pulled, [0])
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class OnboardingTests(TestCase):
+    """Bulk imports create what is valid and report every rejected row by number"""
+
+    HEADER = 'name,email,phone,national_id,user_id,license_plate,vehicle_type,model,color\n'
+
+    def post(self, body, content_type='text/csv'):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/users/import/', body, content_type=content_type)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        return response, [json.loads(line) for line in lines]
+
+    def test_csv_creates_users_with_wallets_and_vehicles(self):
+        response, report = self.post(
+            self.HEADER +
+            'Ann,ann@example.com,0100,NID1,,ANN-001,car,Corolla,red\n'
+            'Ann,ann@example.com,0100,NID1,,ANN-002,truck,Actros,\n'
+            'Bob,bob@example.com,0101,,,,,,\n'
+        )
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(report, [{"summary": {"rows": 3, "users_created": 2, "vehicles_created": 2, "errors": 0}}])
+        ann = User.objects.get(username='ann@example.com')
+        self.assertEqual((ann.profile.national_id, ann.wallet.wallet_balance), ('NID1', Decimal('0.00')))
+        self.assertEqual(
+            sorted(ann.vehicle_set.values_list('license_plate', 'vechile_color')),
+            [('ANN-001', 'red'), ('ANN-002', 'white')]
+        )
+        self.assertFalse(Vehicle.objects.filter(user__username='bob@example.com').exists())
+        record = plate_resolver.resolve('ANN-002')
+        self.assertEqual((record.user_id, record.vehicle_type), (ann.pk, 'truck'))
+
+    def test_rejected_rows_are_reported_and_the_rest_imported(self):
+        existing = User.objects.create_user(username='old@example.com')
+        Vehicle.objects.create(user=existing, license_plate='OLD-001', vehicle_type='car', vechile_model='Golf')
+        _, report = self.post(
+            self.HEADER +
+            'Bad,not-an-email,0100,,,,,,\n'
+            'Dup,dup@example.com,0100,,,OLD-001,car,Golf,\n'
+            'Dup,dup@example.com,0100,,,DUP-002,car,Golf,\n'
+            ',,,,999999,NEW-001,car,Golf,\n'
+            f',,,,{existing.pk},NEW-002,boat,Golf,\n'
+            f',,,,{existing.pk},NEW-003,van,Transit,\n'
+            'Twin,twin@example.com,0100,,,NEW-003,car,Golf,\n'
+        )
+        errors = {entry["row"]: set(entry["errors"]) for entry in report if "row" in entry}
+        self.assertEqual(errors, {
+            1: {'email'}, 2: {'license_plate'}, 3: {'email'}, 4: {'user_id'}, 5: {'vehicle_type'}, 7: {'license_plate'}
+        })
+        self.assertEqual(report[-1]["summary"], {"rows": 7, "users_created": 0, "vehicles_created": 1, "errors": 6})
+        self.assertEqual(Vehicle.objects.get(license_plate='NEW-003').user_id, existing.pk)
+        self.assertFalse(User.objects.filter(username__in=['dup@example.com', 'twin@example.com']).exists())
+
+    def test_email_longer_than_a_username_is_rejected(self):
+        long_email = 'a' * 140 + '@example.com'
+        _, report = self.post(self.HEADER + f'Long,{long_email},0100,,,,,,\nOk,ok@example.com,0100,,,,,,\n')
+        self.assertEqual(report[0], {"row": 1, "errors": {"email": ["Ensure this field has no more than 150 characters."]}})
+        self.assertEqual(report[-1]["summary"]["users_created"], 1)
+
+    def test_duplicates_are_caught_across_chunks(self):
+        rows = onboarding.read_ndjson([
+            json.dumps({"name": 'A', "email": 'a@example.com', "phone": '1', "license_plate": 'CHK-1',
+                        "vehicle_type": 'car', "model": 'Golf'}),
+            json.dumps({"name": 'B', "email": 'b@example.com', "phone": '1', "national_id": 'N1'}),
+            json.dumps({"name": 'C', "email": 'c@example.com', "phone": '1', "national_id": 'N1'}),
+            json.dumps({"name": 'D', "email": 'd@example.com', "phone": '1', "license_plate": 'CHK-1',
+                        "vehicle_type": 'car', "model": 'Golf'}),
+            '{not json',
+        ])
+        report = [entry for entries in onboarding.Importer(chunk_size=2).run(rows) for entry in entries]
+        errors = {entry["row"]: set(entry["errors"]) for entry in report if "row" in entry}
+        self.assertEqual(errors, {3: {'national_id'}, 4: {'license_plate'}, 5: {'non_field_errors'}})
+        self.assertEqual(report[-1]["summary"]["users_created"], 2)
+
+    def test_other_content_types_are_refused(self):
+        response = self.client.post('/api/users/import/', 'name', content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+
+class SpendingAllowanceTests(TestCase):
+    """Allowances never let a wallet spend more than it holds, even across crashes"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='fleet@example.com')
+        self.wallet = Wallet.objects.create(user=user)
+        ledger.top_up(self.wallet.pk, Decimal('100.00'))
+        self.book = allowances.AllowanceBook(amount='40.00', ttl=300, hot_captures=1)
+
+    def spend(self, book, amount, commit=True):
+        allowance_id = book.reserve(self.wallet.pk, 'G1', Decimal(amount))
+        if allowance_id is not None and commit:
+            allowances.record_charge(allowance_id, self.wallet.pk, Decimal(amount))
+        return allowance_id
+
+    def balance(self):
+        return Wallet.objects.values_list('wallet_balance', flat=True).get(pk=self.wallet.pk)
+
+    def after_expiry(self):
+        return timezone.now() + timedelta(seconds=300 + 61)
+
+    def assertLedgerMatches(self):
+        result = checkpoints.audit(self.wallet.pk, self.wallet.pk)[0]
+        self.assertEqual(result.stored_balance, result.ledger_balance)
+
+    def test_grant_holds_the_allowance_from_the_wallet(self):
+        self.assertIsNotNone(self.spend(self.book, '5.00'))
+        self.assertEqual(self.balance(), Decimal('60.00'))
+        self.assertEqual(self.book.remaining(self.wallet.pk, 'G1'), Decimal('35.00'))
+        self.assertLedgerMatches()
+
+    def test_spending_stops_at_the_allowance(self):
+        paid = [self.spend(self.book, '7.00') for _ in range(10)]
+        self.assertEqual(sum(1 for allowance_id in paid if allowance_id is not None), 5)
+        self.assertEqual(self.balance(), Decimal('60.00'))
+
+    def test_concurrent_spending_never_exceeds_the_allowance(self):
+        self.spend(self.book, '1.00')
+        results = []
+
+        def worker():
+            for _ in range(20):
+                results.append(self.book.reserve(self.wallet.pk, 'G1', Decimal('0.50')))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(1 for allowance_id in results if allowance_id is not None), 78)
+        self.assertEqual(self.book.remaining(self.wallet.pk, 'G1'), Decimal('0.00'))
+
+    def test_crash_returns_only_what_was_not_charged(self):
+        allowance_id = self.spend(self.book, '5.00')
+        self.spend(self.book, '5.00')
+        # Reserved in memory but the process died before the charge committed
+        self.spend(self.book, '5.00', commit=False)
+
+        # The restarted process has a new holder and never resumes the old allowance
+        restarted = allowances.AllowanceBook(amount='40.00', ttl=300, hot_captures=1)
+        self.assertNotEqual(restarted.holder, self.book.holder)
+        self.assertNotEqual(self.spend(restarted, '5.00'), allowance_id)
+        self.assertEqual(self.balance(), Decimal('20.00'))
+
+        updated, closed, returned = allowances.reconcile(now=self.after_expiry())
+        self.assertEqual((closed, returned), (2, Decimal('65.00')))
+        self.assertEqual(self.balance(), Decimal('85.00'))
+        self.assertEqual(SpendingAllowance.objects.get(pk=allowance_id).spent, Decimal('10.00'))
+        self.assertLedgerMatches()
+
+    def test_allowances_are_not_closed_before_expiry_and_grace(self):
+        allowance_id = self.spend(self.book, '5.00')
+        expires_at = SpendingAllowance.objects.get(pk=allowance_id).expires_at
+        self.assertEqual(allowances.reconcile(now=expires_at + timedelta(seconds=30))[1], 0)
+        self.assertEqual(SpendingAllowance.objects.get(pk=allowance_id).spent, Decimal('5.00'))
+        self.assertEqual(self.balance(), Decimal('60.00'))
+
+    def test_closing_twice_returns_the_funds_once(self):
+        allowance_id = self.spend(self.book, '5.00')
+        self.assertEqual(allowances.close(allowance_id), Decimal('35.00'))
+        self.assertIsNone(allowances.close(allowance_id))
+        self.assertEqual(allowances.reconcile(now=self.after_expiry())[1], 0)
+        self.assertEqual(self.balance(), Decimal('95.00'))
+        self.assertLedgerMatches()
+
+    def test_refunded_reservation_can_be_spent_again(self):
+        allowance_id = self.spend(self.book, '30.00', commit=False)
+        self.assertIsNone(self.spend(self.book, '30.00'))
+        self.book.refund(self.wallet.pk, 'G1', allowance_id, Decimal('30.00'))
+        self.assertEqual(self.spend(self.book, '30.00'), allowance_id)
+
+    def expire_in_memory(self):
+        entry = self.book._open[(self.wallet.pk, 'G1')]
+        entry.expires = time.time() - 1
+        SpendingAllowance.objects.filter(pk=entry.allowance_id).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_expired_allowance_is_not_granted_again_until_it_can_be_closed(self):
+        first = self.spend(self.book, '5.00')
+        self.expire_in_memory()
+        # Still open for the grace period: no doomed grant, no debit and rollback
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.book.reserve(self.wallet.pk, 'G1', Decimal('5.00')))
+        self.assertEqual(self.balance(), Decimal('60.00'))
+
+        # Grace over: the book closes its own allowance and is granted a new one
+        self.book._expired[(self.wallet.pk, 'G1')] = (first, time.time() - 1)
+        second = self.spend(self.book, '5.00')
+        self.assertNotIn(second, (None, first))
+        self.assertEqual(SpendingAllowance.objects.get(pk=first).spent, Decimal('5.00'))
+        self.assertEqual(self.balance(), Decimal('55.00'))
+        self.assertLedgerMatches()
+
+    def test_open_allowance_found_when_granting_is_remembered(self):
+        first = self.spend(self.book, '5.00')
+        # The book lost its entry, but the allowance is still open
+        self.book._open.clear()
+        self.assertIsNone(self.spend(self.book, '5.00'))
+        self.assertEqual(self.book._expired[(self.wallet.pk, 'G1')][0], first)
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.book.reserve(self.wallet.pk, 'G1', Decimal('5.00')))
+        self.assertEqual(self.balance(), Decimal('60.00'))
+
+    def test_wallet_short_of_the_allowance_is_debited_directly(self):
+        book = allowances.AllowanceBook(amount='500.00', ttl=300, hot_captures=1)
+        self.assertIsNone(self.spend(book, '5.00'))
+        self.assertEqual(self.balance(), Decimal('100.00'))
+        self.assertFalse(SpendingAllowance.objects.exists())
+
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class AuthenticationTests(TestCase):
+    """Tokens stop working once their user is deleted, deactivated or has a role change"""
+
+    def setUp(self):
+        revocations.clear()
+        self.addCleanup(revocations.clear)
+        self.user = User.objects.create_user(username='driver@example.com', is_staff=True)
+        Wallet.objects.create(user=self.user)
+        self.refresh = issue_tokens(self.user)
+
+    def get(self, url, token=None):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {token or self.refresh.access_token}")
+        return client.get(url)
+
+    def wallet(self, token=None):
+        # Claims-only view (mobile app)
+        return self.get(f'/api/user/wallet?user_id={self.user.pk}', token)
+
+    def admin_metrics(self, token=None):
+        # Default view: the user is loaded from the database
+        return self.get('/api/metrics/queries', token)
+
+    def refreshed(self):
+        return APIClient().post('/api/users/auth/refresh_token/', {"refresh": str(self.refresh)}, format='json')
+
+    def test_tokens_work_until_access_changes(self):
+        self.assertEqual(self.wallet().status_code, 200)
+        self.assertEqual(self.admin_metrics().status_code, 200)
+        self.assertEqual(self.refreshed().status_code, 200)
+
+    def test_deactivated_user_is_rejected_everywhere(self):
+        access = self.refresh.access_token
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.wallet(access).status_code, 401)
+        self.assertEqual(self.admin_metrics(access).status_code, 401)
+        self.assertEqual(self.refreshed().status_code, 401)
+
+    def test_inactive_user_is_rejected_without_a_revocation(self):
+        # update() sends no signals, so only the user lookup can notice
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.admin_metrics().status_code, 401)
+        self.assertEqual(self.refreshed().status_code, 401)
+
+    def test_demoted_staff_loses_admin_access(self):
+        access = self.refresh.access_token
+        self.user.is_staff = False
+        self.user.save(update_fields=['is_staff'])
+        self.assertEqual(self.admin_metrics(access).status_code, 401)
+        self.assertEqual(self.wallet(access).status_code, 401)
+
+    def test_deleted_user_is_rejected_and_cannot_refresh(self):
+        access = self.refresh.access_token
+        admin = User.objects.create_user(username='admin@example.com', is_staff=True)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {issue_tokens(admin).access_token}")
+        self.assertEqual(client.delete(f'/api/users/{self.user.pk}/').status_code, 200)
+        self.assertEqual(self.wallet(access).status_code, 401)
+        self.assertEqual(self.refreshed().status_code, 401)
+
+    def test_login_does_not_revoke(self):
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        self.user.first_name = 'Sam'
+        self.user.save()
+        self.assertEqual(self.wallet().status_code, 200)
+
+    def test_tokens_issued_after_the_revocation_work(self):
+        self.user.is_staff = False
+        self.user.save()
+        # iat has whole seconds, so a token from the second of the revocation is revoked too
+        RevokedToken.objects.filter(user=self.user).update(revoked_at=timezone.now() - timedelta(seconds=2))
+        revocations.clear()
+        access = issue_tokens(self.user).access_token
+        self.assertEqual(self.wallet(access).status_code, 200)
+        self.assertEqual(self.admin_metrics(access).status_code, 403)
+
+    def test_other_processes_load_user_revocations(self):
+        self.user.is_active = False
+        self.user.save()
+        other = RevocationList()
+        self.assertTrue(other.is_user_revoked(self.user.pk, self.refresh['iat']))
+        self.assertFalse(other.is_user_revoked(self.user.pk + 1, self.refresh['iat']))
+
+    def test_logout_revokes_the_session(self):
+        access = self.refresh.access_token
+        client = APIClient()
+        response = client.post('/api/users/auth/logout/', {"refresh": str(self.refresh)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.wallet(access).status_code, 401)
+        self.assertEqual(self.refreshed().status_code, 401)
@@ -1,25 +1,35 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
+from autofare.pagination import chunks, keyset, page
+from autofare.streaming import ndjson_renderer_classes, stream_rows, wants_ndjson
+from . import history, ledger, onboarding
+from .authentication import MACHINE_CLIENT_AUTHENTICATION, issue_tokens, is_revoked, revocations
 from .models import UserProfile, Wallet, Transaction
 from .serializers import (
     UserProfileSerializer,
     WalletSerializer,
+    WalletHistoryQuerySerializer,
     CreateUserSerializer,
     AddFundsSerializer,
     TransactionSerializer,
     SignUpSerializer,
-    LoginSerializer
+    LoginSerializer,
+    UserListQuerySerializer
 )
-from django.db import transaction
-from django.utils import timezone
 
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserProfileSerializer
+    renderer_classes = ndjson_renderer_classes()
+    
+    # Users listed per query when streaming the whole list
+    stream_chunk_size = 2000
+    list_ordering = ['user_id']
     
     def get_serializer_class(self):
         if self.action == 'create':
@@ -27,21 +37,75 @@ class UserViewSet(viewsets.ModelViewSet):
         return UserProfileSerializer
     
     def list(self, request, *args, **kwargs):
-        """GET /users - Retrieve all registered user data"""
-        users = User.objects.all()
-        data = []
-        for user in users:
-            try:
-                profile = user.profile
-                data.append({
-                    "user_id": str(user.id),
-                    "name": profile.name,
-                    "email": profile.email,
-                    "phone": profile.phone
-                })
-            except UserProfile.DoesNotExist:
-                continue
-        return Response(data)
+        """GET /users - Retrieve all registered user data, streamed as JSON or NDJSON"""
+        params = UserListQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        limit = params.validated_data.get('limit')
+        cursor = params.validated_data.get('cursor')
+        
+        # Users without a profile are not listed, so profiles alone have every column
+        profiles = UserProfile.objects.values('user_id', 'name', 'email', 'phone')
+        headers = {}
+        try:
+            if limit is None:
+                pages = chunks(profiles, self.list_ordering, self.stream_chunk_size, cursor)
+            else:
+                rows = list(keyset(profiles, self.list_ordering, cursor)[:limit + 1])
+                rows, next_cursor = page(rows, self.list_ordering, limit)
+                pages = [rows]
+                if next_cursor:
+                    headers['X-Next-Cursor'] = next_cursor
+        except ValueError:
+            return Response(
+                {"error": "Invalid cursor"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return stream_rows(
+            (self._listed(rows) for rows in pages),
+            ndjson=wants_ndjson(request),
+            headers=headers,
+            request=request
+        )
+    
+    def _listed(self, rows):
+        for row in rows:
+            row['user_id'] = str(row['user_id'])
+        return rows
+    
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        """POST /users/import - Onboard users and vehicles in bulk from CSV or NDJSON
+        
+        The body is the file itself (Content-Type text/csv or application/x-ndjson),
+        or a multipart upload in the "file" field. The per-row error report is
+        streamed back as NDJSON while the import runs.
+        """
+        name = ''
+        content_type = request.content_type or ''
+        if content_type.startswith('multipart/form-data'):
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response(
+                    {"error": "file is required"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            stream, name, content_type = upload, upload.name, upload.content_type or ''
+        else:
+            # Read the raw body as it arrives instead of buffering it
+            stream = request._request
+        
+        if 'ndjson' in content_type or 'jsonl' in content_type or name.endswith(('.ndjson', '.jsonl')):
+            rows = onboarding.read_ndjson(onboarding.text_stream(stream))
+        elif 'csv' in content_type or name.endswith('.csv'):
+            rows = onboarding.read_csv(onboarding.text_stream(stream))
+        else:
+            return Response(
+                {"error": "Send CSV (text/csv) or NDJSON (application/x-ndjson)"},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+        
+        return stream_rows(onboarding.Importer().run(rows), ndjson=True, request=request)
     
     def create(self, request, *args, **kwargs):
         """POST /users - Add a new user to the system"""
@@ -68,9 +132,10 @@ class UserViewSet(viewsets.ModelViewSet):
 
 class WalletViewSet(viewsets.ViewSet):
     """Wallet endpoints for balance and transaction history"""
+    authentication_classes = MACHINE_CLIENT_AUTHENTICATION  # Mobile app
     
     def list(self, request):
-        """GET /user/wallet - Retrieve wallet balance and transaction history"""
+        """GET /user/wallet - Retrieve wallet balance and a page of transaction history"""
         user_id = request.query_params.get('user_id')
         
         if not user_id:
@@ -79,15 +144,27 @@ class WalletViewSet(viewsets.ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        try:
-            user = User.objects.get(id=user_id)
-            wallet = user.wallet
-        except (User.DoesNotExist, Wallet.DoesNotExist):
+        params = WalletHistoryQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+        
+        wallet = history.wallet(user_id).first() if user_id.isdigit() else None
+        if wallet is None:
             return Response(
                 {"error": "User or wallet not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
         
+        if params['history']:
+            try:
+                rows = list(history.transactions(wallet['id'], params))
+            except ValueError:
+                return Response(
+                    {"error": "Invalid cursor"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            wallet = history.with_page(wallet, rows, params)
+        
         serializer = WalletSerializer(wallet)
         return Response(serializer.data)
     
@@ -99,38 +176,27 @@ class WalletViewSet(viewsets.ViewSet):
         user_id = serializer.validated_data['user_id']
         amount = serializer.validated_data['amount']
         
-        try:
-            user = User.objects.get(id=user_id)
-            wallet = user.wallet
-        except (User.DoesNotExist, Wallet.DoesNotExist):
+        wallet_id = Wallet.objects.filter(user_id=user_id).values_list('id', flat=True).first()
+        if wallet_id is None:
             return Response(
                 {"error": "User or wallet not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        with transaction.atomic():
-            wallet.wallet_balance += amount
-            wallet.save()
-            
-            # Create transaction record
-            Transaction.objects.create(
-                wallet=wallet,
-                transaction_id=f"TXN{timezone.now().timestamp()}",
-                transaction_type="top-up",
-                amount=amount
-            )
+        # Single UPDATE, so concurrent top-ups and captures never lose money
+        new_balance = ledger.top_up(wallet_id, amount)
         
         return Response(
             {
                 "message": "Wallet updated successfully",
-                "new_balance": float(wallet.wallet_balance)
+                "new_balance": float(new_balance)
             },
             status=status.HTTP_200_OK
         )
 
 
 class AuthViewSet(viewsets.ViewSet):
-    """Authentication endpoints for signup and login"""
+    """Authentication endpoints for signup, login and logout"""
     
     @action(detail=False, methods=['post'])
     def signup(self, request):
@@ -140,7 +206,7 @@ class AuthViewSet(viewsets.ViewSet):
         user = serializer.save()
         
         # Generate JWT tokens
-        refresh = RefreshToken.for_user(user)
+        refresh = issue_tokens(user)
         
         return Response(
             {
@@ -163,7 +229,7 @@ class AuthViewSet(viewsets.ViewSet):
         profile = user.profile
         
         # Generate JWT tokens
-        refresh = RefreshToken.for_user(user)
+        refresh = issue_tokens(user)
         
         return Response(
             {
@@ -191,6 +257,17 @@ class AuthViewSet(viewsets.ViewSet):
         
         try:
             refresh = RefreshToken(refresh_token)
+            if is_revoked(refresh):
+                return Response(
+                    {"error": "Refresh token has been revoked"},
+                    status=status.HTTP_401_UNAUTHORIZED
+                )
+            # New access tokens go unchecked on the claims-only views, so only active users get one
+            if not User.objects.filter(pk=refresh.get('user_id'), is_active=True).exists():
+                return Response(
+                    {"error": "User is inactive or deleted"},
+                    status=status.HTTP_401_UNAUTHORIZED
+                )
             return Response(
                 {
                     "message": "Token refreshed successfully",
@@ -203,3 +280,33 @@ class AuthViewSet(viewsets.ViewSet):
                 {"error": "Invalid refresh token"},
                 status=status.HTTP_400_BAD_REQUEST
             )
+    
+    @action(detail=False, methods=['post'])
+    def logout(self, request):
+        """POST /api/auth/logout - Revoke a refresh token and every access token made from it"""
+        refresh_token = request.data.get('refresh')
+        
+        if not refresh_token:
+            return Response(
+                {"error": "Refresh token is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            refresh = RefreshToken(refresh_token)
+        except TokenError:
+            return Response(
+                {"error": "Invalid refresh token"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        user_id = refresh.get('user_id')
+        revocations.revoke(refresh, user_id=user_id)
+        # Access tokens issued before the "sid" claim are only revoked one by one
+        if request.auth is not None:
+            revocations.revoke(request.auth, user_id=user_id)
+        
+        return Response(
+            {"message": "Logged out successfully"},
+            status=status.HTTP_200_OK
+        )
@@ -0,0 +1,30 @@
+"""
+Native async vehicle lookup, served through autofare/asgi.py.
+
+Same request and response contract as VehicleViewSet.list.
+"""
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from . import listing
+from .serializers import VehicleListQuerySerializer
+
+
+@require_GET
+async def vehicle_list(request):
+    """GET /async/user/car - Retrieve a page of vehicles, for all users or a specific user"""
+    params = VehicleListQuerySerializer(data=request.GET)
+    if not params.is_valid():
+        return JsonResponse(params.errors, status=400)
+    params = params.validated_data
+    
+    try:
+        rows = [row async for row in listing.vehicles(params)]
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+    
+    vehicles, next_cursor = listing.listed(rows, params)
+    response = JsonResponse(vehicles, safe=False)
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
@@ -0,0 +1,49 @@
+"""
+Vehicle listing, one bounded page at a time.
+
+Rows are read as plain column values (no model instances) and keyset
+paginated on id. Every filter combination has an index that returns its
+rows already in id order, so a page costs the same however many vehicles
+the system or the fleet has:
+
+    no filter               primary key
+    user_id                 (user, id)
+    user_id + vehicle_type  (user, vehicle_type, id)
+    vehicle_type            (vehicle_type, id)
+"""
+from autofare.pagination import keyset, page
+from .models import Vehicle
+
+
+ORDERING = ['id']
+COLUMNS = ['id', 'user_id', 'license_plate', 'vechile_model', 'vechile_color', 'vehicle_type']
+
+
+def vehicles(params):
+    """Queryset of the next page (plus one row) for validated VehicleListQuerySerializer data.
+
+    Raises ValueError for a cursor that was not issued by this endpoint.
+    """
+    queryset = Vehicle.objects.all()
+    if params.get('user_id') is not None:
+        queryset = queryset.filter(user_id=params['user_id'])
+    if params.get('vehicle_type'):
+        queryset = queryset.filter(vehicle_type=params['vehicle_type'])
+    rows = queryset.values(*COLUMNS)
+    return keyset(rows, ORDERING, params.get('cursor'))[:params['limit'] + 1]
+
+
+def listed(rows, params):
+    """(vehicles as VehicleSerializer renders them, next cursor or None)"""
+    rows, next_cursor = page(rows, ORDERING, params['limit'])
+    return [
+        {
+            "car_id": str(row['id']),
+            "user_id": str(row['user_id']),
+            "license_plate": row['license_plate'],
+            "model": row['vechile_model'],
+            "color": row['vechile_color'],
+            "vehicle_type": row['vehicle_type'],
+        }
+        for row in rows
+    ], next_cursor
@@ -0,0 +1,101 @@
+"""
+Benchmark the in-memory plate matcher at production scale.
+
+Usage: python manage.py bench_plate_matching
+       python manage.py bench_plate_matching --plates 5000000 --queries 20000
+
+Indexes --plates synthetic plates (the generate_dataset format, e.g.
+'BKT-0417') without touching the database, then looks up misreads of
+random plates: a look-alike swap, a dropped, an extra or a wrong
+character. Reports build time, index size and lookup latency per kind of
+misread, how often the right vehicle was among the candidates (recall),
+and how often it was the single closest one, which is what a capture
+fallback would charge (top 1).
+"""
+import random
+import resource
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from autofare.benchmark import summarize
+from autofare.datagen import plate_for
+from vehicles.matching import PlateMatcher
+from vehicles.plates import CONFUSABLE, confusion_distance, normalize_plate
+
+
+LOOKALIKES = {}
+for character, digit in CONFUSABLE.items():
+    LOOKALIKES.setdefault(character, []).append(digit)
+    LOOKALIKES.setdefault(digit, []).append(character)
+
+
+def misread(plate, kind, rng):
+    characters = list(plate)
+    positions = [i for i, character in enumerate(characters) if character.isalnum()]
+    if kind == 'lookalike':
+        swappable = [i for i in positions if characters[i] in LOOKALIKES]
+        if not swappable:
+            return None
+        i = rng.choice(swappable)
+        characters[i] = rng.choice(LOOKALIKES[characters[i]])
+    elif kind == 'drop':
+        del characters[rng.choice(positions)]
+    elif kind == 'extra':
+        characters.insert(rng.randrange(len(characters) + 1), rng.choice(string.ascii_uppercase + string.digits))
+    else:
+        i = rng.choice(positions)
+        characters[i] = rng.choice([c for c in string.ascii_uppercase + string.digits if c != characters[i]])
+    return ''.join(characters)
+
+
+class Command(BaseCommand):
+    help = "Measure build time, memory, latency and accuracy of fuzzy plate matching"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plates', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=10000, help="Misreads looked up per kind")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        matcher = PlateMatcher()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        matcher.build((vehicle_id, normalize_plate(plate_for(vehicle_id))) for vehicle_id in range(options['plates']))
+        elapsed = time.perf_counter() - started
+        grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        self.stdout.write(
+            f"Indexed {len(matcher)} plates in {elapsed:.1f}s, peak memory +{grown / 1024:.0f} MiB "
+            f"({len(matcher._state[0])} keys)"
+        )
+
+        self.stdout.write(f"{'misread':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'recall':>10}{'top 1':>10}")
+        for kind in ('lookalike', 'drop', 'extra', 'wrong'):
+            latencies = []
+            recalled = 0
+            top = 0
+            total_started = time.perf_counter()
+            for _ in range(options['queries']):
+                vehicle_id = rng.randrange(options['plates'])
+                read = misread(plate_for(vehicle_id), kind, rng)
+                if read is None:
+                    continue
+                started = time.perf_counter()
+                found = sorted(
+                    (confusion_distance(read, plate_for(match_id)), match_id)
+                    for match_id, _ in matcher.match(read)
+                )
+                latencies.append(time.perf_counter() - started)
+                if any(match_id == vehicle_id for _, match_id in found):
+                    recalled += 1
+                    closest = found[0][0]
+                    if found[0][1] == vehicle_id and (len(found) == 1 or found[1][0] > closest):
+                        top += 1
+            result = summarize(latencies, time.perf_counter() - total_started)
+            count = len(latencies) or 1
+            self.stdout.write(
+                f"{kind:<12}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+                f"{recalled / count:>10.1%}{top / count:>10.1%}"
+            )
@@ -0,0 +1,242 @@
+"""
+Approximate license plate matching for misread plates.
+
+A read that differs from a registered plate only by look-alike characters
+has the same normalized_plate (vehicles/plates.py), which the database
+finds through its index. For reads with a dropped, extra or wrong
+character, PlateMatcher keeps every normalized plate in memory in a
+symmetric-delete index: each plate is filed under itself and under every
+string made by deleting one of its characters. Two plates at most one
+edit apart always share one of those keys, so a lookup costs
+len(plate) + 1 binary searches, however many plates there are.
+
+Keys are 35 bits of hash() of the string packed above a 28-bit plate slot
+into one sorted array('q'). With the normalized plate and vehicle id of
+each slot, that is about 130 bytes per plate, and about twice that while
+building (some 15 seconds per million plates; see
+``python manage.py bench_plate_matching``). hash() is salted per process,
+which is fine because each process builds its own index. Hash collisions
+only add candidates, and every candidate is checked.
+
+The index is built on first use and follows the Vehicle table the same
+way the plate filter does: vehicles saved in this process are added by
+the signals in vehicles/signals.py, and vehicles created elsewhere within
+PLATE_FILTER_REFRESH seconds. Newly added plates are kept in a dict until
+there are MERGE_AFTER of them; the index is then rebuilt. Deleted
+vehicles and changed plates leave stale entries until that rebuild.
+candidates() reads the matched vehicles back from the database, so stale
+entries are never returned.
+
+Usage:
+    candidates('XYZ-98')            # ranked Candidates, closest first
+    capture_match('XY2-987')        # the one Candidate a capture may charge, or None
+"""
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+
+from .models import Vehicle
+from .plates import confusion_distance, normalize_plate, within_one_edit
+from .watermarks import Watermark
+
+
+SLOT_BITS = 28
+HASH_MASK = (1 << (63 - SLOT_BITS)) - 1
+SLOT_MASK = (1 << SLOT_BITS) - 1
+# Keys sorted per chunk before the chunks are merged, to bound build memory
+CHUNK_KEYS = 1 << 20
+MERGE_AFTER = 50000
+
+Candidate = namedtuple(
+    'Candidate', ['license_plate', 'distance', 'vehicle_id', 'vehicle_type', 'user_id', 'wallet_id']
+)
+
+
+def _variants(normalized):
+    # May repeat a variant (deleting either of two equal neighbours); slots are deduplicated on lookup
+    return [normalized] + [normalized[:i] + normalized[i + 1:] for i in range(len(normalized))]
+
+
+def _hash(variant):
+    return hash(variant) & HASH_MASK
+
+
+class PlateMatcher:
+    """Symmetric-delete index of normalized plates, matching within one edit"""
+
+    def __init__(self, refresh_interval=None):
+        self.refresh_interval = (
+            refresh_interval if refresh_interval is not None else getattr(settings, 'PLATE_FILTER_REFRESH', 5)
+        )
+        self._lock = threading.Lock()
+        # (sorted keys, normalized plate per slot, vehicle id per slot, variant hash -> slots added since)
+        self._state = None
+        self._watermark = Watermark()
+        self._added = {}            # vehicle id -> normalized plate added since the last build
+        self._next_refresh = 0.0
+
+    def __len__(self):
+        state = self._state
+        return len(state[1]) if state is not None else 0
+
+    def build(self, rows):
+        """Index (vehicle id, normalized plate) rows, replacing the current index"""
+        plates = []
+        vehicle_ids = array('q')
+        chunks = []
+        pending = []
+        for vehicle_id, normalized in rows:
+            slot = len(plates)
+            plates.append(normalized)
+            vehicle_ids.append(vehicle_id)
+            pending.extend([(hash(variant) & HASH_MASK) << SLOT_BITS | slot for variant in _variants(normalized)])
+            if len(pending) >= CHUNK_KEYS:
+                pending.sort()
+                chunks.append(array('q', pending))
+                pending = []
+        pending.sort()
+        chunks.append(array('q', pending))
+        keys = chunks[0] if len(chunks) == 1 else array('q', heapq.merge(*chunks))
+        self._state = (keys, plates, vehicle_ids, {})
+        self._added = {}
+
+    def add(self, vehicle_id, normalized):
+        """Index one more plate. Ignored until the index has been built."""
+        with self._lock:
+            if self._state is not None:
+                self._add(vehicle_id, normalized)
+
+    def match(self, plate):
+        """(vehicle id, normalized plate) of indexed plates within one edit of plate's normalized form"""
+        state = self._state
+        if state is None:
+            return []
+        keys, plates, vehicle_ids, recent = state
+        normalized = normalize_plate(plate)
+        slots = set()
+        for variant in set(_variants(normalized)):
+            hashed = _hash(variant)
+            start = bisect_left(keys, hashed << SLOT_BITS)
+            end = (hashed + 1) << SLOT_BITS
+            while start < len(keys) and keys[start] < end:
+                slots.add(keys[start] & SLOT_MASK)
+                start += 1
+            slots.update(recent.get(hashed, ()))
+        return [
+            (vehicle_ids[slot], plates[slot])
+            for slot in slots
+            if within_one_edit(normalized, plates[slot])
+        ]
+
+    def due(self):
+        return time.monotonic() >= self._next_refresh
+
+    def refresh(self):
+        """Build the index if needed, then add vehicles created since the last refresh"""
+        with self._lock:
+            if self._state is None or len(self._added) > MERGE_AFTER:
+                self._build()
+            else:
+                rows = list(
+                    Vehicle.objects.filter(id__gt=self._watermark.since())
+                    .values_list('id', 'normalized_plate')
+                )
+                for vehicle_id, normalized in rows:
+                    # Rows in the watermark overlap may already be indexed
+                    if self._added.get(vehicle_id) != normalized:
+                        self._add(vehicle_id, normalized)
+                if rows:
+                    self._watermark.advance(max(vehicle_id for vehicle_id, _ in rows))
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def reset(self):
+        with self._lock:
+            self._state = None
+            self._added = {}
+            self._watermark.clear()
+            self._next_refresh = 0.0
+
+    # Called with self._lock held
+
+    def _build(self):
+        max_id = 0
+
+        def rows():
+            nonlocal max_id
+            for vehicle_id, normalized in Vehicle.objects.order_by().values_list('id', 'normalized_plate').iterator(
+                chunk_size=10000
+            ):
+                max_id = max(max_id, vehicle_id)
+                yield vehicle_id, normalized
+
+        self.build(rows())
+        self._watermark.clear()
+        self._watermark.advance(max_id)
+
+    def _add(self, vehicle_id, normalized):
+        keys, plates, vehicle_ids, recent = self._state
+        slot = len(plates)
+        plates.append(normalized)
+        vehicle_ids.append(vehicle_id)
+        for variant in _variants(normalized):
+            recent.setdefault(_hash(variant), []).append(slot)
+        self._added[vehicle_id] = normalized
+
+
+plate_matcher = PlateMatcher()
+
+
+def _ranked(plate, rows, limit=None):
+    found = sorted(
+        (
+            Candidate(license_plate, confusion_distance(plate, license_plate), vehicle_id, vehicle_type,
+                      user_id, wallet_id)
+            for license_plate, vehicle_id, vehicle_type, user_id, wallet_id in rows
+        ),
+        key=lambda candidate: (candidate.distance, candidate.license_plate)
+    )
+    return found[:limit] if limit else found
+
+
+def candidates(plate, limit=5):
+    """Registered plates within one edit of plate (look-alikes are free), closest first"""
+    if plate_matcher.due():
+        plate_matcher.refresh()
+    normalized = normalize_plate(plate)
+    vehicle_ids = [vehicle_id for vehicle_id, _ in plate_matcher.match(plate)]
+    if not vehicle_ids:
+        return []
+    rows = Vehicle.objects.filter(id__in=vehicle_ids).values_list(
+        'license_plate', 'id', 'vehicle_type', 'user_id', 'user__wallet__id', 'normalized_plate'
+    )
+    # The index may hold a plate that has since changed or been deleted
+    return _ranked(plate, [row[:5] for row in rows if within_one_edit(normalized, row[5])], limit)
+
+
+def capture_match(plate):
+    """The vehicle a capture of an unregistered plate should be charged to, or None.
+
+    Only a single closest candidate within PLATE_FUZZY_CAPTURE_DISTANCE
+    qualifies; with a tie, charging either could bill the wrong owner.
+    Below a distance of 1 only look-alike substitutions qualify, and those
+    are found through the normalized_plate index without the in-memory
+    matcher.
+    """
+    threshold = settings.PLATE_FUZZY_CAPTURE_DISTANCE
+    if threshold < 1:
+        rows = Vehicle.objects.filter(normalized_plate=normalize_plate(plate)).values_list(
+            'license_plate', 'id', 'vehicle_type', 'user_id', 'user__wallet__id'
+        )
+        found = _ranked(plate, rows)
+    else:
+        found = candidates(plate, limit=2)
+    if not found or found[0].distance > threshold:
+        return None
+    if len(found) > 1 and found[1].distance == found[0].distance:
+        return None
+    return found[0]
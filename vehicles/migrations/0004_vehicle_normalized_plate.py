@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+from vehicles.plates import normalize_plate
+
+
+def fill_normalized_plates(apps, schema_editor):
+    Vehicle = apps.get_model('vehicles', 'Vehicle')
+    last_id = 0
+    while True:
+        batch = list(Vehicle.objects.filter(id__gt=last_id).order_by('id').only('id', 'license_plate')[:5000])
+        if not batch:
+            break
+        for vehicle in batch:
+            vehicle.normalized_plate = normalize_plate(vehicle.license_plate)
+        Vehicle.objects.bulk_update(batch, ['normalized_plate'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicles', '0003_vehicle_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vehicle',
+            name='normalized_plate',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=20),
+        ),
+        migrations.RunPython(fill_normalized_plates, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,29 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
+
+from .plates import normalize_plate
+
+
+class VehicleQuerySet(models.QuerySet):
+    """Bulk plate changes stamp updated_at like save() does, so other processes pick them up"""
+
+    def update(self, **kwargs):
+        if 'license_plate' in kwargs:
+            kwargs.setdefault('updated_at', timezone.now())
+            if isinstance(kwargs['license_plate'], str):
+                kwargs.setdefault('normalized_plate', normalize_plate(kwargs['license_plate']))
+        return super().update(**kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        if 'license_plate' in fields:
+            now = timezone.now()
+            for vehicle in objs:
+                vehicle.normalized_plate = normalize_plate(vehicle.license_plate)
+                vehicle.updated_at = now
+            fields = [*fields, *(name for name in ('normalized_plate', 'updated_at') if name not in fields)]
+        return super().bulk_update(objs, fields, batch_size=batch_size)
+
 
 class Vehicle(models.Model):
     VEHICLE_TYPES = [
@@ -10,24 +34,51 @@ class Vehicle(models.Model):
         ('minibus', 'Minibus'),
         ('van', 'Van'),
     ]
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # Indexed by vehicle_user_idx below, which also orders a user's vehicles by id
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False)
     vehicle_type = models.CharField(max_length=20, choices=VEHICLE_TYPES)
     license_plate = models.CharField(max_length=20, unique=True)
+    # license_plate with OCR look-alikes folded (vehicles/plates.py), set on save.
+    # Bulk inserts must fill it themselves.
+    normalized_plate = models.CharField(max_length=20, db_index=True, editable=False, default='')
     vechile_color = models.CharField(max_length=20 , default='white')
     vechile_model = models.CharField(max_length=50)
-   
+    # Lets other processes pick up changed plates (vehicles/plate_filter.py).
+    # Bulk inserts leave it empty; their vehicles are found by id instead.
+    updated_at = models.DateTimeField(auto_now=True, null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Vehicle listing filters, each in id (keyset) order; see vehicles/listing.py
+            models.Index(fields=['user', 'id'], name='vehicle_user_idx'),
+            models.Index(fields=['user', 'vehicle_type', 'id'], name='vehicle_user_type_idx'),
+            models.Index(fields=['vehicle_type', 'id'], name='vehicle_type_idx'),
+        ]
+
+    objects = VehicleQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.normalized_plate = normalize_plate(self.license_plate)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'license_plate' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'normalized_plate', 'updated_at'}
+        super().save(*args, **kwargs)
 
     @classmethod
     def get_owner_by_plate(cls, plate):
-        try:
-            vehicle = cls.objects.get(license_plate=plate)
-            return vehicle.user
-        except cls.DoesNotExist:
-            return None
+        vehicle = cls.get_vehicle_by_plate(plate)
+        return vehicle.user if vehicle else None
 
     @classmethod
     def get_vehicle_by_plate(cls, plate):
         try:
-            return cls.objects.get(license_plate=plate)
+            return cls.objects.select_related('user').get(license_plate=plate)
         except cls.DoesNotExist:
             return None
+
+    @classmethod
+    def get_plate_records(cls, plates):
+        """Return (plate, vehicle_id, vehicle_type, user_id, wallet_id) rows for the given plates"""
+        return cls.objects.filter(license_plate__in=plates).values_list(
+            'license_plate', 'id', 'vehicle_type', 'user_id', 'user__wallet__id'
+        )
@@ -0,0 +1,270 @@
+"""
+Bloom filter of every registered license plate, in front of plate lookups.
+
+Many camera reads are unregistered plates, foreign vehicles or OCR
+garbage. The filter answers "definitely not registered" from memory, so
+those reads never reach the plate cache or the database; a "maybe" goes
+on to the normal lookup. At a 1% false positive rate it costs about 1.2
+bytes per plate.
+
+The filter is built from the Vehicle table on first use and then kept
+current:
+- vehicles saved in this process are added by the signals in
+  vehicles/signals.py, and bulk imports add their plates directly
+- every PLATE_FILTER_REFRESH seconds, vehicles with an id past the
+  filter's watermark, or saved (updated_at, which bulk plate updates
+  through VehicleQuerySet also stamp) since the previous refresh, are
+  added. That picks up vehicles created, and plates changed, by
+  other processes (see vehicles/watermarks.py).
+
+A Bloom filter cannot forget a plate, so deleted vehicles stay in it
+until the next rebuild. That only makes a false positive, which the
+normal lookup answers. The filter is rebuilt by itself once it holds
+more plates than it was sized for, and by
+``python manage.py build_plate_filter``.
+
+With PLATE_FILTER_PATH set, the filter lives in that file and is memory
+mapped, so every worker process on the host shares one copy. Writers
+take an exclusive lock on PLATE_FILTER_PATH + '.lock'. Setting a bit is
+a read-modify-write of a whole byte, so an unlocked write could lose
+another process's bit. Readers take no lock. A rebuild writes a new file
+and renames it into place; each process switches to it at its next
+refresh.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Vehicle
+from .watermarks import OVERLAP, Watermark
+
+
+MAGIC = b'PLATEBF2'
+# magic, bits, hashes, capacity, plates added, highest vehicle id added, build time
+HEADER = struct.Struct('<8sQIQQQd')
+OFFSET = 64
+MIN_CAPACITY = 100000
+
+
+def _size(capacity, fp_rate):
+    bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    bits = (bits + 7) // 8 * 8
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+def _positions(plate, bits, hashes):
+    digest = hashlib.blake2b(plate.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'little')
+    step = int.from_bytes(digest[8:], 'little') | 1
+    return [(first + i * step) % bits for i in range(hashes)]
+
+
+def _set(buffer, bits, hashes, plates):
+    for plate in plates:
+        for position in _positions(plate, bits, hashes):
+            buffer[OFFSET + (position >> 3)] |= 1 << (position & 7)
+
+
+class PlateFilter:
+    """Approximate set of registered plates: no false negatives, few false positives"""
+
+    def __init__(self, path=None, fp_rate=None, refresh_interval=None):
+        self.path = path if path is not None else getattr(settings, 'PLATE_FILTER_PATH', None)
+        self.path = str(self.path) if self.path else None
+        self.fp_rate = fp_rate or getattr(settings, 'PLATE_FILTER_FP_RATE', 0.01)
+        self.refresh_interval = (
+            refresh_interval if refresh_interval is not None else getattr(settings, 'PLATE_FILTER_REFRESH', 5)
+        )
+        self._lock = threading.Lock()
+        self._state = None           # (buffer, bits, hashes), swapped as a whole
+        self._inode = None
+        self._watermark = Watermark()
+        self._changed = Watermark()  # time.time() of recent refreshes
+        self._next_refresh = 0.0
+        self.stale = 0               # plates deleted since the filter was built
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'PLATE_FILTER_ENABLED', True)
+
+    def due(self):
+        """Whether might_contain needs refresh() first (it must not query the database itself)"""
+        return time.monotonic() >= self._next_refresh
+
+    def might_contain(self, plate):
+        """False only if no vehicle has this plate"""
+        state = self._state
+        if state is None:
+            return True
+        buffer, bits, hashes = state
+        for position in _positions(plate, bits, hashes):
+            if not buffer[OFFSET + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def refresh(self):
+        """Build or map the filter if needed, then add vehicles created or saved since the last refresh"""
+        with self._lock:
+            now = time.monotonic()
+            started = time.time()
+            if self._state is None or self._replaced():
+                self._load()
+            _, _, _, _, _, known, built_at = self._header()
+            since = self._watermark.since(default=known)
+            # Saves that committed late, or on a host whose clock is behind, are read again in the overlap
+            changed = datetime.fromtimestamp(self._changed.since(default=built_at - OVERLAP), timezone.utc)
+            rows = list(
+                Vehicle.objects.filter(Q(id__gt=since) | Q(updated_at__gte=changed)).values_list('id', 'license_plate')
+            )
+            if rows:
+                # Vehicles up to the watermark were counted before; a changed plate of one is not counted
+                # again, which a rebuild corrects
+                self._add(
+                    [plate for _, plate in rows], max(pk for pk, _ in rows),
+                    counted=sum(1 for pk, _ in rows if pk > known)
+                )
+            _, _, _, capacity, count, _, _ = self._header()
+            if count > capacity:
+                self._build()
+            self._watermark.advance(self._header()[5])
+            self._changed.advance(started)
+            self._next_refresh = now + self.refresh_interval
+
+    def add(self, plates):
+        """Add plates saved by this process. Ignored until the filter has been built."""
+        with self._lock:
+            if self._state is not None:
+                self._add(plates)
+
+    def discard(self, plate):
+        # Bloom filters cannot remove; the plate stays a false positive until the next rebuild
+        self.stale += 1
+
+    def rebuild(self):
+        """Build the filter again from the Vehicle table, dropping deleted plates"""
+        with self._lock:
+            self._build()
+            self._watermark.clear()
+            self._watermark.advance(self._header()[5])
+            self._changed.clear()
+
+    def reset(self):
+        """Forget the filter; the next refresh builds or maps it again"""
+        with self._lock:
+            self._state = None
+            self._inode = None
+            self._watermark.clear()
+            self._changed.clear()
+            self._next_refresh = 0.0
+            self.stale = 0
+
+    def stats(self):
+        state = self._state
+        if state is None:
+            return {"built": False}
+        _, bits, hashes, capacity, count, max_id, _ = self._header()
+        return {
+            "built": True, "shared": bool(self.path), "bits": bits, "hashes": hashes,
+            "bytes": OFFSET + bits // 8, "capacity": capacity, "plates": count,
+            "max_vehicle_id": max_id, "stale": self.stale,
+        }
+
+    # Called with self._lock held
+
+    def _header(self):
+        return HEADER.unpack_from(self._state[0], 0)
+
+    def _write_header(self, buffer, bits, hashes, capacity, count, max_id, built_at):
+        HEADER.pack_into(buffer, 0, MAGIC, bits, hashes, capacity, count, max_id, built_at)
+
+    @contextmanager
+    def _file_lock(self):
+        if not self.path:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _add(self, plates, max_id=0, counted=None):
+        buffer, bits, hashes = self._state
+        with self._file_lock():
+            _, _, _, capacity, count, stored_max, built_at = self._header()
+            _set(buffer, bits, hashes, plates)
+            count += len(plates) if counted is None else counted
+            self._write_header(buffer, bits, hashes, capacity, count, max(stored_max, max_id), built_at)
+
+    def _replaced(self):
+        if not self.path:
+            return False
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def _load(self):
+        if not self.path:
+            self._build()
+        elif not self._map():
+            # One worker builds the file; the others wait for it and map it
+            with self._file_lock():
+                if not self._map():
+                    self._build(locked=True)
+        self._watermark.clear()
+        # The first refresh re-reads plates changed since the filter was built
+        self._changed.clear()
+
+    def _map(self):
+        try:
+            with open(self.path, 'r+b') as handle:
+                buffer = mmap.mmap(handle.fileno(), 0)
+                inode = os.fstat(handle.fileno()).st_ino
+        except (FileNotFoundError, ValueError):
+            return False
+        magic, bits, hashes = HEADER.unpack_from(buffer, 0)[:3]
+        if magic != MAGIC or len(buffer) != OFFSET + bits // 8:
+            return False
+        self._state = (buffer, bits, hashes)
+        self._inode = inode
+        return True
+
+    def _build(self, locked=False):
+        built_at = time.time()
+        capacity = max(MIN_CAPACITY, 2 * Vehicle.objects.count())
+        bits, hashes = _size(capacity, self.fp_rate)
+        buffer = bytearray(OFFSET + bits // 8)
+        count = 0
+        max_id = 0
+        rows = Vehicle.objects.order_by().values_list('id', 'license_plate').iterator(chunk_size=10000)
+        for pk, plate in rows:
+            _set(buffer, bits, hashes, [plate])
+            count += 1
+            max_id = max(max_id, pk)
+        self._write_header(buffer, bits, hashes, capacity, count, max_id, built_at)
+        self.stale = 0
+        if not self.path:
+            self._state = (buffer, bits, hashes)
+            return
+        # flock is per open file, so taking it again here would wait on ourselves
+        with nullcontext() if locked else self._file_lock():
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary, 'wb') as handle:
+                handle.write(buffer)
+            os.replace(temporary, self.path)
+            self._map()
+
+
+plate_filter = PlateFilter()
@@ -0,0 +1,117 @@
+"""
+License plate normalization for OCR-tolerant matching.
+
+Camera reads confuse characters that look alike (0/O, 1/I, 8/B) and
+vary in spacing and dashes. normalize_plate maps a plate to a form those
+differences cannot change: upper case, letters and digits only, digits in
+ASCII, and each group of look-alike characters folded onto one digit.
+Vehicle stores it as normalized_plate, so a read that differs from the
+registered plate only by look-alikes is found with one indexed lookup.
+
+confusion_distance ranks candidates: an edit distance in which swapping
+look-alikes costs CONFUSION_COST instead of 1.
+"""
+import unicodedata
+
+
+# Each character is read as, or instead of, the digit it maps to
+CONFUSABLE = {
+    'O': '0', 'Q': '0', 'D': '0',
+    'I': '1', 'L': '1',
+    'Z': '2',
+    'S': '5',
+    'G': '6',
+    'B': '8',
+}
+CONFUSION_COST = 0.25
+
+
+def _clean(plate):
+    if plate.isascii():
+        return ''.join(filter(str.isalnum, plate.upper()))
+    characters = []
+    for character in plate.upper():
+        if character.isdecimal():
+            characters.append(str(unicodedata.decimal(character)))
+        elif character.isalnum():
+            characters.append(character)
+    return ''.join(characters)
+
+
+def _fold(cleaned):
+    return ''.join(CONFUSABLE.get(character, character) for character in cleaned)
+
+
+def normalize_plate(plate):
+    """'xyz-987' -> 'XY2987'"""
+    return _fold(_clean(plate))
+
+
+def within_one_edit(first, second):
+    """Whether two strings are at most one insertion, deletion or substitution apart"""
+    if first == second:
+        return True
+    if abs(len(first) - len(second)) > 1:
+        return False
+    if len(first) < len(second):
+        first, second = second, first
+    index = 0
+    while index < len(second) and first[index] == second[index]:
+        index += 1
+    if len(first) == len(second):
+        return first[index + 1:] == second[index + 1:]
+    return first[index + 1:] == second[index:]
+
+
+def _substitution(first, second):
+    if first == second:
+        return 0.0
+    if CONFUSABLE.get(first, first) == CONFUSABLE.get(second, second):
+        return CONFUSION_COST
+    return 1.0
+
+
+def _aligned(first, second):
+    return sum(_substitution(a, b) for a, b in zip(first, second))
+
+
+def _one_gap(longer, shorter):
+    # Cheapest alignment that skips exactly one character of longer
+    prefix = [0.0]
+    for a, b in zip(longer, shorter):
+        prefix.append(prefix[-1] + _substitution(a, b))
+    suffix = [0.0]
+    for a, b in zip(reversed(longer), reversed(shorter)):
+        suffix.append(suffix[-1] + _substitution(a, b))
+    return 1 + min(prefix[i] + suffix[len(shorter) - i] for i in range(len(longer)))
+
+
+def confusion_distance(read, plate):
+    """Edit distance between two plates where look-alike substitutions cost CONFUSION_COST"""
+    read, plate = _clean(read), _clean(plate)
+    # Matched plates are nearly aligned. Other alignments need at least two
+    # more insertions or deletions, so a cheap enough aligned cost is exact.
+    if len(read) == len(plate):
+        cost = _aligned(read, plate)
+        if cost <= 2:
+            return cost
+    elif abs(len(read) - len(plate)) == 1:
+        longer, shorter = (read, plate) if len(read) > len(plate) else (plate, read)
+        cost = _one_gap(longer, shorter)
+        if cost <= 3:
+            return cost
+    return _edit_distance(read, plate)
+
+
+def _edit_distance(read, plate):
+    previous = [float(column) for column in range(len(plate) + 1)]
+    for row, read_character in enumerate(read, start=1):
+        current = [float(row)]
+        for column, plate_character in enumerate(plate, start=1):
+            current.append(min(
+                previous[column] + 1,
+                current[column - 1] + 1,
+                previous[column - 1] + _substitution(read_character, plate_character),
+            ))
+        previous = current
+    return previous[-1]
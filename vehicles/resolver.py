@@ -0,0 +1,183 @@
+"""
+Cached license plate resolution for the toll capture path.
+
+A plate resolves to the ids the capture needs (vehicle, vehicle type, owner
+and wallet), so a known plate costs no lookup queries. Entries are bounded
+by size (least recently used first) and by age, and are invalidated by the
+model signals in vehicles/signals.py. Signals only reach the current
+process, so in multi-process deployments the TTL bounds how stale another
+worker's entry can be.
+
+Plates the Bloom filter in vehicles/plate_filter.py rules out are answered
+as misses before the cache or the database is consulted. With
+PLATE_FUZZY_CAPTURE on, a plate that is still not found resolves to the
+vehicle it is an unambiguous misread of (vehicles/matching.py); those
+answers are not cached.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from autofare import metrics
+from . import matching
+from .models import Vehicle
+from .plate_filter import plate_filter
+
+
+PlateRecord = namedtuple('PlateRecord', ['vehicle_id', 'vehicle_type', 'user_id', 'wallet_id'])
+
+
+class PlateResolver:
+    """Bounded LRU/TTL cache of plate -> PlateRecord backed by Vehicle.get_plate_records"""
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or getattr(settings, 'PLATE_CACHE_SIZE', 100000)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'PLATE_CACHE_TTL', 300)
+        self._entries = OrderedDict()  # plate -> (expires_at, record)
+        self._plates_by_user = {}
+        self._plate_by_vehicle = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, plate):
+        """Return the PlateRecord for a plate, or None if no vehicle has it"""
+        return self.resolve_many([plate]).get(plate)
+
+    def resolve_many(self, plates):
+        """Resolve several plates with at most one query for the ones not cached"""
+        if plate_filter.enabled and plate_filter.due():
+            plate_filter.refresh()
+        plates = set(plates)
+        found, missing, now = self._cached(self._filtered(plates))
+        if missing:
+            found.update(self._load(Vehicle.get_plate_records(missing), now))
+        if self.fuzzy:
+            for plate in plates - found.keys():
+                record = self._corrected(matching.capture_match(plate))
+                if record is not None:
+                    found[plate] = record
+        return found
+
+    async def aresolve(self, plate):
+        """Async resolve() for views served under ASGI"""
+        if plate_filter.enabled and plate_filter.due():
+            await sync_to_async(plate_filter.refresh)()
+        found, missing, now = self._cached(self._filtered({plate}))
+        if missing:
+            rows = [row async for row in Vehicle.get_plate_records(missing)]
+            found.update(self._load(rows, now))
+        if plate not in found and self.fuzzy:
+            return self._corrected(await sync_to_async(matching.capture_match)(plate))
+        return found.get(plate)
+
+    @property
+    def fuzzy(self):
+        return getattr(settings, 'PLATE_FUZZY_CAPTURE', False)
+
+    def _corrected(self, candidate):
+        if candidate is None:
+            return None
+        metrics.plate_cache.inc(result='corrected')
+        return PlateRecord(candidate.vehicle_id, candidate.vehicle_type, candidate.user_id, candidate.wallet_id)
+
+    def _filtered(self, plates):
+        if not plate_filter.enabled:
+            return plates
+        kept = {plate for plate in plates if plate_filter.might_contain(plate)}
+        if len(kept) < len(plates):
+            metrics.plate_cache.inc(len(plates) - len(kept), result='filtered')
+        return kept
+
+    def _cached(self, plates):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for plate in plates:
+                entry = self._entries.get(plate)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(plate)
+                    found[plate] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry is not None:
+                        self._forget(plate)
+                    missing.append(plate)
+                    self.misses += 1
+        if found:
+            metrics.plate_cache.inc(len(found), result='hit')
+        if missing:
+            metrics.plate_cache.inc(len(missing), result='miss')
+        return found, missing, now
+
+    def _load(self, rows, now):
+        loaded = {
+            plate: PlateRecord(vehicle_id, vehicle_type, user_id, wallet_id)
+            for plate, vehicle_id, vehicle_type, user_id, wallet_id in rows
+        }
+        with self._lock:
+            for plate, record in loaded.items():
+                self._store(plate, record, now + self.ttl)
+        return loaded
+
+    def invalidate_plate(self, plate):
+        with self._lock:
+            self._forget(plate)
+
+    def invalidate_vehicle(self, vehicle_id):
+        with self._lock:
+            plate = self._plate_by_vehicle.get(vehicle_id)
+            if plate is not None:
+                self._forget(plate)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for plate in list(self._plates_by_user.get(user_id, ())):
+                self._forget(plate)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plates_by_user.clear()
+            self._plate_by_vehicle.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _store(self, plate, record, expires_at):
+        self._forget(plate)
+        self._entries[plate] = (expires_at, record)
+        self._plates_by_user.setdefault(record.user_id, set()).add(plate)
+        self._plate_by_vehicle[record.vehicle_id] = plate
+        while len(self._entries) > self.max_size:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, plate):
+        entry = self._entries.pop(plate, None)
+        if entry is None:
+            return
+        record = entry[1]
+        plates = self._plates_by_user.get(record.user_id)
+        if plates is not None:
+            plates.discard(plate)
+            if not plates:
+                del self._plates_by_user[record.user_id]
+        if self._plate_by_vehicle.get(record.vehicle_id) == plate:
+            del self._plate_by_vehicle[record.vehicle_id]
+
+
+plate_resolver = PlateResolver()
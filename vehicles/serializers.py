@@ -4,9 +4,9 @@ from .models import Vehicle
 
 class VehicleSerializer(serializers.ModelSerializer):
     car_id = serializers.CharField(source='id', read_only=True)
-    user_id = serializers.CharField(source='user.id', read_only=True)
-    model = serializers.CharField(source='vehicle_model')
-    color = serializers.CharField(source='vehicle_color')
+    user_id = serializers.CharField(read_only=True)
+    model = serializers.CharField(source='vechile_model')
+    color = serializers.CharField(source='vechile_color')
     
     class Meta:
         model = Vehicle
@@ -14,10 +14,25 @@ class VehicleSerializer(serializers.ModelSerializer):
         read_only_fields = ['car_id', 'user_id']
 
 
+class VehicleListQuerySerializer(serializers.Serializer):
+    """Query parameters of GET /user/car"""
+    user_id = serializers.IntegerField(min_value=1, required=False)
+    vehicle_type = serializers.ChoiceField(choices=Vehicle.VEHICLE_TYPES, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+    cursor = serializers.CharField(required=False)
+
+
+class PlateMatchQuerySerializer(serializers.Serializer):
+    """Query parameters of GET /user/car/match"""
+    # A misread can carry extra characters
+    plate = serializers.CharField(max_length=40)
+    limit = serializers.IntegerField(min_value=1, max_value=20, default=5)
+
+
 class CreateVehicleSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField(write_only=True)
-    model = serializers.CharField(source='vehicle_model')
-    color = serializers.CharField(source='vehicle_color')
+    model = serializers.CharField(source='vechile_model')
+    color = serializers.CharField(source='vechile_color')
     
     class Meta:
         model = Vehicle
@@ -0,0 +1,44 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from users.models import Wallet
+from .models import Vehicle
+from .matching import plate_matcher
+from .plate_filter import plate_filter
+from .resolver import plate_resolver
+
+
+@receiver([post_save, post_delete], sender=Vehicle)
+def invalidate_vehicle_plate(sender, instance, **kwargs):
+    # The plate may have changed, so drop both the old and the current entry
+    plate_resolver.invalidate_vehicle(instance.pk)
+    plate_resolver.invalidate_plate(instance.license_plate)
+
+
+@receiver(post_save, sender=Vehicle)
+def add_filter_plate(sender, instance, **kwargs):
+    plate_filter.add([instance.license_plate])
+    plate_matcher.add(instance.pk, instance.normalized_plate)
+
+
+@receiver(post_delete, sender=Vehicle)
+def discard_filter_plate(sender, instance, **kwargs):
+    plate_filter.discard(instance.license_plate)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_plates(sender, instance, **kwargs):
+    plate_resolver.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Wallet)
+def invalidate_wallet_owner_plates(sender, instance, created, **kwargs):
+    # Balance updates don't change the cached ids; only a new wallet does
+    if created:
+        plate_resolver.invalidate_user(instance.user_id)
+
+
+@receiver(post_delete, sender=Wallet)
+def invalidate_deleted_wallet_plates(sender, instance, **kwargs):
+    plate_resolver.invalidate_user(instance.user_id)
@@ -1,3 +1,305 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from collections import deque
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from users.models import Wallet
+from .matching import candidates, capture_match, plate_matcher
+from .models import Vehicle
+from .plate_filter import PlateFilter, plate_filter
+from .plates import confusion_distance, normalize_plate, within_one_edit
+from .resolver import PlateResolver, plate_resolver
+from .watermarks import OVERLAP
+
+
+def age(plates, seconds=OVERLAP + 1):
+    """Move plates' past refreshes back in time, so the next refresh is past their overlap"""
+    plates._watermark._marks = deque((at - seconds, max_id) for at, max_id in plates._watermark._marks)
+    plates._changed._marks = deque((at - seconds, since - seconds) for at, since in plates._changed._marks)
+
+
+class PlateFilterTests(TestCase):
+    """The plate filter never rejects a registered plate, whichever process registered it"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='plates@example.com')
+        # Another process: the signals of this one never reach it
+        self.other = PlateFilter(path='', refresh_interval=0)
+        self.other.refresh()
+
+    def tearDown(self):
+        plate_filter.reset()
+
+    def vehicle(self, plate):
+        return Vehicle.objects.create(user=self.user, license_plate=plate, vehicle_type='car', vechile_model='Golf')
+
+    def test_saved_vehicle_is_added_in_this_process(self):
+        plate_filter.reset()
+        plate_filter.refresh()
+        self.assertFalse(plate_filter.might_contain('NEW-111'))
+        self.vehicle('NEW-111')
+        self.assertTrue(plate_filter.might_contain('NEW-111'))
+
+    def test_created_vehicle_is_added_on_refresh(self):
+        age(self.other)
+        self.vehicle('NEW-222')
+        self.assertFalse(self.other.might_contain('NEW-222'))
+        self.other.refresh()
+        self.assertTrue(self.other.might_contain('NEW-222'))
+
+    def test_changed_plate_is_added_on_refresh(self):
+        vehicle = self.vehicle('OLD-333')
+        self.other.refresh()
+        age(self.other)
+        vehicle.license_plate = 'XYZ999'
+        vehicle.save()
+        self.other.refresh()
+        self.assertTrue(self.other.might_contain('XYZ999'))
+
+    def test_changed_plate_is_added_with_its_fields(self):
+        vehicle = self.vehicle('OLD-444')
+        self.other.refresh()
+        age(self.other)
+        vehicle.license_plate = 'XYZ444'
+        vehicle.save(update_fields=['license_plate'])
+        self.other.refresh()
+        self.assertTrue(self.other.might_contain('XYZ444'))
+
+    def test_plates_changed_in_bulk_are_added_on_refresh(self):
+        first, second = self.vehicle('OLD-777'), self.vehicle('OLD-888')
+        self.other.refresh()
+        age(self.other)
+        Vehicle.objects.filter(pk=first.pk).update(license_plate='BULK-777')
+        second.license_plate = 'BULK-888'
+        Vehicle.objects.bulk_update([second], ['license_plate'])
+        self.other.refresh()
+        self.assertTrue(self.other.might_contain('BULK-777'))
+        self.assertTrue(self.other.might_contain('BULK-888'))
+        self.assertEqual(Vehicle.objects.get(pk=first.pk).normalized_plate, normalize_plate('BULK-777'))
+
+    def test_change_committed_after_a_refresh_is_read_again(self):
+        vehicle = self.vehicle('OLD-555')
+        self.other.refresh()
+        age(self.other)
+        self.other.refresh()
+        # Stamped before the refresh above, visible only after it
+        Vehicle.objects.filter(pk=vehicle.pk).update(
+            license_plate='LATE-555', updated_at=timezone.now() - timedelta(seconds=30)
+        )
+        self.other.refresh()
+        self.assertTrue(self.other.might_contain('LATE-555'))
+
+    def test_shared_file_follows_changes_made_before_it_was_mapped(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'plates.bloom')
+        vehicle = self.vehicle('OLD-666')
+        first = PlateFilter(path=path, refresh_interval=0)
+        first.refresh()
+        vehicle.license_plate = 'XYZ666'
+        vehicle.save()
+
+        second = PlateFilter(path=path, refresh_interval=0)
+        second.refresh()
+        self.assertTrue(second.might_contain('XYZ666'))
+        self.assertTrue(first.might_contain('XYZ666'))
+        self.assertEqual(second.stats()['plates'], 1)
+
+
+class PlateResolverTests(TestCase):
+    """A cached plate costs no query and is never resolved to stale ids in this process"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        self.user = User.objects.create_user(username='driver@example.com')
+        self.vehicle = Vehicle.objects.create(
+            user=self.user, license_plate='ABC-123', vehicle_type='car', vechile_model='Golf'
+        )
+
+    def test_cached_plate_needs_no_query(self):
+        record = plate_resolver.resolve('ABC-123')
+        self.assertEqual((record.vehicle_id, record.user_id, record.wallet_id), (self.vehicle.pk, self.user.pk, None))
+        with self.assertNumQueries(0):
+            self.assertEqual(plate_resolver.resolve('ABC-123'), record)
+        self.assertEqual(plate_resolver.stats()['hits'], 1)
+
+    def test_changed_plate_is_resolved_again(self):
+        plate_resolver.resolve('ABC-123')
+        self.vehicle.license_plate = 'XYZ-789'
+        self.vehicle.save()
+        self.assertIsNone(plate_resolver.resolve('ABC-123'))
+        self.assertEqual(plate_resolver.resolve('XYZ-789').vehicle_id, self.vehicle.pk)
+
+    def test_new_wallet_is_picked_up(self):
+        plate_resolver.resolve('ABC-123')
+        wallet = Wallet.objects.create(user=self.user)
+        self.assertEqual(plate_resolver.resolve('ABC-123').wallet_id, wallet.pk)
+
+    def test_deleted_vehicle_no_longer_resolves(self):
+        plate_resolver.resolve('ABC-123')
+        self.vehicle.delete()
+        self.assertIsNone(plate_resolver.resolve('ABC-123'))
+
+    def test_entries_are_bounded_by_size_and_age(self):
+        Vehicle.objects.create(user=self.user, license_plate='DEF-456', vehicle_type='car', vechile_model='Polo')
+        resolver = PlateResolver(max_size=1, ttl=300)
+        resolver.resolve_many(['ABC-123', 'DEF-456'])
+        self.assertEqual(resolver.stats()['size'], 1)
+
+        expired = PlateResolver(ttl=0)
+        expired.resolve('ABC-123')
+        with self.assertNumQueries(1):
+            expired.resolve('ABC-123')
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class VehicleListTests(TestCase):
+    """Vehicles are listed in id order, one bounded page per request"""
+
+    def setUp(self):
+        self.fleet = User.objects.create_user(username='fleet@example.com')
+        other = User.objects.create_user(username='other@example.com')
+        for number in range(5):
+            Vehicle.objects.create(
+                user=self.fleet if number % 2 == 0 else other, license_plate=f'LST-{number}',
+                vehicle_type='truck' if number < 3 else 'car', vechile_model='Actros'
+            )
+        self.client = APIClient()
+
+    def walk(self, query):
+        plates = []
+        url = f'/api/user/car?{query}'
+        while True:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            plates.append([vehicle['license_plate'] for vehicle in response.data])
+            if 'X-Next-Cursor' not in response:
+                return plates
+            url = f'/api/user/car?{query}&cursor={response["X-Next-Cursor"]}'
+
+    def test_pages_follow_the_cursor(self):
+        self.assertEqual(self.walk('limit=2'), [['LST-0', 'LST-1'], ['LST-2', 'LST-3'], ['LST-4']])
+        response = self.client.get('/api/user/car?limit=1')
+        self.assertEqual(response.data, [{
+            "car_id": str(Vehicle.objects.get(license_plate='LST-0').pk), "user_id": str(self.fleet.pk),
+            "license_plate": 'LST-0', "model": 'Actros', "color": 'white', "vehicle_type": 'truck',
+        }])
+
+    def test_filters_by_user_and_vehicle_type(self):
+        self.assertEqual(self.walk(f'user_id={self.fleet.pk}&limit=2'), [['LST-0', 'LST-2'], ['LST-4']])
+        self.assertEqual(self.walk(f'user_id={self.fleet.pk}&vehicle_type=truck'), [['LST-0', 'LST-2']])
+        self.assertEqual(self.walk('vehicle_type=car'), [['LST-3', 'LST-4']])
+
+    def test_a_page_is_one_query(self):
+        with self.assertNumQueries(1):
+            self.client.get('/api/user/car?limit=2')
+
+    def test_invalid_parameters_are_rejected(self):
+        self.assertEqual(self.client.get('/api/user/car?cursor=nonsense').status_code, 400)
+        self.assertEqual(self.client.get('/api/user/car?limit=1001').status_code, 400)
+        self.assertEqual(self.client.get('/api/user/car?vehicle_type=boat').status_code, 400)
+
+
+class PlateNormalizationTests(SimpleTestCase):
+    """Look-alike characters, case and separators never tell two reads apart"""
+
+    def test_look_alikes_share_a_normalized_plate(self):
+        self.assertEqual(normalize_plate('xyz-987'), 'XY2987')
+        self.assertEqual(normalize_plate('XY2 987'), normalize_plate('XYZ-987'))
+        self.assertEqual(normalize_plate('B0L-١٢٣'), '801123')
+
+    def test_look_alike_swaps_cost_less_than_edits(self):
+        self.assertEqual(confusion_distance('XYZ-987', 'XY2-987'), 0.25)
+        self.assertEqual(confusion_distance('XYZ987', 'XYZ988'), 1.0)
+        self.assertTrue(within_one_edit('XY2987', 'XY298'))
+        self.assertFalse(within_one_edit('XY2987', 'XY2899'))
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class PlateMatchingTests(TestCase):
+    """A misread is matched to the registered plates it may be, and charged only when unambiguous"""
+
+    def setUp(self):
+        plate_matcher.reset()
+        plate_resolver.clear()
+        self.addCleanup(plate_matcher.reset)
+        self.addCleanup(plate_resolver.clear)
+        self.user = User.objects.create_user(username='matched@example.com')
+        self.wallet = Wallet.objects.create(user=self.user)
+        self.vehicle = self.register('XYZ-987')
+        self.register('XYZ-988')
+
+    def register(self, plate):
+        return Vehicle.objects.create(user=self.user, license_plate=plate, vehicle_type='car', vechile_model='Golf')
+
+    def plates(self, read):
+        return [(candidate.license_plate, candidate.distance) for candidate in candidates(read)]
+
+    def test_candidates_are_ranked_closest_first(self):
+        self.assertEqual(self.plates('XY2-987'), [('XYZ-987', 0.25), ('XYZ-988', 1.25)])
+        self.assertEqual(self.plates('XYZ-98'), [('XYZ-987', 1.0), ('XYZ-988', 1.0)])
+        self.assertEqual(self.plates('ABC-123'), [])
+
+    def test_plates_registered_or_changed_later_are_matched(self):
+        candidates('XYZ-987')
+        self.register('NEW-555')
+        self.assertEqual(self.plates('NEW-55'), [('NEW-555', 1.0)])
+        # The index keeps the old plate until its rebuild; it is never returned
+        self.vehicle.license_plate = 'QQQ-111'
+        self.vehicle.save()
+        self.assertEqual(self.plates('XYZ-987'), [('XYZ-988', 1.0)])
+
+    def test_endpoint_lists_candidates(self):
+        response = APIClient().get('/api/user/car/match', {"plate": 'XY2-987', "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {"plate": 'XY2-987', "candidates": [{
+            "car_id": str(self.vehicle.pk), "user_id": str(self.user.pk), "license_plate": 'XYZ-987',
+            "vehicle_type": 'car', "distance": 0.25,
+        }]})
+
+    def test_capture_charges_only_an_unambiguous_match(self):
+        self.assertEqual(capture_match('XY2-987').vehicle_id, self.vehicle.pk)
+        # An edit is beyond the default distance
+        self.assertIsNone(capture_match('XYZ-98'))
+        with override_settings(PLATE_FUZZY_CAPTURE_DISTANCE=1):
+            # Tied between the two registered plates
+            self.assertIsNone(capture_match('XYZ-98'))
+            self.assertEqual(capture_match('XYZ-9877').vehicle_id, self.vehicle.pk)
+
+    def test_resolver_corrects_misreads_only_when_enabled(self):
+        self.assertIsNone(plate_resolver.resolve('XY2-987'))
+        with override_settings(PLATE_FUZZY_CAPTURE=True):
+            record = plate_resolver.resolve('XY2-987')
+        self.assertEqual((record.vehicle_id, record.wallet_id), (self.vehicle.pk, self.wallet.pk))
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class AsyncVehicleListTests(TestCase):
+    """The async vehicle list keeps the contract of the sync one"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='fleet@example.com')
+        for number in range(3):
+            Vehicle.objects.create(
+                user=self.user, license_plate=f'FLT-{number}', vehicle_type='truck', vechile_model='Actros'
+            )
+
+    async def test_page_matches_the_sync_endpoint(self):
+        query = f'?user_id={self.user.pk}&limit=2'
+        response = await AsyncClient().get(f'/api/async/user/car{query}')
+        sync = await sync_to_async(APIClient().get)(f'/api/user/car{query}')
+        self.assertEqual(response.json(), json.loads(sync.content))
+        self.assertEqual(response['X-Next-Cursor'], sync['X-Next-Cursor'])
+        self.assertEqual([vehicle['license_plate'] for vehicle in response.json()], ['FLT-0', 'FLT-1'])
+
+    async def test_invalid_cursor_is_rejected(self):
+        response = await AsyncClient().get('/api/async/user/car?cursor=nonsense')
+        self.assertEqual(response.status_code, 400)
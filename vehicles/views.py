@@ -1,13 +1,18 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from django.contrib.auth.models import User
+from users.authentication import MACHINE_CLIENT_AUTHENTICATION
+from . import listing, matching
 from .models import Vehicle
-from .serializers import VehicleSerializer, CreateVehicleSerializer
+from .serializers import (
+    VehicleSerializer, CreateVehicleSerializer, VehicleListQuerySerializer, PlateMatchQuerySerializer
+)
 
 
 class VehicleViewSet(viewsets.ModelViewSet):
     queryset = Vehicle.objects.all()
     serializer_class = VehicleSerializer
+    authentication_classes = MACHINE_CLIENT_AUTHENTICATION  # Mobile app
     
     def get_serializer_class(self):
         if self.action == 'create':
@@ -15,16 +20,43 @@ class VehicleViewSet(viewsets.ModelViewSet):
         return VehicleSerializer
     
     def list(self, request, *args, **kwargs):
-        """GET /user/car - Retrieve vehicle data for all users or a specific user"""
-        user_id = request.query_params.get('user_id')
+        """GET /user/car - Retrieve a page of vehicles, for all users or a specific user"""
+        params = VehicleListQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
         
-        if user_id:
-            vehicles = Vehicle.objects.filter(user_id=user_id)
-        else:
-            vehicles = Vehicle.objects.all()
+        try:
+            rows = list(listing.vehicles(params))
+        except ValueError:
+            return Response(
+                {"error": "Invalid cursor"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        serializer = VehicleSerializer(vehicles, many=True)
-        return Response(serializer.data)
+        vehicles, next_cursor = listing.listed(rows, params)
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return Response(vehicles, headers=headers)
+    
+    def match(self, request, *args, **kwargs):
+        """GET /user/car/match - Registered plates a camera read may be a misread of, closest first"""
+        params = PlateMatchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        plate = params.validated_data['plate']
+        
+        found = matching.candidates(plate, limit=params.validated_data['limit'])
+        return Response({
+            "plate": plate,
+            "candidates": [
+                {
+                    "car_id": str(candidate.vehicle_id),
+                    "user_id": str(candidate.user_id),
+                    "license_plate": candidate.license_plate,
+                    "vehicle_type": candidate.vehicle_type,
+                    "distance": candidate.distance,
+                }
+                for candidate in found
+            ],
+        })
     
     def create(self, request, *args, **kwargs):
         """POST /user/car - Add vehicle information for a user"""
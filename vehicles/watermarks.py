@@ -0,0 +1,38 @@
+"""
+Id watermark for in-memory structures that follow the Vehicle table.
+
+A process picks up vehicles created elsewhere by reading the rows with an
+id above the highest one it has seen. Ids are assigned before commit, so
+a row can become visible after a row with a higher id; the watermarks of
+past refreshes are therefore kept for OVERLAP seconds and reading starts
+from the oldest of them, which re-reads the last minute of rows.
+
+The same holds for the updated_at times that pick up changed plates: a
+save is stamped before it commits, so it is read from the refresh times
+of the last OVERLAP seconds.
+"""
+import time
+from collections import deque
+
+
+OVERLAP = 60
+
+
+class Watermark:
+    """Highest vehicle ids (or times) seen by recent refreshes"""
+
+    def __init__(self):
+        self._marks = deque()   # (time.monotonic(), highest vehicle id)
+
+    def since(self, default=0):
+        """Id to read vehicles after: the oldest watermark still within OVERLAP"""
+        now = time.monotonic()
+        while len(self._marks) > 1 and self._marks[1][0] <= now - OVERLAP:
+            self._marks.popleft()
+        return self._marks[0][1] if self._marks else default
+
+    def advance(self, max_id):
+        self._marks.append((time.monotonic(), max_id))
+
+    def clear(self):
+        self._marks.clear()
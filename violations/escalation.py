@@ -0,0 +1,129 @@
+"""
+Nightly penalty escalation, in primary key chunks over a process pool.
+
+Two tables carry escalating penalties (see violations/penalties.py):
+- violations.Violation.escalated_penalty is set to get_current_penalty()
+- ai.Violation.current_violation_amount is escalated from
+  base_violation_amount while its trip is unpaid
+
+The key range of each table is cut into chunks of chunk_size keys. A chunk
+is one UPDATE that computes the penalty in SQL and writes only the rows
+whose stored penalty changed (a penalty steps once every
+ESCALATION_PERIOD_DAYS), so no rows are loaded into Python. Chunks run in
+a pool of forked worker processes, each with its own database
+connection.
+
+Progress is kept in a ProcessingCheckpoint per table: its position is the
+highest key below which every chunk has finished. Chunks finish out of
+order, so after a crash the chunks past the position run again. That
+is harmless because a run computes every penalty as of its start time,
+stored as the checkpoint's run_started_at and reused when the run resumes.
+
+Usage:
+    run('violations', chunk_size=20000, workers=8)
+"""
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from django.db import connections
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from ai.models import Violation as AIViolation
+from .models import ProcessingCheckpoint, Violation
+from .penalties import current_penalty, escalation
+
+
+Target = namedtuple('Target', ['model', 'key', 'rows', 'field', 'penalty'])
+
+TARGETS = {
+    'violations': Target(
+        Violation, 'id', Q(), 'escalated_penalty', current_penalty
+    ),
+    'ai': Target(
+        AIViolation, 'violation_no', Q(trip__status='unpaid', base_violation_amount__isnull=False),
+        'current_violation_amount', lambda now: escalation('base_violation_amount', 'timestamp', now)
+    ),
+}
+CHUNK_SIZE = 20000
+
+
+def checkpoint_name(target):
+    return f"escalate_penalties:{target}"
+
+
+def chunks(target, start, chunk_size):
+    """(low, high] key ranges covering the target's rows with a key above start"""
+    spec = TARGETS[target]
+    bounds = spec.model.objects.filter(**{f"{spec.key}__gt": start}).aggregate(
+        low=Min(spec.key), high=Max(spec.key)
+    )
+    if bounds['low'] is None:
+        return []
+    return [
+        (low, min(low + chunk_size, bounds['high']))
+        for low in range(bounds['low'] - 1, bounds['high'], chunk_size)
+    ]
+
+
+def escalate_chunk(target, low, high, now):
+    """Store the penalties of one key range as of now. Returns the number of rows changed."""
+    spec = TARGETS[target]
+    penalty = spec.penalty(now)
+    rows = spec.model.objects.filter(spec.rows, **{f"{spec.key}__gt": low, f"{spec.key}__lte": high})
+    return rows.exclude(**{spec.field: penalty}).update(**{spec.field: penalty})
+
+
+def _start(target, restart):
+    checkpoint, _ = ProcessingCheckpoint.objects.get_or_create(name=checkpoint_name(target))
+    if restart or checkpoint.run_started_at is None or checkpoint.completed_at is not None:
+        checkpoint.position = 0
+        checkpoint.run_started_at = timezone.now()
+        checkpoint.completed_at = None
+        checkpoint.save()
+    return checkpoint
+
+
+def run(target, chunk_size=CHUNK_SIZE, workers=1, restart=False, log=None):
+    """Escalate one target, resuming an unfinished run unless restart. Returns (chunks, rows changed)."""
+    checkpoint = _start(target, restart)
+    now = checkpoint.run_started_at
+    ranges = chunks(target, checkpoint.position, chunk_size)
+    finished = [False] * len(ranges)
+    next_unfinished = 0
+    changed = 0
+    started = time.perf_counter()
+
+    def record(index, rows):
+        nonlocal next_unfinished, changed
+        finished[index] = True
+        changed += rows
+        advanced = next_unfinished
+        while next_unfinished < len(ranges) and finished[next_unfinished]:
+            next_unfinished += 1
+        if next_unfinished > advanced:
+            checkpoint.position = ranges[next_unfinished - 1][1]
+            checkpoint.save(update_fields=['position', 'updated_at'])
+        if log:
+            log(f"{target}: {sum(finished)}/{len(ranges)} chunks, {changed} changed, "
+                f"{time.perf_counter() - started:.1f}s")
+
+    if workers > 1 and len(ranges) > 1:
+        # Forked workers must not share the parent's connections
+        connections.close_all()
+        with ProcessPoolExecutor(workers, mp_context=get_context('fork')) as pool:
+            futures = {
+                pool.submit(escalate_chunk, target, low, high, now): index
+                for index, (low, high) in enumerate(ranges)
+            }
+            for future in as_completed(futures):
+                record(futures[future], future.result())
+    else:
+        for index, (low, high) in enumerate(ranges):
+            record(index, escalate_chunk(target, low, high, now))
+
+    checkpoint.completed_at = timezone.now()
+    checkpoint.save(update_fields=['completed_at', 'updated_at'])
+    return len(ranges), changed
@@ -0,0 +1,45 @@
+"""
+Store escalated penalties for every open violation.
+
+Usage:
+    python manage.py escalate_penalties
+    python manage.py escalate_penalties --target ai --workers 8 --chunk-size 50000
+    python manage.py escalate_penalties --restart
+
+Meant to run nightly. Each table is updated in primary key chunks by a
+pool of worker processes, one UPDATE per chunk (see
+violations/escalation.py). Progress is checkpointed after every chunk, so
+a run that was interrupted resumes where it stopped, with the same "now",
+when the command runs again. --restart discards an unfinished run.
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from violations.escalation import CHUNK_SIZE, TARGETS, run
+
+
+class Command(BaseCommand):
+    help = "Escalate unpaid violation penalties in resumable chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=[*TARGETS, 'all'], default='all')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Primary keys per chunk")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--restart', action='store_true', help="Start over instead of resuming")
+        parser.add_argument('--progress', action='store_true', help="Report every finished chunk")
+
+    def handle(self, *args, **options):
+        targets = list(TARGETS) if options['target'] == 'all' else [options['target']]
+        log = self.stdout.write if options['progress'] else None
+        for target in targets:
+            started = time.perf_counter()
+            chunks, changed = run(
+                target, chunk_size=options['chunk_size'], workers=options['workers'],
+                restart=options['restart'], log=log
+            )
+            self.stdout.write(
+                f"{target}: {changed} penalties changed in {chunks} chunks, "
+                f"{time.perf_counter() - started:.2f}s"
+            )
@@ -0,0 +1,42 @@
+"""
+Issue violations for unpaid trips.
+
+Usage: python manage.py reconcile_violations --interval 60
+       python manage.py reconcile_violations --once
+
+Each pass reads only the unpaid trips since the previous one (see
+violations/reconciliation.py). Passes are safe to repeat or to run from
+several hosts: a trip never gets a second violation.
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from violations.reconciliation import reconcile
+
+
+class Command(BaseCommand):
+    help = "Issue a toll evasion violation for every unpaid trip since the last pass"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds between passes")
+        parser.add_argument('--batch-size', type=int, default=None, help="Trips per transaction")
+        parser.add_argument('--once', action='store_true', help="Make one pass and exit")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        total = 0
+        started = time.perf_counter()
+        try:
+            while not stop.is_set():
+                issued = reconcile(options['batch_size'])
+                if issued:
+                    total += sum(issued.values())
+                    self.stdout.write(f"Issued {sum(issued.values())} violations to {len(issued)} vehicles")
+                if options['once']:
+                    break
+                stop.wait(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Issued {total} violations in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicles', '0004_vehicle_normalized_plate'),
+        ('violations', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='violation',
+            index=models.Index(fields=['status', 'vehicle'], name='violation_status_vehicle_idx'),
+        ),
+    ]
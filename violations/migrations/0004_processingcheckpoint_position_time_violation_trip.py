@@ -0,0 +1,25 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('toll', '0005_trip_trip_status_time_idx'),
+        ('violations', '0003_processingcheckpoint_violation_escalated_penalty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingcheckpoint',
+            name='position_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='violation',
+            name='trip',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='violation', to='toll.trip'),
+        ),
+    ]
@@ -1,5 +1,33 @@
 from django.db import models
-from datetime import datetime, timedelta
+from django.db.models import Count, Sum
+
+from .penalties import CENT, PAID, PENALTY_FIELD, ZERO, current_penalty, escalated
+
+
+class ViolationQuerySet(models.QuerySet):
+    """Penalty figures computed in the database; see violations/penalties.py"""
+
+    def outstanding(self):
+        return self.exclude(status=PAID)
+
+    def with_current_penalty(self, now=None):
+        """Annotate each violation with current_penalty"""
+        return self.annotate(current_penalty=current_penalty(now))
+
+    def outstanding_total(self, vehicle, now=None):
+        """Sum of a vehicle's (instance or id) unpaid penalties as of now"""
+        total = self.outstanding().filter(vehicle=vehicle).aggregate(total=Sum(current_penalty(now), output_field=PENALTY_FIELD))['total']
+        return total.quantize(CENT) if total is not None else ZERO
+
+    def top_debtors(self, n, now=None):
+        """The n owners with the highest unpaid penalties: [{"user_id", "total", "violations"}]"""
+        return list(
+            self.outstanding()
+            .values(user_id=models.F('vehicle__user_id'))
+            .annotate(total=Sum(current_penalty(now), output_field=PENALTY_FIELD), violations=Count('id'))
+            .order_by('-total', 'user_id')[:n]
+        )
+
 
 class Violation(models.Model):
     vehicle = models.ForeignKey('vehicles.Vehicle', on_delete=models.CASCADE)
@@ -7,12 +35,33 @@ class Violation(models.Model):
     violation_type = models.CharField(max_length=100)  # e.g., 'speeding', 'toll evasion'
     base_penalty = models.DecimalField(max_digits=10, decimal_places=2, default=50.00)  # Base amount
     status = models.CharField(max_length=20, default='Unpaid')  # Paid, Unpaid
+    # The unpaid trip this violation was issued for (python manage.py reconcile_violations)
+    trip = models.OneToOneField('toll.Trip', on_delete=models.CASCADE, null=True, blank=True, related_name='violation')
+    # get_current_penalty() as of the last escalate_penalties run
+    escalated_penalty = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+
+    objects = ViolationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Outstanding penalties grouped by vehicle (top_debtors)
+            models.Index(fields=['status', 'vehicle'], name='violation_status_vehicle_idx'),
+        ]
+
+    def get_current_penalty(self, now=None):
+        if self.status == PAID:
+            return ZERO  # Penalty disappears once paid
+        return escalated(self.base_penalty, self.violation_date, now)
+
+
+class ProcessingCheckpoint(models.Model):
+    """Progress of a resumable batch job over rows in primary key order"""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)  # Every row with a key up to here is done
+    position_time = models.DateTimeField(null=True, blank=True)  # Or, for jobs in time order, up to this time
+    run_started_at = models.DateTimeField(null=True, blank=True)  # Also the "now" the run computes with
+    completed_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
-    def get_current_penalty(self):
-        if self.status == 'Paid':
-            return 0  # Penalty disappears once paid
-        days_since = (datetime.now() - self.violation_date.replace(tzinfo=None)).days
-        periods = days_since // 5  # Number of 5-day periods
-        increase_percentage = 0.10  # 10% increase per 5 days
-        multiplier = 1 + (periods * increase_percentage)
-        return self.base_penalty * multiplier
\ No newline at end of file
+    def __str__(self):
+        return f"{self.name} at {self.position}"
@@ -0,0 +1,80 @@
+"""
+Penalty escalation, in Python and as a SQL expression.
+
+An unpaid violation's penalty grows by ESCALATION_RATE of its base penalty
+for every full ESCALATION_PERIOD_DAYS since the violation; a paid one owes
+nothing. current_penalty() computes the same figure in the database, so
+listing, ranking and summing penalties needs no rows in Python:
+
+    Violation.objects.with_current_penalty().order_by('-current_penalty')
+    Violation.objects.outstanding_total(vehicle)
+    Violation.objects.top_debtors(10)
+
+escalation() is the same rule for any model; python manage.py
+escalate_penalties stores it nightly (violations/escalation.py).
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db.models import Case, DateTimeField, DecimalField, F, Func, IntegerField, Value, When
+from django.db.models.functions import Greatest, Round
+from django.utils import timezone
+
+
+PAID = 'Paid'
+UNPAID = 'Unpaid'
+ESCALATION_PERIOD_DAYS = 5
+ESCALATION_RATE = Decimal('0.10')
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+PENALTY_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+def escalated(base_penalty, violation_date, now=None):
+    """base_penalty after the escalation periods from violation_date to now, to the cent"""
+    now = now or timezone.now()
+    periods = max(0, (now - violation_date).days // ESCALATION_PERIOD_DAYS)
+    # The field default is a float until the row is saved
+    return (Decimal(str(base_penalty)) * (1 + periods * ESCALATION_RATE)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class PeriodsSince(Func):
+    """Whole periods of `days` days from a datetime expression to `now`, truncated toward zero"""
+    output_field = IntegerField()
+
+    def __init__(self, expression, now, days, **extra):
+        self.days = days
+        super().__init__(expression, Value(now, output_field=DateTimeField()), **extra)
+
+    def _compiled(self, compiler):
+        (value, value_params), (now, now_params) = (
+            compiler.compile(expression) for expression in self.get_source_expressions()
+        )
+        return value, value_params, now, now_params
+
+    def as_sql(self, compiler, connection, **extra_context):
+        value, value_params, now, now_params = self._compiled(compiler)
+        seconds = 86400 * self.days
+        return f"CAST(EXTRACT(EPOCH FROM ({now} - {value})) / {seconds} AS integer)", [*now_params, *value_params]
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        value, value_params, now, now_params = self._compiled(compiler)
+        return f"CAST((julianday({now}) - julianday({value})) / {self.days} AS integer)", [*now_params, *value_params]
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        value, value_params, now, now_params = self._compiled(compiler)
+        return f"(TIMESTAMPDIFF(DAY, {value}, {now}) DIV {self.days})", [*value_params, *now_params]
+
+
+def escalation(base, since, now=None):
+    """Expression for the field base escalated for the periods from the datetime field since to now"""
+    periods = Greatest(PeriodsSince(since, now or timezone.now(), ESCALATION_PERIOD_DAYS), Value(0))
+    return Round(F(base) + F(base) * periods * Value(ESCALATION_RATE), 2, output_field=PENALTY_FIELD)
+
+
+def current_penalty(now=None):
+    """Expression for a Violation's penalty at now, equal to Violation.get_current_penalty()"""
+    return Case(
+        When(status=PAID, then=Value(ZERO)),
+        default=escalation('base_penalty', 'violation_date', now),
+        output_field=PENALTY_FIELD,
+    )
@@ -0,0 +1,80 @@
+"""
+Issue a violation for every unpaid trip, incrementally.
+
+A capture the wallet could not pay leaves a Trip with status 'unpaid'.
+reconcile() issues one 'toll evasion' Violation per such trip, linked
+through Violation.trip. It reads only the unpaid trips written since a
+watermark on Trip.created_at, through the (status, created_at) index, so
+a pass costs the same however large the trips table grows.
+
+The watermark is on write time, not trip_time: batch and write-behind
+captures store the gate's read time as trip_time, which can be hours
+before the trip is written. The watermark is kept in the
+ProcessingCheckpoint named 'reconcile_violations'. created_at is stamped
+before the trip commits, by the clock of the host writing it, so a pass
+starts VIOLATION_RECONCILE_OVERLAP seconds before the watermark. Trips in
+that overlap that already have a violation are skipped by the join on
+the unique Violation.trip, so passes can repeat any range.
+
+Each batch of trips is issued in one transaction that also moves the
+watermark, holding the checkpoint row locked, so concurrent passes take
+turns and a crash loses nothing. The first pass issues violations for
+every unpaid trip without one.
+
+Usage:
+    reconcile()     # {vehicle id: violations issued}
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from toll.models import Trip
+from .models import ProcessingCheckpoint, Violation
+
+
+CHECKPOINT = 'reconcile_violations'
+VIOLATION_TYPE = 'toll evasion'
+
+
+def _issue(checkpoint_id, since, batch_size):
+    """Issue violations for the next batch of unpaid trips from since. Returns the batch."""
+    with transaction.atomic():
+        checkpoint = ProcessingCheckpoint.objects.select_for_update().get(pk=checkpoint_id)
+        trips = Trip.objects.filter(status='unpaid', violation__isnull=True)
+        if since is not None:
+            trips = trips.filter(created_at__gte=since)
+        batch = list(trips.order_by('created_at').values_list('trip_id', 'vehicle_id', 'created_at')[:batch_size])
+        if batch:
+            Violation.objects.bulk_create(
+                [Violation(trip_id=trip_id, vehicle_id=vehicle_id, violation_type=VIOLATION_TYPE)
+                 for trip_id, vehicle_id, _ in batch],
+                # A violation issued for the trip by other means wins
+                ignore_conflicts=True
+            )
+            # The writing host's clock may run ahead
+            reached = min(batch[-1][2], timezone.now())
+            if checkpoint.position_time is None or reached > checkpoint.position_time:
+                checkpoint.position_time = reached
+        checkpoint.completed_at = timezone.now()
+        checkpoint.save(update_fields=['position_time', 'completed_at', 'updated_at'])
+    return batch
+
+
+def reconcile(batch_size=None):
+    """Issue violations for unpaid trips since the watermark. Returns {vehicle id: violations issued}."""
+    batch_size = batch_size or settings.VIOLATION_RECONCILE_BATCH
+    checkpoint, _ = ProcessingCheckpoint.objects.get_or_create(name=CHECKPOINT)
+    since = None
+    if checkpoint.position_time is not None:
+        since = checkpoint.position_time - timedelta(seconds=settings.VIOLATION_RECONCILE_OVERLAP)
+    issued = {}
+    while True:
+        batch = _issue(checkpoint.pk, since, batch_size)
+        for _, vehicle_id, _ in batch:
+            issued[vehicle_id] = issued.get(vehicle_id, 0) + 1
+        if len(batch) < batch_size:
+            return issued
+        # Trips issued in this batch are skipped by the join, including any at the same time
+        since = batch[-1][2]
@@ -1,3 +1,236 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from ai.models import Violation as AIViolation
+from toll.models import Gate, Trip
+from vehicles.models import Vehicle
+from vehicles.resolver import plate_resolver
+from . import escalation
+from .models import ProcessingCheckpoint, Violation
+from .penalties import escalated
+from .reconciliation import CHECKPOINT, reconcile
+
+
+@override_settings(ALLOWED_HOSTS=['*'], VIOLATION_RECONCILE_OVERLAP=60)
+class ViolationReconciliationTests(TestCase):
+    """Every unpaid trip gets exactly one violation, however late it is written"""
+
+    def setUp(self):
+        plate_resolver.clear()
+        self.addCleanup(plate_resolver.clear)
+        user = User.objects.create_user(username='evader@example.com')
+        self.vehicle = Vehicle.objects.create(
+            user=user, license_plate='EVD-100', vehicle_type='car', vechile_model='Golf'
+        )
+        self.gate = Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+
+    def trip(self, status='unpaid', **fields):
+        trip = Trip.objects.create(vehicle=self.vehicle, gate=self.gate, fare_amount=10, status=status)
+        if fields:
+            Trip.objects.filter(pk=trip.pk).update(**fields)
+        return trip
+
+    def watermark(self):
+        return ProcessingCheckpoint.objects.get(name=CHECKPOINT).position_time
+
+    def test_issues_one_violation_per_unpaid_trip(self):
+        unpaid = [self.trip() for _ in range(3)]
+        self.trip(status='paid')
+        self.assertEqual(reconcile(), {self.vehicle.pk: 3})
+        self.assertEqual(
+            sorted(Violation.objects.values_list('trip_id', flat=True)), [trip.pk for trip in unpaid]
+        )
+        violation = Violation.objects.first()
+        self.assertEqual((violation.vehicle_id, violation.violation_type), (self.vehicle.pk, 'toll evasion'))
+
+    def test_passes_can_repeat(self):
+        self.trip()
+        reconcile()
+        # Forget the watermark: the overlap and the first pass read every trip again
+        ProcessingCheckpoint.objects.filter(name=CHECKPOINT).update(position_time=None)
+        self.assertEqual(reconcile(), {})
+        self.assertEqual(Violation.objects.count(), 1)
+
+    def test_trip_with_a_violation_is_skipped(self):
+        trip = self.trip()
+        Violation.objects.create(vehicle=self.vehicle, trip=trip, violation_type='manual')
+        self.assertEqual(reconcile(), {})
+
+    def test_batches_move_the_watermark(self):
+        trips = [self.trip(created_at=timezone.now() - timedelta(seconds=10 - i)) for i in range(5)]
+        self.assertEqual(reconcile(batch_size=2), {self.vehicle.pk: 5})
+        self.assertEqual(self.watermark(), Trip.objects.get(pk=trips[-1].pk).created_at)
+
+    def test_late_read_written_after_the_watermark_is_issued(self):
+        self.trip()
+        reconcile()
+        # A gate uploads reads it buffered two hours ago; the owner has no wallet
+        read_at = timezone.now() - timedelta(hours=2)
+        response = APIClient().post(
+            f'/api/capture/{self.gate.gate_id}/batch/',
+            {"reads": [{"license_plate": 'EVD-100', "timestamp": read_at.isoformat()}]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        late = Trip.objects.latest('trip_id')
+        self.assertEqual((late.status, late.trip_time), ('unpaid', read_at))
+        self.assertLess(late.trip_time, self.watermark())
+
+        self.assertEqual(reconcile(), {self.vehicle.pk: 1})
+        self.assertTrue(Violation.objects.filter(trip=late).exists())
+
+    def test_trip_committed_within_the_overlap_is_issued(self):
+        self.trip()
+        reconcile()
+        # Stamped before the watermark moved, committed after the pass
+        self.trip(created_at=self.watermark() - timedelta(seconds=30))
+        self.assertEqual(reconcile(), {self.vehicle.pk: 1})
+
+    def test_command_reports_issued_violations(self):
+        self.trip()
+        self.trip()
+        out = StringIO()
+        call_command('reconcile_violations', '--once', stdout=out)
+        self.assertIn("Issued 2 violations to 1 vehicles", out.getvalue())
+
+
+class PenaltyTests(TestCase):
+    """Penalties computed in SQL are the penalties get_current_penalty() computes"""
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.owners = [User.objects.create_user(username=f'debtor{number}@example.com') for number in range(2)]
+        self.vehicles = [
+            Vehicle.objects.create(user=user, license_plate=f'PEN-{number}', vehicle_type='car', vechile_model='Golf')
+            for number, user in enumerate(self.owners)
+        ]
+
+    def violation(self, age, base_penalty='50.00', status='Unpaid', vehicle=0):
+        violation = Violation.objects.create(
+            vehicle=self.vehicles[vehicle], violation_type='speeding', base_penalty=Decimal(base_penalty), status=status
+        )
+        Violation.objects.filter(pk=violation.pk).update(violation_date=self.now - age)
+        violation.refresh_from_db()
+        return violation
+
+    def test_sql_matches_python_at_period_boundaries(self):
+        ages = [timedelta(0), timedelta(days=4), timedelta(days=5, seconds=-1), timedelta(days=5),
+                timedelta(days=12), timedelta(days=365), timedelta(days=-3)]
+        for age in ages:
+            for base_penalty in ['50.00', '33.33', '0.05']:
+                self.violation(age, base_penalty)
+        self.violation(timedelta(days=30), status='Paid')
+        for violation in Violation.objects.with_current_penalty(self.now):
+            with self.subTest(age=self.now - violation.violation_date, base_penalty=violation.base_penalty):
+                self.assertEqual(violation.current_penalty, violation.get_current_penalty(self.now))
+
+    def test_escalation_steps_every_period(self):
+        self.assertEqual(escalated(Decimal('50.00'), self.now - timedelta(days=4), self.now), Decimal('50.00'))
+        self.assertEqual(escalated(Decimal('50.00'), self.now - timedelta(days=12), self.now), Decimal('60.00'))
+        self.assertEqual(escalated(Decimal('33.33'), self.now - timedelta(days=5), self.now), Decimal('36.66'))
+        # An unsaved violation still holds the float default
+        unsaved = Violation(violation_date=self.now - timedelta(days=5))
+        self.assertEqual(unsaved.get_current_penalty(self.now), Decimal('55.00'))
+        unsaved.status = 'Paid'
+        self.assertEqual(unsaved.get_current_penalty(self.now), Decimal('0.00'))
+
+    def test_totals_and_debtors_are_aggregated_in_the_database(self):
+        self.violation(timedelta(days=10))                      # 60.00
+        self.violation(timedelta(days=0), '20.00')              # 20.00
+        self.violation(timedelta(days=50), status='Paid')
+        self.violation(timedelta(days=5), vehicle=1)            # 55.00
+        with self.assertNumQueries(1):
+            self.assertEqual(Violation.objects.outstanding_total(self.vehicles[0], self.now), Decimal('80.00'))
+        self.assertEqual(Violation.objects.outstanding_total(self.vehicles[1].pk, self.now), Decimal('55.00'))
+        self.assertEqual(Violation.objects.outstanding_total(self.vehicles[1], self.now - timedelta(days=1)),
+                         Decimal('50.00'))
+        with self.assertNumQueries(1):
+            debtors = Violation.objects.top_debtors(5, self.now)
+        self.assertEqual(
+            [(debtor['user_id'], debtor['total'], debtor['violations']) for debtor in debtors],
+            [(self.owners[0].pk, Decimal('80.00'), 2), (self.owners[1].pk, Decimal('55.00'), 1)]
+        )
+
+
+class EscalationTests(TestCase):
+    """A run stores every penalty as of its start, however many times it is interrupted"""
+
+    def setUp(self):
+        user = User.objects.create_user(username='escalated@example.com')
+        self.vehicle = Vehicle.objects.create(user=user, license_plate='ESC-1', vehicle_type='car', vechile_model='Golf')
+        now = timezone.now()
+        for days in [0, 5, 11, 16, 40]:
+            violation = Violation.objects.create(vehicle=self.vehicle, violation_type='speeding', base_penalty=50)
+            Violation.objects.filter(pk=violation.pk).update(violation_date=now - timedelta(days=days))
+
+    def checkpoint(self):
+        return ProcessingCheckpoint.objects.get(name=escalation.checkpoint_name('violations'))
+
+    def assertEscalatedAsOf(self, now):
+        for violation in Violation.objects.all():
+            self.assertEqual(violation.escalated_penalty, violation.get_current_penalty(now))
+
+    def test_run_stores_current_penalties_in_chunks(self):
+        self.assertEqual(escalation.run('violations', chunk_size=2), (3, 5))
+        checkpoint = self.checkpoint()
+        self.assertIsNotNone(checkpoint.completed_at)
+        self.assertEqual(checkpoint.position, Violation.objects.latest('id').pk)
+        self.assertEscalatedAsOf(checkpoint.run_started_at)
+        # Penalties step once a period, so the next run has nothing to write
+        self.assertEqual(escalation.run('violations', chunk_size=2), (3, 0))
+
+    def test_interrupted_run_resumes_with_its_start_time(self):
+        escalate_chunk = escalation.escalate_chunk
+        calls = []
+
+        def crash_on_third(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise RuntimeError("worker lost")
+            return escalate_chunk(*args)
+
+        with mock.patch.object(escalation, 'escalate_chunk', crash_on_third):
+            with self.assertRaises(RuntimeError):
+                escalation.run('violations', chunk_size=2)
+        interrupted = self.checkpoint()
+        self.assertIsNone(interrupted.completed_at)
+        self.assertEqual(interrupted.position, calls[1][2])
+        self.assertEqual(Violation.objects.filter(escalated_penalty__isnull=True).count(), 1)
+
+        self.assertEqual(escalation.run('violations', chunk_size=2), (1, 1))
+        self.assertEqual(self.checkpoint().run_started_at, interrupted.run_started_at)
+        self.assertEscalatedAsOf(interrupted.run_started_at)
+
+    def test_restart_discards_an_unfinished_run(self):
+        ProcessingCheckpoint.objects.create(
+            name=escalation.checkpoint_name('violations'), position=Violation.objects.latest('id').pk,
+            run_started_at=timezone.now() - timedelta(days=30)
+        )
+        self.assertEqual(escalation.run('violations', chunk_size=10), (0, 0))
+        self.assertEqual(escalation.run('violations', chunk_size=10, restart=True), (1, 5))
+        self.assertEscalatedAsOf(self.checkpoint().run_started_at)
+
+    def test_ai_violations_escalate_only_while_the_trip_is_unpaid(self):
+        gate = Gate.objects.create(gate_id='G1', gate_name='North', gate_location='Ring road')
+        amounts = {}
+        for status in ['unpaid', 'Paid']:
+            trip = Trip.objects.create(vehicle=self.vehicle, gate=gate, fare_amount=10, status=status)
+            violation = AIViolation.objects.create(
+                trip=trip, vehicle_type='car', base_violation_amount=Decimal('40.00'),
+                current_violation_amount=Decimal('40.00')
+            )
+            AIViolation.objects.filter(pk=violation.pk).update(timestamp=timezone.now() - timedelta(days=10))
+            amounts[status] = violation.pk
+        out = StringIO()
+        call_command('escalate_penalties', '--target', 'ai', '--workers', '1', stdout=out)
+        self.assertIn("ai: 1 penalties changed in 1 chunks", out.getvalue())
+        self.assertEqual(AIViolation.objects.get(pk=amounts['unpaid']).current_violation_amount, Decimal('48.00'))
+        self.assertEqual(AIViolation.objects.get(pk=amounts['Paid']).current_violation_amount, Decimal('40.00'))